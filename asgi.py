@@ -0,0 +1,301 @@
+"""
+asyncio serving mode. Webhook events are handled as tasks on one event
+loop, so waiting on OpenAI, websites or LINE does not hold a thread.
+
+    python asgi.py
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+Requires aiohttp and uvicorn in addition to requirements.txt.
+"""
+import asyncio
+import os
+
+from linebot import AsyncLineBotApi
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import MessageEvent, TextMessage, TextSendMessage, AudioMessage, FollowEvent
+
+import main
+from src.cache import LRUCache
+from src.dedup import event_key
+from src.http_client import async_http_client
+from src.key_pool import AsyncPooledOpenAIModel
+from src.logger import logger, log_payload
+from src.metrics import metrics
+from src.models import AsyncOpenAIModel, OpenAIModelCmd
+from src.service.audio import AudioRejected, AUDIO_BUSY_MESSAGE
+from src.service.website import WebsiteReader
+from src.service.youtube import YoutubeTranscriptReader
+from src.rate_limiter import set_reply_deadline
+from src.single_flight import AsyncSingleFlight
+from src.utils import get_role_and_content
+
+line_bot_api = None
+async_models = LRUCache(maxsize=int(os.getenv('MODEL_CACHE_SIZE') or 10000))
+user_tasks = {}
+default_async_model = AsyncPooledOpenAIModel(main.key_pool) if main.key_pool else None
+metrics.register('inflight_users', lambda: len(user_tasks))
+summary_flight = AsyncSingleFlight()
+# a failed generation may be down to the leader's own key
+image_flight = AsyncSingleFlight(shareable=lambda result: result[0])
+# downloads and transcriptions in flight, like the audio threads of main
+audio_slots = asyncio.Semaphore(main.audio_transcriber.workers)
+
+
+async def get_async_model(user_id: str) -> AsyncOpenAIModel:
+    model = await asyncio.to_thread(main.get_model, user_id)
+    if model is main.default_model:
+        return default_async_model
+    api_key = model.api_key
+    model = async_models.get(api_key)
+    if model is None:
+        model = AsyncOpenAIModel(api_key=api_key)
+        async_models.set(api_key, model)
+    return model
+
+
+async def summarize_youtube_async(reader: YoutubeTranscriptReader, video_id: str) -> str:
+    is_successful, chunks, error_message = await main.youtube.get_transcript_chunks_async(video_id, reader.model_engine)
+    if not is_successful:
+        raise Exception(error_message)
+    is_successful, response, error_message = await reader.summarize_async(chunks)
+    if not is_successful:
+        raise Exception(error_message)
+    _, response = get_role_and_content(response)
+    return response
+
+
+async def summarize_website_async(reader: WebsiteReader, url: str) -> str:
+    chunks = await main.website.get_content_from_url_async(url)
+    if len(chunks) == 0:
+        raise Exception('このサイトからテキストを取得できませんでした。')
+    is_successful, response, error_message = await reader.summarize_async(chunks)
+    if not is_successful:
+        raise Exception(error_message)
+    _, response = get_role_and_content(response)
+    return response
+
+
+async def load_summary_async(cache_key: str, load, reader, source: str) -> str:
+    response = main.summary_cache.peek(cache_key)
+    if response is None:
+        response = await load(reader, source)
+        await asyncio.to_thread(main.summary_cache.set, cache_key, response)
+    return response
+
+
+async def get_image_async(user_model: AsyncOpenAIModel, prompt: str):
+    response = main.image_pool.take(prompt)
+    if response is not None:
+        return True, response, None
+    if main.coalesce_image_prompts:
+        result = await image_flight.do(f'image:{prompt}', user_model.image_generations, prompt)
+    else:
+        result = await user_model.image_generations(prompt)
+    if result[0]:
+        main.image_pool.remember(prompt, result[1])
+    return result
+
+
+async def summarize_url_async(user_id: str, text: str):
+    user_model = await get_async_model(user_id)
+    await asyncio.to_thread(main.memory.append, user_id, 'user', text)
+    url = main.website.get_url_from_text(text)
+    if not url:
+        return main.build_summary_message("入力された内容はURLではありませんでした。")
+    model_engine = os.getenv('OPENAI_MODEL_ENGINE')
+    video_id = main.youtube.retrieve_video_id(text)
+    if video_id:
+        reader = YoutubeTranscriptReader(user_model, model_engine)
+        cache_key = main.summary_cache.make_key(f'youtube:{video_id}', reader.prompt_key(), model_engine)
+        load = summarize_youtube_async
+        source = video_id
+    else:
+        reader = WebsiteReader(user_model, model_engine)
+        cache_key = main.summary_cache.make_key(f'url:{main.website.canonicalize_url(url)}', reader.prompt_key(), model_engine)
+        load = summarize_website_async
+        source = url
+    response = await asyncio.to_thread(main.summary_cache.get, cache_key)
+    if response is None:
+        response = await summary_flight.do(cache_key, load_summary_async, cache_key, load, reader, source)
+    else:
+        logger.info(f'summary cache hit: {cache_key}')
+    await asyncio.to_thread(main.memory.append, user_id, 'assistant', response)
+    return main.build_summary_message(response)
+
+
+async def answer_chat_async(user_id: str, text: str):
+    user_model = await get_async_model(user_id)
+    comp = await asyncio.to_thread(main.build_chat_prompt, user_id, text)
+    is_successful, response, error_message = await user_model.chat_completions(comp, os.getenv('OPENAI_MODEL_ENGINE'))
+    if not is_successful:
+        raise Exception(error_message)
+    role, response = get_role_and_content(response)
+    log_payload('model_response', response)
+    reply, samples = main.get_reply_and_reply_samples(response)
+    msg = main.build_chat_message(reply, samples)
+    await asyncio.to_thread(main.memory.append, user_id, role, reply)
+    return msg
+
+
+async def handle_text_message_async(event):
+    user_id = event.source.user_id
+    text = str(event.message.text.strip())
+    logger.info(f'{user_id}: {text}')
+    set_reply_deadline(event.timestamp)
+
+    try:
+        cmd = await asyncio.to_thread(main.pop_command, user_id)
+        metrics.inc('commands_total', command=main.command_label(text, cmd))
+        msg = await asyncio.to_thread(main.build_command_message, user_id, text, cmd)
+        if msg is not None:
+            pass
+        elif cmd == OpenAIModelCmd.SET_TOKEN:
+            api_key = text
+            await asyncio.to_thread(main.setup_token, user_id, api_key)
+            msg = TextSendMessage(text=f'トークンを入力しました。\n{api_key}')
+        elif cmd == OpenAIModelCmd.SET_IMAGE_PROMPT:
+            prompt = text
+            logger.info(f"image {text}")
+            await asyncio.to_thread(main.memory.append, user_id, 'user', prompt)
+            is_successful, response, error_message = await get_image_async(await get_async_model(user_id), prompt)
+            if not is_successful:
+                raise Exception(error_message)
+            url = response['data'][0]['url']
+            msg = main.build_image_message(url)
+            await asyncio.to_thread(main.memory.append, user_id, 'assistant', url)
+        elif cmd == OpenAIModelCmd.SET_SUMMARIZE_URL:
+            msg = await summarize_url_async(user_id, text)
+        else:
+            msg = await answer_chat_async(user_id, text)
+    except Exception as e:
+        msg = await asyncio.to_thread(main.build_error_message, user_id, e)
+    await reply_message(event.reply_token, msg)
+
+
+async def handle_audio_message_async(event):
+    user_id = event.source.user_id
+    set_reply_deadline(event.timestamp)
+    metrics.inc('commands_total', command='audio')
+    transcriber = main.audio_transcriber
+    if not transcriber.reserve():
+        return await reply_message(event.reply_token, TextSendMessage(text=AUDIO_BUSY_MESSAGE))
+    try:
+        transcriber.check_duration(event.message.duration)
+        async with audio_slots:
+            with metrics.timer('stage_seconds', stage='audio_download'):
+                audio = await transcriber.read_async(await line_bot_api.get_message_content(event.message.id))
+            is_successful, response, error_message = await (await get_async_model(user_id)).audio_transcriptions(audio, 'whisper-1')
+        if not is_successful:
+            raise Exception(error_message)
+        logger.info(f"{user_id}: (voice) {response['text']}")
+        msg = await answer_chat_async(user_id, response['text'])
+    except AudioRejected as e:
+        msg = TextSendMessage(text=str(e))
+    except Exception as e:
+        msg = await asyncio.to_thread(main.build_error_message, user_id, e)
+    finally:
+        transcriber.release()
+    await reply_message(event.reply_token, msg)
+
+
+async def reply_message(reply_token, msg):
+    with metrics.timer('stage_seconds', stage='line_reply'):
+        await line_bot_api.reply_message(reply_token, msg)
+
+
+async def handle_event(event):
+    if isinstance(event, FollowEvent):
+        await asyncio.to_thread(main.memory.remove, event.source.user_id)
+        await reply_message(event.reply_token, main.build_follow_message())
+    elif isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        await handle_text_message_async(event)
+    elif isinstance(event, MessageEvent) and isinstance(event.message, AudioMessage):
+        await handle_audio_message_async(event)
+
+
+async def run_in_order(previous, event):
+    if previous is not None:
+        await asyncio.wait([previous])
+    try:
+        await handle_event(event)
+    except Exception as e:
+        logger.error(f'failed to handle event: {str(e)}')
+
+
+def dispatch(event):
+    # events of one user run one after another, different users concurrently
+    key = getattr(event.source, 'user_id', None) or ''
+    task = asyncio.create_task(run_in_order(user_tasks.get(key), event))
+    user_tasks[key] = task
+    task.add_done_callback(lambda t: user_tasks.pop(key, None) if user_tasks.get(key) is t else None)
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def respond(send, status, text, content_type=b'text/plain; charset=utf-8'):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type)],
+    })
+    await send({'type': 'http.response.body', 'body': text.encode('utf-8')})
+
+
+async def lifespan(receive, send):
+    global line_bot_api
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            main.setup()
+            line_bot_api = AsyncLineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'), AiohttpAsyncHttpClient(async_http_client.get_session()), endpoint=os.getenv('LINE_API_ENDPOINT') or AsyncLineBotApi.DEFAULT_API_ENDPOINT, data_endpoint=os.getenv('LINE_API_DATA_ENDPOINT') or AsyncLineBotApi.DEFAULT_API_DATA_ENDPOINT)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if user_tasks:
+                await asyncio.wait(list(user_tasks.values()))
+            await async_http_client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    if scope['method'] == 'GET' and scope['path'] == '/':
+        return await respond(send, 200, 'Hello World')
+    if scope['method'] == 'GET' and scope['path'] == '/metrics':
+        return await respond(send, 200, metrics.render(), b'text/plain; version=0.0.4; charset=utf-8')
+    if scope['method'] == 'POST' and scope['path'] == '/callback':
+        body = (await read_body(receive)).decode('utf-8')
+        signature = dict(scope['headers']).get(b'x-line-signature', b'').decode('utf-8')
+        try:
+            with metrics.timer('stage_seconds', stage='signature'):
+                events = main.handler.parser.parse(body, signature)
+        except InvalidSignatureError:
+            logger.info("Invalid signature. Please check your channel access token/channel secret.")
+            return await respond(send, 400, 'Bad Request')
+        for event in events:
+            key = event_key(event)
+            if key is not None and not await asyncio.to_thread(main.seen_events.add, key):
+                logger.info(f'skip redelivered webhook event {key}')
+                continue
+            dispatch(event)
+        return await respond(send, 200, 'OK')
+    return await respond(send, 404, 'Not Found')
+
+
+if __name__ == "__main__":
+    import uvicorn
+    host = '0.0.0.0'
+    port = int(os.getenv('PORT') or 8080)
+    logger.info(f"start listening: {host}:{port}")
+    uvicorn.run(app, host=host, port=port)
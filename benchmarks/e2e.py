@@ -0,0 +1,562 @@
+"""
+End-to-end load test of the webhook server against local stand-ins for
+OpenAI and LINE. One stub server answers the OpenAI endpoints used by
+src/models.py, the LINE reply and content APIs and a few article pages for
+/url; the bot runs against it in a subprocess and simulated users post
+signed webhook events to /callback. The latency of an event is the time
+from posting it until its reply reaches the stub LINE API.
+
+    python -m benchmarks.e2e --users 50 --duration 30 --mix chat=70,image=10,url=10,follow=10
+    python -m benchmarks.e2e --server asgi --openai-latency 1.5 --openai-errors 0.05
+    python -m benchmarks.e2e --record traffic.jsonl --save baseline.json
+    python -m benchmarks.e2e --replay traffic.jsonl --baseline baseline.json
+
+A recording has one {"at": seconds, "event": webhook event} object per
+line, so captured production events can be replayed as well. Replay keeps
+every user's events in order and resends them at their original offsets
+(scaled by --speed) with fresh reply tokens and event ids.
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ('chat', 'image', 'url', 'audio', 'follow')
+QUESTIONS = ['明日の天気は？', '何を聞けば良い？', 'おすすめの本を教えて', 'Pythonのリスト内包表記とは？', '東京から大阪まで何時間？']
+IMAGE_PROMPTS = [
+    'A scene of dinosaurs happily playing in a candy castle they built',
+    'An upside-down walking elephant with surprised animals around it',
+    'A giant squid sunbathing on a sandy beach at the bottom of the sea',
+]
+CHAT_REPLY = json.dumps({'reply': 'いい質問だね！それはね、場合によるよ。', 'reply sample1': 'もっと詳しく', 'reply sample2': '例を教えて'}, ensure_ascii=False)
+STUBS_PLACEHOLDER = '{stubs}'
+PAGE_PARAGRAPH = 'The quick brown fox jumps over the lazy dog while the benchmark measures how long the bot needs to summarize this page. '
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _send(self, status, body, content_type='application/json', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _openai(self, endpoint):
+        stubs = self.server.stubs
+        stubs.count(endpoint)
+        delay, status = stubs.openai_profile()
+        time.sleep(delay)
+        headers = {
+            'x-ratelimit-limit-requests': '10000',
+            'x-ratelimit-remaining-requests': '9999',
+            'x-ratelimit-reset-requests': '6ms',
+        }
+        if status == 429:
+            return self._send(429, {'error': {'message': 'Rate limit reached for requests', 'type': 'requests'}}, headers={**headers, 'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '1s'})
+        if status == 500:
+            return self._send(500, {'error': {'message': 'The server had an error while processing your request.', 'type': 'server_error'}}, headers=headers)
+        if endpoint == '/models':
+            return self._send(200, {'object': 'list', 'data': [{'id': 'gpt-3.5-turbo', 'object': 'model'}]}, headers=headers)
+        if endpoint == '/chat/completions':
+            return self._send(200, {
+                'object': 'chat.completion',
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': CHAT_REPLY}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 100, 'completion_tokens': 40, 'total_tokens': 140},
+            }, headers=headers)
+        if endpoint == '/images/generations':
+            return self._send(200, {'created': int(time.time()), 'data': [{'url': f'{stubs.url}/images/{uuid.uuid4().hex}.png'}]}, headers=headers)
+        if endpoint == '/audio/transcriptions':
+            return self._send(200, {'text': '明日の天気を教えてください。'}, headers=headers)
+        return self._send(404, {'error': {'message': 'not found'}})
+
+    def do_GET(self):
+        stubs = self.server.stubs
+        if self.path == '/v1/models':
+            return self._openai('/models')
+        match = re.match(r'^/pages/(\d+)$', self.path)
+        if match:
+            stubs.count('/pages')
+            time.sleep(stubs.page_latency)
+            paragraphs = ''.join(f'<p>Page {match.group(1)}, paragraph {i}. {PAGE_PARAGRAPH * 4}</p>' for i in range(stubs.page_paragraphs))
+            html = f'<html><head><title>Page {match.group(1)}</title></head><body><nav>menu</nav><article>{paragraphs}</article></body></html>'
+            return self._send(200, html.encode('utf-8'), 'text/html; charset=utf-8')
+        if re.match(r'^/v2/bot/message/[^/]+/content$', self.path):
+            stubs.count('/line/content')
+            return self._send(200, stubs.audio, 'audio/x-m4a')
+        return self._send(404, {'message': 'not found'})
+
+    def do_POST(self):
+        stubs = self.server.stubs
+        body = self._read_body()
+        if self.path.startswith('/v1/'):
+            return self._openai(self.path[len('/v1'):])
+        if self.path == '/v2/bot/message/reply':
+            time.sleep(stubs.line_latency)
+            payload = json.loads(body)
+            stubs.replied(payload['replyToken'], payload.get('messages', []))
+            return self._send(200, {})
+        return self._send(404, {'message': 'not found'})
+
+
+class Stubs:
+    """
+    OpenAI, LINE and article pages on one local port. Replies posted to the
+    LINE reply API are kept by reply token until the load generator
+    collects them with wait().
+    """
+    def __init__(self, port=0, openai_latency=0.5, openai_jitter=0.25, openai_errors=0.0, line_latency=0.02, page_latency=0.05, page_paragraphs=30):
+        self.openai_latency = openai_latency
+        self.openai_jitter = openai_jitter
+        self.openai_errors = openai_errors
+        self.line_latency = line_latency
+        self.page_latency = page_latency
+        self.page_paragraphs = page_paragraphs
+        self.audio = os.urandom(64 * 1024)
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+        self.server.daemon_threads = True
+        self.server.stubs = self
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.replies = {}
+        self.condition = threading.Condition()
+        self.requests = Counter()
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+    def openai_profile(self):
+        with self.lock:
+            delay = max(0.0, self.openai_latency + self.random.uniform(-self.openai_jitter, self.openai_jitter))
+            failed = self.random.random() < self.openai_errors
+            status = self.random.choice((429, 500)) if failed else 200
+        return delay, status
+
+    def replied(self, reply_token, messages):
+        with self.condition:
+            self.replies[reply_token] = (time.perf_counter(), messages)
+            self.condition.notify_all()
+
+    def wait(self, reply_token, timeout):
+        """
+        Returns (time of the reply, its messages), or None on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while reply_token not in self.replies:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            return self.replies.pop(reply_token)
+
+
+def sign(secret, body):
+    digest = hmac.new(secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def make_event(user_id, message=None):
+    """
+    A message event with the given text or message object, or a follow
+    event when `message` is None.
+    """
+    event = {
+        'type': 'follow' if message is None else 'message',
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'source': {'type': 'user', 'userId': user_id},
+        'webhookEventId': uuid.uuid4().hex.upper()[:26],
+        'deliveryContext': {'isRedelivery': False},
+        'replyToken': uuid.uuid4().hex,
+    }
+    if isinstance(message, str):
+        message = {'type': 'text', 'text': message}
+    if message is not None:
+        event['message'] = dict(message, id=str(random.randrange(10 ** 17, 10 ** 18)))
+    return event
+
+
+def refresh_event(event, stubs_url):
+    event = dict(event, timestamp=int(time.time() * 1000), webhookEventId=uuid.uuid4().hex.upper()[:26], replyToken=uuid.uuid4().hex)
+    if 'message' in event:
+        event['message'] = dict(event['message'], id=str(random.randrange(10 ** 17, 10 ** 18)))
+        if 'text' in event['message']:
+            event['message']['text'] = event['message']['text'].replace(STUBS_PLACEHOLDER, stubs_url)
+    return event
+
+
+def event_label(event):
+    if event['type'] != 'message':
+        return event['type']
+    if event['message']['type'] != 'text':
+        return event['message']['type']
+    text = event['message'].get('text', '')
+    if text.startswith('/'):
+        return text.split()[0]
+    return None
+
+
+def scenario_steps(scenario, rng, stubs, pages):
+    """
+    (label, message) pairs of one scenario; see make_event().
+    """
+    if scenario == 'chat':
+        return [('chat', rng.choice(QUESTIONS))]
+    if scenario == 'image':
+        return [('/image', '/image'), ('image', rng.choice(IMAGE_PROMPTS))]
+    if scenario == 'url':
+        return [('/url', '/url'), ('url', f'{stubs.url}/pages/{rng.randrange(pages)}')]
+    if scenario == 'audio':
+        return [('audio', {'type': 'audio', 'duration': rng.randrange(2000, 30000), 'contentProvider': {'type': 'line'}})]
+    return [('follow', None)]
+
+
+class LoadGenerator:
+
+    def __init__(self, target, secret, stubs, reply_timeout=60, recorder=None):
+        self.target = target
+        self.secret = secret
+        self.stubs = stubs
+        self.reply_timeout = reply_timeout
+        self.recorder = recorder
+        self.started = time.perf_counter()
+        self.samples = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def send(self, label, event):
+        body = json.dumps({'destination': 'Ubenchmark', 'events': [event]}, ensure_ascii=False)
+        sent = time.perf_counter()
+        if self.recorder is not None:
+            self.recorder.write(sent - self.started, event, self.stubs.url)
+        try:
+            r = self._session().post(f'{self.target}/callback', data=body.encode('utf-8'), headers={
+                'Content-Type': 'application/json',
+                'X-Line-Signature': sign(self.secret, body),
+            }, timeout=self.reply_timeout)
+            status = r.status_code
+        except requests.RequestException:
+            status = None
+        acked = time.perf_counter()
+        reply = self.stubs.wait(event['replyToken'], self.reply_timeout) if status == 200 else None
+        sample = {
+            'label': label,
+            'status': status,
+            'ack': acked - sent,
+            'latency': reply[0] - sent if reply else None,
+        }
+        with self.lock:
+            self.samples.append(sample)
+        return sample
+
+    def run_user(self, user_id, scenarios, weights, deadline, pages, seed):
+        rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            scenario = rng.choices(scenarios, weights)[0]
+            for label, message in scenario_steps(scenario, rng, self.stubs, pages):
+                sample = self.send(label, make_event(user_id, message))
+                if sample['latency'] is None:
+                    break
+
+    def replay_user(self, entries, speed):
+        previous = None
+        for at, event in entries:
+            delay = self.started + at / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            label = event_label(event) or {'/image': 'image', '/url': 'url'}.get(previous, 'chat')
+            self.send(label, refresh_event(event, self.stubs.url))
+            previous = label
+
+
+class Recorder:
+
+    def __init__(self, path):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def write(self, at, event, stubs_url):
+        # links to the stub pages are replayed against the stubs of that run
+        if 'text' in event.get('message', {}):
+            event = dict(event, message=dict(event['message'], text=event['message']['text'].replace(stubs_url, STUBS_PLACEHOLDER)))
+        line = json.dumps({'at': round(at, 4), 'event': event}, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+def load_recording(path):
+    entries = defaultdict(list)
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                event = record['event']
+                entries[event.get('source', {}).get('userId', '')].append((float(record['at']), event))
+    # a command and its answer must arrive in the order they were sent
+    for user_entries in entries.values():
+        user_entries.sort(key=lambda entry: entry[0])
+    return entries
+
+
+class BotProcess:
+    """
+    main.py (waitress) or asgi.py (uvicorn) in a scratch directory, so the
+    run starts without stored users, caches or job queues.
+    """
+    def __init__(self, server, port, env):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.log = open(os.path.join(self.workdir.name, 'bot.log'), 'wb')
+        script = os.path.join(ROOT, 'asgi.py' if server == 'asgi' else 'main.py')
+        self.process = subprocess.Popen([sys.executable, script], cwd=self.workdir.name, env={**os.environ, **env, 'PORT': str(port)}, stdout=self.log, stderr=subprocess.STDOUT)
+        self.url = f'http://127.0.0.1:{port}'
+
+    def wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                if requests.get(f'{self.url}/', timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                time.sleep(0.2)
+        self.stop()
+        with open(self.log.name, encoding='utf-8', errors='replace') as f:
+            sys.exit(f'bot did not start:\n{f.read()[-4000:]}')
+
+    def peak_rss(self):
+        return peak_rss(self.process.pid)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+        self.workdir.cleanup()
+
+
+def peak_rss(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(samples, elapsed, rss, stub_requests):
+    labels = {}
+    for label in sorted({sample['label'] for sample in samples}):
+        group = [sample for sample in samples if sample['label'] == label]
+        latencies = [sample['latency'] for sample in group if sample['latency'] is not None]
+        acks = [sample['ack'] for sample in group if sample['status'] is not None]
+        labels[label] = {
+            'count': len(group),
+            'errors': len(group) - len(latencies),
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'ack_p50': percentile(acks, 50),
+            'ack_p99': percentile(acks, 99),
+        }
+    latencies = [sample['latency'] for sample in samples if sample['latency'] is not None]
+    return {
+        'events': len(samples),
+        'errors': len(samples) - len(latencies),
+        'elapsed': elapsed,
+        'requests_per_second': len(samples) / elapsed if elapsed else 0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'peak_rss': rss,
+        'labels': labels,
+        'stub_requests': dict(stub_requests),
+    }
+
+
+def _ms(value):
+    return '-' if value is None else f'{value * 1000:.0f}'
+
+
+def _delta(value, base):
+    if value is None or not base:
+        return ''
+    return f' ({(value - base) / base:+.0%})'
+
+
+def report(result, baseline=None):
+    baseline = baseline or {}
+    base_labels = baseline.get('labels', {})
+    print(f"{'event':>10}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ack p50':>10}{'ack p99':>10}")
+    for label, stats in result['labels'].items():
+        print(f"{label:>10}{stats['count']:>8}{stats['errors']:>8}{_ms(stats['p50']):>10}{_ms(stats['p95']):>10}{_ms(stats['p99']):>10}{_ms(stats['ack_p50']):>10}{_ms(stats['ack_p99']):>10}")
+        base = base_labels.get(label)
+        if base:
+            print(f"{'baseline':>10}{base['count']:>8}{base['errors']:>8}{_ms(base['p50']):>10}{_ms(base['p95']):>10}{_ms(base['p99']):>10}{_ms(base['ack_p50']):>10}{_ms(base['ack_p99']):>10}")
+    print()
+    print(f"events: {result['events']} in {result['elapsed']:.1f}s, errors: {result['errors']}")
+    print(f"requests/s: {result['requests_per_second']:.1f}{_delta(result['requests_per_second'], baseline.get('requests_per_second'))}")
+    for p in ('p50', 'p95', 'p99'):
+        print(f"{p}: {_ms(result[p])} ms{_delta(result[p], baseline.get(p))}")
+    if result['peak_rss'] is not None:
+        print(f"peak RSS: {result['peak_rss'] / (1 << 20):.1f} MiB{_delta(result['peak_rss'], baseline.get('peak_rss'))}")
+    print('stub requests: ' + ', '.join(f'{endpoint}={count}' for endpoint, count in sorted(result['stub_requests'].items())))
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'unknown scenario {name}; choose from {", ".join(SCENARIOS)}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def parse_env(values):
+    env = {}
+    for value in values:
+        name, _, setting = value.partition('=')
+        env[name] = setting
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', choices=['main', 'asgi'], default='main')
+    parser.add_argument('--target', help='URL of a bot that is already running against the stubs; --stub-port then has to be fixed')
+    parser.add_argument('--pid', type=int, help='process id of --target, for its peak RSS')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--stub-port', type=int, default=0)
+    parser.add_argument('--env', action='append', default=[], help='extra KEY=VALUE for the bot, e.g. USE_JOB_QUEUE=1')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('chat=70,image=10,url=10,follow=10'))
+    parser.add_argument('--pages', type=int, default=20, help='distinct article pages behind /url')
+    parser.add_argument('--reply-timeout', type=float, default=60)
+    parser.add_argument('--openai-latency', type=float, default=0.5)
+    parser.add_argument('--openai-jitter', type=float, default=0.25)
+    parser.add_argument('--openai-errors', type=float, default=0.0, help='fraction of OpenAI calls answered with 429 or 500')
+    parser.add_argument('--line-latency', type=float, default=0.02)
+    parser.add_argument('--record', help='write the sent events to this file')
+    parser.add_argument('--replay', help='send the events of a recording instead of simulated users')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed-up')
+    parser.add_argument('--save', help='write the results as JSON')
+    parser.add_argument('--baseline', help='results of an earlier --save to compare with')
+    args = parser.parse_args()
+
+    stubs = Stubs(port=args.stub_port, openai_latency=args.openai_latency, openai_jitter=args.openai_jitter, openai_errors=args.openai_errors, line_latency=args.line_latency)
+    stubs.start()
+    secret = os.getenv('LINE_CHANNEL_SECRET') or 'benchmark-secret'
+    bot = None
+    if args.target:
+        target = args.target.rstrip('/')
+    else:
+        bot = BotProcess(args.server, args.port, {
+            'LINE_CHANNEL_SECRET': secret,
+            'LINE_CHANNEL_ACCESS_TOKEN': 'benchmark',
+            'LINE_API_ENDPOINT': stubs.url,
+            'LINE_API_DATA_ENDPOINT': stubs.url,
+            'OPENAI_API_BASE': f'{stubs.url}/v1',
+            'DEFAULT_OPEN_AI_TOKENS': 'sk-benchmark-1,sk-benchmark-2',
+            'OPENAI_MODEL_ENGINE': 'gpt-3.5-turbo',
+            'SYSTEM_MESSAGE': 'You are a helpful assistant.',
+            **parse_env(args.env),
+        })
+        bot.wait_ready()
+        target = bot.url
+    print(f'bot: {target}, stubs: {stubs.url}')
+
+    recorder = Recorder(args.record) if args.record else None
+    generator = LoadGenerator(target, secret, stubs, reply_timeout=args.reply_timeout, recorder=recorder)
+    try:
+        if args.replay:
+            recording = load_recording(args.replay)
+            with ThreadPoolExecutor(max_workers=max(1, len(recording))) as executor:
+                list(executor.map(lambda entries: generator.replay_user(entries, args.speed), recording.values()))
+        else:
+            scenarios = list(args.mix)
+            weights = [args.mix[name] for name in scenarios]
+            deadline = generator.started + args.duration
+            with ThreadPoolExecutor(max_workers=args.users) as executor:
+                list(executor.map(lambda i: generator.run_user(f'U{i:032x}', scenarios, weights, deadline, args.pages, i), range(args.users)))
+        elapsed = time.perf_counter() - generator.started
+        rss = bot.peak_rss() if bot else (peak_rss(args.pid) if args.pid else None)
+    finally:
+        if recorder is not None:
+            recorder.close()
+        if bot is not None:
+            bot.stop()
+        stubs.stop()
+
+    result = summarize(generator.samples, elapsed, rss, stubs.requests)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""
+Speed and quality of article extraction: the legacy html.parser
+<article> / div.content lookup against ArticleExtractor.
+
+Quality is the character-bigram F1 between the extracted text and the
+known article text. Without --corpus two synthetic sets of script and
+navigation heavy news-like pages are generated: "rules" pages use the
+markup of DOMAIN_RULES and <article>, so they only check that the rules
+apply; "unseen" pages use layouts none of the rules or selectors know,
+with comment threads, teasers and tag lists around the article, and
+measure the scoring fallback. A corpus directory holds pairs of
+NAME.html and NAME.txt (the expected article text), and an optional
+NAME.url with the page URL for the per-domain rules.
+
+    python -m benchmarks.extraction --pages 200
+    python -m benchmarks.extraction --corpus ./corpus
+"""
+import argparse
+import os
+import random
+import time
+from collections import Counter
+
+from bs4 import BeautifulSoup
+
+from src.service.extractor import ArticleExtractor
+
+SENTENCES = [
+    '政府は本日、新たな経済対策を発表しました。',
+    '専門家によると、物価の上昇は来年まで続く見通しです。',
+    '行政院今天宣布新的防疫措施，將從下週開始實施。',
+    '中央氣象署表示，颱風可能在週末接近台灣東部海面。',
+    '市場では円安が進み、輸出企業の株価が上昇しました。',
+    '立法院今日三讀通過修正草案，相關規定將於明年上路。',
+    '地元の住民は、復旧作業が早く進むことを望んでいます。',
+    '記者現場直擊，民眾排隊購買限量商品，人潮綿延數百公尺。',
+]
+NAV = ['ホーム', '国内', '国際', '經濟', '運動', '娛樂', 'ランキング', '天氣', 'ログイン', '訂閱']
+# reader comments and teasers: sentence-like text that is not the article
+COMMENTS = [
+    'この記事、とても参考になりました！',
+    '本當嗎？我覺得政府應該早點處理。',
+    '続報を待っています。',
+    '推！這篇寫得很清楚，謝謝記者。',
+    'ちょっと偏った見方だと思います。',
+    '樓上說得對，大家一起關注。',
+]
+TAGS = ['経済', '政治', '社會', '國際', '物価', '颱風', '株価', '防疫']
+
+# (url, template) pairs; {body} is the article paragraphs
+TEMPLATES = [
+    ('https://udn.com/news/story/1', '<div class="wrapper"><section class="article-content__editor">{body}</section></div>'),
+    ('https://news.yahoo.co.jp/articles/1', '<div class="article_body">{body}</div>'),
+    ('https://example.com/news/1', '<article>{body}</article>'),
+    ('https://blog.example.jp/entry/1', '<div id="main"><div class="entry-body">{body}</div></div>'),
+    ('https://example.com.tw/post/1', '<table><tr><td class="nav">選單</td><td><div class="story">{body}</div></td></tr></table>'),
+]
+
+
+def build_page(rng, template):
+    paragraphs = [''.join(rng.choice(SENTENCES) for _ in range(rng.randint(2, 5))) for _ in range(rng.randint(3, 10))]
+    body = ''.join(f'<p>{p}</p>' for p in paragraphs)
+    links = ''.join(f'<li><a href="/c/{i}">{rng.choice(NAV)}</a></li>' for i in range(30))
+    related = ''.join(f'<li><a href="/r/{i}">{rng.choice(SENTENCES)}</a></li>' for i in range(10))
+    scripts = ''.join(f'<script>var d{i}={{"k":"{rng.random()}"}};window.dataLayer=[];</script>' for i in range(20))
+    html = (
+        f'<html><head><title>news</title>{scripts}<style>.a{{color:red}}</style></head><body>'
+        f'<header><nav><ul>{links}</ul></nav></header>'
+        f'<div class="ad-banner">広告 スポンサー</div>'
+        f'{template.format(body=body)}'
+        f'<div class="related"><ul>{related}</ul></div>'
+        f'<footer>Copyright 2023 All rights reserved.</footer>{scripts}</body></html>'
+    )
+    return html, '\n'.join(paragraphs)
+
+
+def random_class(rng):
+    # generated class names of CSS-in-JS sites, or plain words no rule knows
+    if rng.random() < 0.5:
+        return f'{rng.choice(["css", "sc", "jsx", "x"])}-{rng.getrandbits(32):08x}'
+    return rng.choice(['l-col', 'wysiwyg', 'mw-parser-output', 'col-md-8', 'kiji', 'txt-area'])
+
+
+def body_class(rng):
+    # names of real text containers that only look like noise to a careless hint
+    if rng.random() < 0.3:
+        return rng.choice(['downloads-article__body', 'c-richtext', 'honbun'])
+    return random_class(rng)
+
+
+def build_unseen_page(rng):
+    paragraphs = [''.join(rng.choice(SENTENCES) for _ in range(rng.randint(2, 5))) for _ in range(rng.randint(3, 10))]
+    if rng.random() < 0.3:
+        # older CMS: one text block broken up with <br>
+        body = f'<div class="{body_class(rng)}">' + '<br><br>'.join(paragraphs) + '</div>'
+    else:
+        body = ''.join(f'<p class="{random_class(rng)}">{p}</p>' if rng.random() < 0.3 else f'<p>{p}</p>' for p in paragraphs)
+    body = f'<div class="{body_class(rng)}">{body}</div>'
+    for _ in range(rng.randint(0, 2)):
+        body = f'<div class="{random_class(rng)}">{body}</div>'
+    # the headline and tagline count as article text, like in annotated corpora
+    title = rng.choice(SENTENCES)
+    tagline = rng.choice(SENTENCES)
+    tags = '<ul class="tags">' + ''.join(f'<li><a href="/t/{i}">#{rng.choice(TAGS)}</a></li>' for i in range(rng.randint(3, 8))) + '</ul>'
+    teasers = ''.join(f'<div class="{random_class(rng)}"><a href="/n/{i}">{rng.choice(SENTENCES)}</a><span>{rng.choice(NAV)}</span></div>' for i in range(rng.randint(4, 10)))
+    comments = ''.join(f'<div class="{random_class(rng)}"><p>{rng.choice(COMMENTS)}</p><p>{rng.choice(COMMENTS)}</p></div>' for _ in range(rng.randint(0, 6)))
+    links = ''.join(f'<a href="/c/{i}">{rng.choice(NAV)}</a> | ' for i in range(30))
+    scripts = ''.join(f'<script>var d{i}={{"k":"{rng.random()}"}};</script>' for i in range(20))
+    main = f'<div class="{random_class(rng)}"><h1>{title}</h1><p class="tagline">{tagline}</p>{body}{tags}</div>'
+    side = f'<div class="{random_class(rng)}">{teasers}</div>'
+    html = (
+        f'<html><head><title>news</title>{scripts}</head><body>'
+        f'<div class="{random_class(rng)}">{links}</div>'
+        f'<div class="{random_class(rng)}">{main + side if rng.random() < 0.5 else side + main}</div>'
+        f'<div id="{random_class(rng)}">{comments}</div>'
+        f'<div>© 2023 {rng.choice(NAV)}</div>{scripts}</body></html>'
+    )
+    return html, '\n'.join([title, tagline] + paragraphs)
+
+
+def synthetic_corpus(pages, seed):
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(pages):
+        url, template = TEMPLATES[i % len(TEMPLATES)]
+        html, text = build_page(rng, template)
+        corpus.append((url, html, text))
+    return corpus
+
+
+def unseen_corpus(pages, seed):
+    rng = random.Random(seed)
+    hosts = ['example.net', 'news.example.org', 'udn.com', 'nhk.or.jp', 'blog.example.jp']
+    corpus = []
+    for i in range(pages):
+        html, text = build_unseen_page(rng)
+        # some pages are on ruled domains whose markup changed
+        corpus.append((f'https://{hosts[i % len(hosts)]}/{i}', html, text))
+    return corpus
+
+
+def load_corpus(directory):
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.html'):
+            continue
+        stem = os.path.join(directory, name[:-5])
+        with open(stem + '.html', encoding='utf-8', errors='replace') as f:
+            html = f.read()
+        with open(stem + '.txt', encoding='utf-8') as f:
+            text = f.read()
+        url = None
+        if os.path.exists(stem + '.url'):
+            with open(stem + '.url') as f:
+                url = f.read().strip()
+        corpus.append((url, html, text))
+    return corpus
+
+
+def legacy_extract(html, url=None):
+    main = BeautifulSoup(html, 'html.parser')
+    chunks = [article.text.strip() for article in main.find_all('article')]
+    if chunks == []:
+        chunks = [article.text.strip() for article in main.find_all('div', class_='content')]
+    return chunks
+
+
+def bigrams(text):
+    text = ''.join(text.split())
+    return Counter(text[i:i + 2] for i in range(len(text) - 1))
+
+
+def f1(extracted, expected):
+    got, want = bigrams(extracted), bigrams(expected)
+    overlap = sum((got & want).values())
+    if overlap == 0:
+        return 0.0
+    precision = overlap / sum(got.values())
+    recall = overlap / sum(want.values())
+    return 2 * precision * recall / (precision + recall)
+
+
+def run(corpus_name, name, extract, corpus):
+    scores = []
+    start = time.perf_counter()
+    for url, html, text in corpus:
+        scores.append(f1('\n'.join(extract(html, url)), text))
+    elapsed = time.perf_counter() - start
+    empty = sum(1 for score in scores if score == 0)
+    print(f'{corpus_name:>8}{name:>12}{len(corpus) / elapsed:>12.1f}{sum(scores) / len(scores):>10.3f}{empty:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', help='directory of NAME.html / NAME.txt pairs')
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.corpus:
+        corpora = [('corpus', load_corpus(args.corpus))]
+    else:
+        corpora = [('rules', synthetic_corpus(args.pages, args.seed)), ('unseen', unseen_corpus(args.pages, args.seed))]
+    print(f"{'pages':>8}{'extractor':>12}{'pages/s':>12}{'F1':>10}{'empty':>8}")
+    for corpus_name, corpus in corpora:
+        run(corpus_name, 'legacy', legacy_extract, corpus)
+        run(corpus_name, 'article', ArticleExtractor().extract, corpus)
+        run(corpus_name, 'article/std', ArticleExtractor(parser='html.parser').extract, corpus)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Compare one-connection-per-request calls with the pooled HTTPClient against a
+local stub of the OpenAI API.
+
+    python -m benchmarks.http_pool --concurrency 50 100 200 --requests 1000 --tls
+"""
+import argparse
+import json
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import urllib3
+
+from src.http_client import HTTPClient
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        body = json.dumps({
+            'choices': [{'message': {'role': 'assistant', 'content': 'ok'}}]
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 512
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connections = 0
+
+    def get_request(self):
+        request, address = super().get_request()
+        self.connections += 1
+        return request, address
+
+
+def make_certificate(directory):
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+        '-subj', '/CN=localhost', '-keyout', key, '-out', cert
+    ], check=True, capture_output=True)
+    return cert, key
+
+
+def start_server(tls):
+    server = CountingServer(('127.0.0.1', 0), StubHandler)
+    scheme = 'http'
+    if tls:
+        cert, key = make_certificate(tempfile.mkdtemp())
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = 'https'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'{scheme}://127.0.0.1:{server.server_address[1]}/v1/chat/completions'
+
+
+def run(call, total, concurrency):
+    latencies = []
+
+    def task(_):
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(task, range(total)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[50, 100, 200])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--tls', action='store_true')
+    args = parser.parse_args()
+    urllib3.disable_warnings()
+
+    body = {'model': 'stub', 'messages': [{'role': 'user', 'content': 'hello'}]}
+    print(f"{'mode':<10}{'conc':>6}{'conns':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for concurrency in args.concurrency:
+        server, url = start_server(args.tls)
+        client = HTTPClient(pool_maxsize=concurrency)
+        modes = {
+            'oneshot': lambda: requests.post(url, json=body, verify=False, timeout=30).json(),
+            'pooled': lambda: client.request('POST', url, json=body, verify=False).json(),
+        }
+        for name, call in modes.items():
+            server.connections = 0
+            elapsed, p50, p99 = run(call, args.requests, concurrency)
+            print(f'{name:<10}{concurrency:>6}{server.connections:>8}{args.requests / elapsed:>10.0f}{p50 * 1000:>10.1f}{p99 * 1000:>10.1f}')
+        client.close()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
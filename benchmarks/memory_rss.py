@@ -0,0 +1,67 @@
+"""
+Resident memory of the conversation store with many simulated users.
+Each run happens in a fresh subprocess so the numbers do not overlap.
+
+    python -m benchmarks.memory_rss --users 100000 1000000
+"""
+import argparse
+import json
+import subprocess
+import sys
+from collections import defaultdict
+
+
+def rss_bytes():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    import resource
+    return pages * resource.getpagesize()
+
+
+def simulate(kind, users, turns):
+    before = rss_bytes()
+    if kind == 'dict':
+        store = defaultdict(list)
+        for i in range(users):
+            user_id = f'U{i:032x}'
+            store[user_id].append({'role': 'system', 'content': 'You are a helpful assistant.'})
+            for turn in range(turns):
+                store[user_id].append({'role': 'user', 'content': f'question {turn} from {i}'})
+                store[user_id].append({'role': 'assistant', 'content': f'answer {turn} to {i}'})
+    else:
+        from src.memory import Memory
+        store = Memory('You are a helpful assistant.', memory_message_count=2, max_users=users, max_bytes=1 << 40)
+        for i in range(users):
+            user_id = f'U{i:032x}'
+            for turn in range(turns):
+                store.append(user_id, 'user', f'question {turn} from {i}')
+                store.append(user_id, 'assistant', f'answer {turn} to {i}')
+    return rss_bytes() - before
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--turns', type=int, default=2)
+    parser.add_argument('--child', nargs=2)
+    args = parser.parse_args()
+
+    if args.child:
+        kind, users = args.child
+        print(json.dumps(simulate(kind, int(users), args.turns)))
+        return
+
+    print(f"{'users':>10}{'dict MiB':>12}{'Memory MiB':>12}{'B/user':>10}")
+    for users in args.users:
+        results = {}
+        for kind in ('dict', 'memory'):
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.memory_rss', '--turns', str(args.turns), '--child', kind, str(users)],
+                check=True, capture_output=True, text=True
+            ).stdout
+            results[kind] = json.loads(output.strip().splitlines()[-1])
+        print(f"{users:>10}{results['dict'] / 2**20:>12.1f}{results['memory'] / 2**20:>12.1f}{results['memory'] / users:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
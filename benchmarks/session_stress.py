@@ -0,0 +1,103 @@
+"""
+Stress test of the in-process session state: many simulated users talk
+at once on a thread pool while other threads read, reset and re-prompt
+them. Afterwards every user's history must be exactly its own last turns
+in order, and the byte accounting of every shard must add up.
+
+    python -m benchmarks.session_stress --users 5000 --turns 20 --threads 200
+"""
+import argparse
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.cache import ShardedLRUCache
+from src.memory import Memory
+
+
+def expected_history(user_id, turns, keep):
+    messages = []
+    for turn in range(turns):
+        messages.append({'role': 'user', 'content': f'{user_id} question {turn}'})
+        messages.append({'role': 'assistant', 'content': f'{user_id} answer {turn}'})
+    return messages[-keep:]
+
+
+def talk(memory, commands, models, user_id, turns):
+    for turn in range(turns):
+        commands.set(user_id, f'{user_id}:{turn}')
+        memory.append(user_id, 'user', f'{user_id} question {turn}')
+        models.set(user_id, user_id)
+        if commands.pop(user_id) != f'{user_id}:{turn}':
+            return f'{user_id}: lost command of turn {turn}'
+        memory.append(user_id, 'assistant', f'{user_id} answer {turn}')
+        history = memory.get(user_id)
+        if any(message['content'].split(' ')[0] != user_id for message in history[1:]):
+            return f'{user_id}: history interleaved with another user'
+        if models.get(user_id) != user_id:
+            return f'{user_id}: model of another user'
+    return None
+
+
+def disturb(memory, user_ids, stop):
+    # readers and resets on users that are not being checked
+    rng = random.Random(0)
+    while not stop.is_set():
+        user_id = rng.choice(user_ids)
+        memory.get(user_id)
+        memory.remove(user_id)
+        memory.change_system_message(user_id, 'You are a terse assistant.')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=200)
+    parser.add_argument('--history', type=int, default=5, help='memory_message_count')
+    parser.add_argument('--shards', type=int, default=16)
+    args = parser.parse_args()
+
+    # switch threads often to shake out races
+    sys.setswitchinterval(1e-5)
+    memory = Memory('You are a helpful assistant.', memory_message_count=args.history, max_users=args.users * 2, max_bytes=1 << 40, shards=args.shards)
+    commands = ShardedLRUCache(maxsize=args.users * 2)
+    models = ShardedLRUCache(maxsize=args.users * 2)
+    user_ids = [f'U{i:032x}' for i in range(args.users)]
+    bystanders = [f'B{i:032x}' for i in range(100)]
+    for user_id in bystanders:
+        memory.append(user_id, 'user', 'hello')
+
+    stop = threading.Event()
+    disturbers = [threading.Thread(target=disturb, args=(memory, bystanders, stop)) for _ in range(4)]
+    for thread in disturbers:
+        thread.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        errors = [error for error in executor.map(lambda user_id: talk(memory, commands, models, user_id, args.turns), user_ids) if error]
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for thread in disturbers:
+        thread.join()
+
+    keep = args.history * 2
+    for user_id in user_ids:
+        history = memory.get(user_id)[1:]
+        if history != expected_history(user_id, args.turns, keep):
+            errors.append(f'{user_id}: history lost or out of order')
+    for shard in memory.shards:
+        if shard.total_bytes != sum(conversation.size for conversation in shard.storage.values()):
+            errors.append('shard byte accounting is off')
+
+    operations = args.users * args.turns * 7
+    print(f'{args.users} users x {args.turns} turns on {args.threads} threads: {elapsed:.2f}s, {operations / elapsed:,.0f} ops/s')
+    for error in errors[:20]:
+        print(error)
+    print('FAILED' if errors else 'OK')
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Cost of FileStorage.save with a growing number of stored users, compared
+with rewriting the whole db.json on every save.
+
+    python -m benchmarks.storage_save --users 1000 10000 100000 1000000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from src.storage import FileStorage
+
+
+def rewrite_save(file_name, history, data):
+    history.update(data)
+    with open(file_name, 'w', newline='') as f:
+        json.dump(history, f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--saves', type=int, default=1000)
+    parser.add_argument('--rewrite-limit', type=int, default=100000, help='skip the rewrite baseline above this many users')
+    args = parser.parse_args()
+
+    print(f"{'users':>10}{'journal us/save':>18}{'rewrite us/save':>18}")
+    for users in args.users:
+        directory = tempfile.mkdtemp()
+        file_name = os.path.join(directory, 'db.json')
+        history = {f'U{i:032x}': f'sk-{i:048x}' for i in range(users)}
+        with open(file_name, 'w') as f:
+            json.dump(history, f)
+
+        storage = FileStorage(file_name, compact_bytes=1 << 40)
+        storage.load()
+        start = time.perf_counter()
+        for i in range(args.saves):
+            storage.save({f'N{i:032x}': f'sk-{i:048x}'})
+        journal = (time.perf_counter() - start) / args.saves
+        storage.close()
+
+        rewrite = None
+        if users <= args.rewrite_limit:
+            saves = max(1, min(args.saves, 10_000_000 // users))
+            start = time.perf_counter()
+            for i in range(saves):
+                rewrite_save(file_name, history, {f'N{i:032x}': f'sk-{i:048x}'})
+            rewrite = (time.perf_counter() - start) / saves
+        rewrite_text = f'{rewrite * 1e6:>18.1f}' if rewrite is not None else f"{'skipped':>18}"
+        print(f'{users:>10}{journal * 1e6:>18.1f}{rewrite_text}')
+
+
+if __name__ == '__main__':
+    main()
@@ -16,65 +16,213 @@ from linebot.models import (
 )
 import os
 import uuid
-
-from src.models import OpenAIModel, OpenAIModelCmd
-from src.memory import Memory
-from src.logger import logger
+import base64
+import hashlib
+import hmac
+
+from src.models import OpenAIModel, OpenAIModelCmd, TokenValidationCache
+from src.memory import Memory, PersistentMemory
+from src.conversation_store import SQLiteConversationBackend, MongoConversationBackend, CommandStore
+from src.logger import logger, log_payload, queue_handler
 from src.storage import Storage, FileStorage, MongoStorage
 from src.utils import get_role_and_content
 from src.service.youtube import Youtube, YoutubeTranscriptReader
 from src.service.website import Website, WebsiteReader
+from src.service.audio import AudioTranscriber, AudioRejected, AUDIO_BUSY_MESSAGE
 from src.mongodb import mongodb
+from src.job_queue import SQLiteJobQueue, JobWorkerPool, JobAborted
+from src.cache import LRUCache, ShardedLRUCache, SummaryCache, SQLiteCacheStore, MongoCacheStore
+from src.single_flight import SingleFlight
+from src.metrics import metrics
+from src.dedup import SeenSet, SQLiteSeenStore, MongoSeenStore, event_key
+from src.rate_limiter import Priority, set_reply_deadline
+from src.key_pool import KeyPool, PooledOpenAIModel
+from src.image_pool import ImagePool
 
 load_dotenv('.env')
 
 app = Flask(__name__)
-line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
-handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
-default_open_ai_token = os.getenv('DEFAULT_OPEN_AI_TOKEN')
+line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'), endpoint=os.getenv('LINE_API_ENDPOINT') or LineBotApi.DEFAULT_API_ENDPOINT, data_endpoint=os.getenv('LINE_API_DATA_ENDPOINT') or LineBotApi.DEFAULT_API_DATA_ENDPOINT)
+channel_secret = os.getenv('LINE_CHANNEL_SECRET')
+handler = WebhookHandler(channel_secret)
+default_open_ai_tokens = [api_key.strip() for api_key in (os.getenv('DEFAULT_OPEN_AI_TOKENS') or os.getenv('DEFAULT_OPEN_AI_TOKEN') or '').split(',') if api_key.strip()]
+key_pool = KeyPool(default_open_ai_tokens) if default_open_ai_tokens else None
+default_model = PooledOpenAIModel(key_pool) if key_pool else None
 storage = None
-youtube = Youtube(step=4)
+youtube = Youtube()
 website = Website()
+job_pool = None
+audio_transcriber = AudioTranscriber()
+seen_events = SeenSet()
+summary_flight = SingleFlight()
+# a failed generation may be down to the leader's own key
+image_flight = SingleFlight(shareable=lambda result: result[0])
+coalesce_image_prompts = bool(os.getenv('COALESCE_IMAGE_PROMPTS'))
+summary_cache = SummaryCache(maxsize=int(os.getenv('SUMMARY_CACHE_SIZE') or 256), ttl=int(os.getenv('SUMMARY_CACHE_TTL') or 86400))
+
+IMAGE_PROMPT_SAMPLES = {
+    "お菓子の城を作った恐竜たちが楽しそうに遊んでいるシーン":"A scene of dinosaurs happily playing in a candy castle they built",
+    "逆さまに歩く象とその周りに驚く動物たちの姿":"An upside-down walking elephant with surprised animals around it",
+    "飛行船に乗ったネコ科の生き物たちが、大量の毛玉を空中にばらまいているシーン":"A scene of feline creatures on a hot air balloon, scattering a massive amount of furballs into the air",
+    "ウサギがチェロを演奏している様子を見て、羊やヒツジたちが驚きを隠せないシーン":"A scene where sheep and lambs can't hide their surprise as they watch a rabbit playing the cello",
+    "海底で巨大なイカが、砂浜に座って日光浴をしている様子":"A giant squid sunbathing on a sandy beach at the bottom of the sea"
+}
+# the quick replies of /image send these prompts, so they are kept ready
+image_pool = ImagePool(IMAGE_PROMPT_SAMPLES.values())
+
+HISTORY_SUMMARY_PROMPT = "以下はユーザーとアシスタントの会話の一部です。これまでの要約と合わせて、重要な情報を落とさずに300字以内で要約してください。"
+
+
+def summarize_history(user_id: str, summary: str, messages):
+    lines = [f"{message['role']}: {message['content']}" for message in messages]
+    if summary:
+        lines.insert(0, f'これまでの要約: {summary}')
+    is_successful, response, error_message = get_model(user_id).chat_completions([{
+        'role': 'system', 'content': HISTORY_SUMMARY_PROMPT
+    }, {
+        'role': 'user', 'content': '\n'.join(lines)
+    }], os.getenv('OPENAI_MODEL_ENGINE'), Priority.BULK)
+    if not is_successful:
+        raise Exception(error_message)
+    _, content = get_role_and_content(response)
+    return content
+
 
+memory_options = dict(system_message=os.getenv('SYSTEM_MESSAGE'), memory_message_count=int(os.getenv('MEMORY_MESSAGE_COUNT') or 10), model_engine=os.getenv('OPENAI_MODEL_ENGINE'), summarizer=summarize_history)
+memory = Memory(**memory_options)
+model_management = ShardedLRUCache(maxsize=int(os.getenv('MODEL_CACHE_SIZE') or 10000))
+shared_models = LRUCache(maxsize=int(os.getenv('MODEL_CACHE_SIZE') or 10000))
+token_validation_cache = TokenValidationCache()
+# pending commands expire so an abandoned /url or /image prompt does not linger
+command_ttl = int(os.getenv('COMMAND_TTL') or 600)
+user_commands = ShardedLRUCache(maxsize=int(os.getenv('MODEL_CACHE_SIZE') or 10000), ttl=command_ttl)
 
-memory = Memory(system_message=os.getenv('SYSTEM_MESSAGE'), memory_message_count=2)
-model_management = {}
-api_keys = {}
+def get_shared_model(api_key: str) -> OpenAIModel:
+    model = shared_models.get(api_key)
+    if model is None:
+        model = OpenAIModel(api_key=api_key)
+        shared_models.set(api_key, model)
+    return model
+
+def set_command(user_id: str, cmd: OpenAIModelCmd):
+    user_commands.set(user_id, cmd.name)
+
+def pop_command(user_id: str) -> OpenAIModelCmd:
+    return OpenAIModelCmd[user_commands.pop(user_id, OpenAIModelCmd.NONE.name)]
 
 def setup_token(user_id: str, api_key:str):
-    model = OpenAIModel(api_key=api_key)
-    is_successful, _, _ = model.check_token_valid()
-    if not is_successful:
+    model = get_shared_model(api_key)
+    if not token_validation_cache.is_valid(model):
         raise ValueError('Invalid API token')
-    model_management[user_id] = model
-    storage.save({
-        user_id: api_key
-    })
+    model_management.set(user_id, model)
+    with metrics.timer('stage_seconds', stage='storage'):
+        storage.save({
+            user_id: api_key
+        })
 
 def get_model(user_id: str) -> OpenAIModel:
-    if user_id in model_management:
-        return model_management[user_id]
-    else:
-        if not default_open_ai_token:
-            logger.error("invalid system token")
-            raise KeyError()
-        setup_token(user_id, default_open_ai_token)
-        return model_management[user_id]
+    model = model_management.get(user_id)
+    if model is not None:
+        return model
+    with metrics.timer('stage_seconds', stage='storage'):
+        api_key = storage.get(user_id)
+    # users saved with a default key before the pool existed use the pool
+    if api_key and not (key_pool and api_key in key_pool):
+        model = get_shared_model(api_key)
+        model_management.set(user_id, model)
+        return model
+    if default_model is None:
+        logger.error("invalid system token")
+        raise KeyError()
+    model_management.set(user_id, default_model)
+    return default_model
+
+def sign_body(body: str) -> str:
+    digest = hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def parse_new_events(body: str, signature: str):
+    """
+    Verifies the signature and drops events LINE already delivered.
+    Returns the payload and the new events.
+    """
+    with metrics.timer('stage_seconds', stage='signature'):
+        if not handler.parser.signature_validator.validate(body, signature):
+            raise InvalidSignatureError('Invalid signature. signature=' + signature)
+    payload = json.loads(body)
+    events = []
+    for event in payload.get('events', []):
+        key = event_key(event)
+        if key is None or seen_events.add(key):
+            events.append(event)
+        else:
+            logger.info(f'skip redelivered webhook event {key}')
+    return payload, events
+
+
+def enqueue_events(body: str, signature: str):
+    payload, events = parse_new_events(body, signature)
+    jobs = []
+    for event in events:
+        source = event.get('source', {})
+        key = source.get('userId') or source.get('groupId') or source.get('roomId') or ''
+        jobs.append((key, json.dumps({'destination': payload.get('destination'), 'events': [event]})))
+    job_pool.submit(jobs)
+
+
+def handle_job(body: str):
+    # bad payloads fail here, before any handler has changed anything
+    signature = sign_body(body)
+    handler.parser.parse(body, signature)
+    metrics.inc('inflight_events')
+    try:
+        handler.handle(body, signature)
+    except Exception as e:
+        # commands, memory and OpenAI calls must not be repeated
+        raise JobAborted(str(e)) from e
+    finally:
+        metrics.dec('inflight_events')
+
+
+def handle_events(body: str, signature: str):
+    payload, events = parse_new_events(body, signature)
+    if not events:
+        return
+    try:
+        handle_job(json.dumps({'destination': payload.get('destination'), 'events': events}))
+    except JobAborted:
+        # the handlers ran; a redelivery would repeat what they did
+        raise
+    except Exception:
+        # let LINE's redelivery of a failed event through
+        for event in events:
+            key = event_key(event)
+            if key is not None:
+                seen_events.discard(key)
+        raise
+
 
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    log_payload('request_body', body)
+    metrics.inc('inflight_requests')
     try:
-        handler.handle(body, signature)
+        with metrics.timer('request_seconds', route='callback'):
+            if job_pool:
+                enqueue_events(body, signature)
+            else:
+                handle_events(body, signature)
     except InvalidSignatureError:
-        print("Invalid signature. Please check your channel access token/channel secret.")
+        logger.info("Invalid signature. Please check your channel access token/channel secret.")
         abort(400)
+    finally:
+        metrics.dec('inflight_requests')
     return 'OK'
 
-@handler.add(FollowEvent)
-def follow_event(event):
+def build_follow_message():
     text = '''
     AIゆるチャットへようこそ✨
     このままAIと会話してください。
@@ -82,296 +230,385 @@ def follow_event(event):
     文字を入力するのが面倒なら、タップすれば簡単に返信できます。
     '''[1:-1]
     text = textwrap.dedent(text)
-    user_id = event.source.user_id
     quick_reply_menu = {"ヘルプ":"ヘルプ", "何を聞けば良い？":"何を聞けば良い？", "明日の天気は？":"明日の天気は？"}
     items = [QuickReplyButton(action=MessageAction(label=v, text=quick_reply_menu[v])) for k,v in enumerate(quick_reply_menu)]
-    msg = TextSendMessage(text=str(text), quick_reply=QuickReply(items=items))
-    memory.remove(user_id)
-    line_bot_api.reply_message(event.reply_token, msg)
+    return TextSendMessage(text=str(text), quick_reply=QuickReply(items=items))
 
 
-@handler.add(MessageEvent, message=TextMessage)
-def handle_text_message(event):
+def reply_message(reply_token: str, msg):
+    with metrics.timer('stage_seconds', stage='line_reply'):
+        line_bot_api.reply_message(reply_token, msg)
+
+
+@handler.add(FollowEvent)
+def follow_event(event):
     user_id = event.source.user_id
-    text = str(event.message.text.strip())
-    logger.info(f'{user_id}: {text}')
+    msg = build_follow_message()
+    memory.remove(user_id)
+    reply_message(event.reply_token, msg)
 
-    def get_reply_and_reply_samples(string_with_json: str):
 
-        # 正規表現パターン
-        pattern = r'{[\s\S]*}'
+def get_reply_and_reply_samples(string_with_json: str):
 
-        # 正規表現にマッチする部分を抽出
-        match = re.search(pattern, string_with_json)
+    # 正規表現パターン
+    pattern = r'{[\s\S]*}'
 
-        if match:
-            json_data = match.group()
-        else:
-            return string_with_json, []
-        # JSONデータをPythonオブジェクトに変換
-        parsed_json = json.loads(json_data)
+    # 正規表現にマッチする部分を抽出
+    match = re.search(pattern, string_with_json)
+
+    if match:
+        json_data = match.group()
+    else:
+        return string_with_json, []
+    # JSONデータをPythonオブジェクトに変換
+    parsed_json = json.loads(json_data)
+
+    # replyとreply_samplesの取得
+    reply = parsed_json['reply']
+    reply_samples = [parsed_json[key] for key in parsed_json.keys() if key.startswith('reply sample')]
+    reply_samples = list(filter(lambda x: len(x)>0, reply_samples))
+    return reply, reply_samples
+
+
+def wrap_msg(msg):
+    text=("""
+    # 命令書：
+    あなたは、優秀な女子高生のアシスタントで質問者からの質問に的確に回答します。
+    以下の制約条件をもとに、アシスタントとしての回答および、それに対する質問者からのさらなる質問の例を出力してください。
+
+    # 制約条件：
+    ・回答の文字数は500字以内
+    ・さらなる質問の例は最大4つ。それぞれ20字以内
+    ・出力は女子高生が話すような日本語の砕けた言葉で。
+    ・重要なキーワードを取り残さない
+    ・情報が不足する場合は、回答せず、さらなる質問を求めてください。
+
+    # 入力文：
+    """ + msg +
+    """
+    # 出力文：
+    {"reply":"...","reply sample1":"...", ...}
+    """)[1:-1]
+    text = textwrap.dedent(text)
+    return text
+
+
+def build_chat_prompt(user_id: str, text: str):
+    memory.append(user_id, 'user', text)
+    ret = memory.get(user_id)
+    comp = copy.deepcopy(ret)
+    last = comp.pop()
+    last["content"]=wrap_msg(last["content"])
+    comp.append(last)
+    # logger.info("送信ログ:\n" + json.dumps(comp))
+    return comp
+
+
+COMMAND_PREFIXES = ['/cancel', '/token', '/reset_system_message', '/help', '/system', '/clear', '/image', '/url']
+
+
+def command_label(text: str, cmd: OpenAIModelCmd) -> str:
+    if cmd != OpenAIModelCmd.NONE:
+        return cmd.name.lower()
+    if text in ['ヘルプ', '使い方']:
+        return 'help'
+    for prefix in COMMAND_PREFIXES:
+        if text.startswith(prefix):
+            return prefix
+    return 'chat'
+
+
+def build_command_message(user_id: str, text: str, cmd: OpenAIModelCmd):
+    """
+    Answers the commands that need no network call. Returns None when the
+    message has to go to OpenAI (pending token/image/url commands or chat).
+    """
+    if text in ['/cancel']:
+        return TextSendMessage(text=f'キャンセルしました')
+    if cmd == OpenAIModelCmd.SET_SYSTEM_PROMPT:
+        system_prompt = text
+        memory.change_system_message(user_id, system_message=system_prompt)
+        return TextSendMessage(text=f'システムメッセージを変更しました:\n{system_prompt}')
+    if cmd != OpenAIModelCmd.NONE:
+        return None
+    if text.startswith('/token'):
+        set_command(user_id, OpenAIModelCmd.SET_TOKEN)
+        # api_key = text[3:].strip()
+        # setup_token(user_id, api_key)
+
+        quick_reply_menu = {"キャンセル":"/cancel"}
+        items = [QuickReplyButton(action=MessageAction(label=v, text=quick_reply_menu[v])) for k,v in enumerate(quick_reply_menu)]
+        msg = TextSendMessage(text='トークンを入力してください。', quick_reply=QuickReply(items=items))
+    elif text.startswith('/reset_system_message'):
+        system_prompt = text
+        memory.change_system_message(user_id, system_message=os.getenv('SYSTEM_MESSAGE'))
+        msg = TextSendMessage(text=f'システムメッセージを初期状態に戻しました。')
+    elif text in ['ヘルプ', '使い方']:
+        quick_reply_menu = {"何を聞けば良い？":"何を聞けば良い？", "明日の天気は？":"明日の天気は？", "画像生成をしたい":"/image", "URLを要約": "/url", "システムメッセージ":"/system", "システムメッセージをリセット":"/reset_system_message", "履歴をクリア":"/clear", "トークンを入力":"/token"}
+
+        items = [QuickReplyButton(action=MessageAction(label=v, text=quick_reply_menu[v])) for k,v in enumerate(quick_reply_menu)]
+        
+        msg = TextSendMessage(text="チャットの他、画像の生成や、指定したURLの要約などができます✨",
+                                quick_reply=QuickReply(items=items))
+    elif text.startswith('/help'):
+        text = '''
+        このままチャットすればChatGPTをお手軽に使えます✨
+        以下のコマンドも使えます。
+
+        /image 画像の生成をします。
+        /url 指定したURLを要約します。
+        /system システムメッセージを入力します。例：あなたは有能な弁護士です。
+        /reset_system_message システムメッセージを初期状態に戻します。
+        /clear これまでのチャット履歴と要約を覚えてますが、その履歴をクリアします。
+        /token カスタムのAPI Tokenを入力します。https://platform.openai.com/ に登録すれば取得できます。
+        '''[1:-1]
+        msg = TextSendMessage(text=textwrap.dedent(text))
+
+    elif text.startswith('/system'):
+        set_command(user_id, OpenAIModelCmd.SET_SYSTEM_PROMPT)
+        msg = TextSendMessage(text='システムメッセージを入力してください。\n\n例1 あなたは有能な弁護士です。\n例2 あなたは優秀な小学生の家庭教師です。')
+        # memory.change_system_message(user_id, text[5:].strip())
+        # msg = TextSendMessage(text='システムプロンプトを入力しました。')
+
+    elif text.startswith('/clear'):
+        memory.remove(user_id)
+        msg = TextSendMessage(text='履歴をクリアしました。')
+
+    elif text.startswith('/image'):
+        set_command(user_id, OpenAIModelCmd.SET_IMAGE_PROMPT)
+        quick_reply_menu = IMAGE_PROMPT_SAMPLES
+        items = [QuickReplyButton(action=MessageAction(label=((s[:15]+"..") if len(s)>15 else s), text=(quick_reply_menu.get(s) or s))) for k,s in enumerate(quick_reply_menu)]
+        msg = TextSendMessage(text='どんな画像を生成しますか？できるだけ英語で入力してください。', quick_reply=QuickReply(items=items))
+
+        # prompt = text[3:].strip()
+        # memory.append(user_id, 'user', prompt)
+        # is_successful, response, error_message = get_model(user_id).image_generations(prompt)
+        # if not is_successful:
+        #     raise Exception(error_message)
+        # url = response['data'][0]['url']
+        # msg = ImageSendMessage(
+        #     original_content_url=url,
+        #     preview_image_url=url
+        # )
+        # memory.append(user_id, 'assistant', url)
+    elif text.startswith('/url'):
+        set_command(user_id, OpenAIModelCmd.SET_SUMMARIZE_URL)
+        msg = TextSendMessage(text='要約したいURLを入力してね。')
+    else:
+        msg = None
+    return msg
+
+
+def build_image_message(url: str):
+    quick_reply_menu = {
+        "続けて画像を生成":"/image",
+        "ヘルプ":"ヘルプ",
+    }
+    items = [QuickReplyButton(action=MessageAction(label=((s[:15]+"..") if len(s)>15 else s), text=(quick_reply_menu.get(s) or s))) for k,s in enumerate(quick_reply_menu)]
+
+    return ImageSendMessage(
+        original_content_url=url,
+        preview_image_url=url,
+        quick_reply=QuickReply(items=items)
+    )
+
+
+def build_summary_message(text: str):
+    quick_reply_menu = {
+        "続けてURLを入力":"/url",
+        "ヘルプ":"ヘルプ",
+    }
+    items = [QuickReplyButton(action=MessageAction(label=((s[:15]+"..") if len(s)>15 else s), text=(quick_reply_menu.get(s) or s))) for k,s in enumerate(quick_reply_menu)]
+    return TextSendMessage(text=text, quick_reply=QuickReply(items=items))
+
+
+def build_chat_message(reply: str, samples):
+    quick_reply_menu = {
+        "ヘルプ":"ヘルプ"
+    }
+    items = [QuickReplyButton(action=MessageAction(label=((s[:15]+"..") if len(s)>15 else s), text=(quick_reply_menu.get(s) or s))) for k,s in enumerate(quick_reply_menu)]
+    items += [QuickReplyButton(action=MessageAction(label=((s[:15]+"..") if len(s)>15 else s), text=s)) for s in samples]
+    if len(items)>0:
+        return TextSendMessage(text=reply, quick_reply=QuickReply(items=items))
+    return TextSendMessage(text=reply)
+
+
+def build_error_message(user_id: str, e: Exception):
+    if isinstance(e, (ValueError, KeyError)):
+        logger.info(f'例外が発生しました。{str(e)}')
+        return TextSendMessage(text=f'例外が発生しました。{str(e)}')
+    memory.remove(user_id)
+    if str(e).startswith('Incorrect API key provided'):
+        return TextSendMessage(text='OpenAI API Token が正しくありません。/token sk-xxxxx の形式で登録してください。')
+    elif str(e).startswith('That model is currently overloaded with other requests.'):
+        return TextSendMessage(text='同時使用人数を超えました。しばらく待ってからお試しください。')
+    return TextSendMessage(text=str(e))
 
-        # replyとreply_samplesの取得
-        reply = parsed_json['reply']
-        reply_samples = [parsed_json[key] for key in parsed_json.keys() if key.startswith('reply sample')]
-        reply_samples = list(filter(lambda x: len(x)>0, reply_samples))
-        return reply, reply_samples
+
+def summarize_youtube(reader: YoutubeTranscriptReader, video_id: str) -> str:
+    is_successful, chunks, error_message = youtube.get_transcript_chunks(video_id, reader.model_engine)
+    if not is_successful:
+        raise Exception(error_message)
+    is_successful, response, error_message = reader.summarize(chunks)
+    if not is_successful:
+        raise Exception(error_message)
+    _, response = get_role_and_content(response)
+    return response
+
+
+def summarize_website(reader: WebsiteReader, url: str) -> str:
+    chunks = website.get_content_from_url(url)
+    if len(chunks) == 0:
+        raise Exception('このサイトからテキストを取得できませんでした。')
+    is_successful, response, error_message = reader.summarize(chunks)
+    if not is_successful:
+        raise Exception(error_message)
+    _, response = get_role_and_content(response)
+    return response
+
+
+def load_summary(cache_key: str, load, reader, source: str) -> str:
+    # runs once per key however many users sent the same link meanwhile;
+    # the caller missed already, only a flight that just ended can have set it
+    response = summary_cache.peek(cache_key)
+    if response is None:
+        response = load(reader, source)
+        summary_cache.set(cache_key, response)
+    return response
+
+
+def get_image(user_model: OpenAIModel, prompt: str):
+    response = image_pool.take(prompt)
+    if response is not None:
+        return True, response, None
+    if coalesce_image_prompts:
+        result = image_flight.do(f'image:{prompt}', user_model.image_generations, prompt)
+    else:
+        result = user_model.image_generations(prompt)
+    if result[0]:
+        image_pool.remember(prompt, result[1])
+    return result
+
+
+def answer_chat(user_id: str, text: str):
+    user_model = get_model(user_id)
+    comp = build_chat_prompt(user_id, text)
+    is_successful, response, error_message = user_model.chat_completions(comp, os.getenv('OPENAI_MODEL_ENGINE'))
+    if not is_successful:
+        raise Exception(error_message)
+    role, response = get_role_and_content(response)
+    log_payload('model_response', response)
+    reply, samples = get_reply_and_reply_samples(response)
+    # logger.info(f"{reply} {samples}")
+    msg = build_chat_message(reply, samples)
+    memory.append(user_id, role, reply)
+    return msg
+
+
+@handler.add(MessageEvent, message=TextMessage)
+def handle_text_message(event):
+    user_id = event.source.user_id
+    text = str(event.message.text.strip())
+    logger.info(f'{user_id}: {text}')
+    set_reply_deadline(event.timestamp)
 
     try:
-        def setup_token(api_key:str):
-            model = OpenAIModel(api_key=api_key)
-            is_successful, _, _ = model.check_token_valid()
-            if not is_successful:
-                raise ValueError('Invalid API token')
-            model_management[user_id] = model
-            storage.save({
-                user_id: api_key
-            })
-        cmd = get_model(user_id).pop_command()
-        if text in ['/cancel']:
-            msg = TextSendMessage(text=f'キャンセルしました')
+        cmd = pop_command(user_id)
+        metrics.inc('commands_total', command=command_label(text, cmd))
+        msg = build_command_message(user_id, text, cmd)
+        if msg is not None:
+            pass
         elif cmd == OpenAIModelCmd.SET_TOKEN:
             # api_key = text[3:].strip()
             # setup_token(user_id, api_key)
             api_key = text
             setup_token(user_id, api_key)
             msg = TextSendMessage(text=f'トークンを入力しました。\n{api_key}')
-        elif cmd == OpenAIModelCmd.SET_SYSTEM_PROMPT:
-            system_prompt = text
-            memory.change_system_message(user_id, system_message=system_prompt)
-            msg = TextSendMessage(text=f'システムメッセージを変更しました:\n{system_prompt}')
         elif cmd == OpenAIModelCmd.SET_IMAGE_PROMPT:
             prompt = text
             logger.info(f"image {text}")
             memory.append(user_id, 'user', prompt)
-            is_successful, response, error_message = get_model(user_id).image_generations(prompt)
+            is_successful, response, error_message = get_image(get_model(user_id), prompt)
             if not is_successful:
                 raise Exception(error_message)
             url = response['data'][0]['url']
-            quick_reply_menu = {
-                "続けて画像を生成":"/image",
-                "ヘルプ":"ヘルプ",
-            }
-            items = [QuickReplyButton(action=MessageAction(label=((s[:15]+"..") if len(s)>15 else s), text=(quick_reply_menu.get(s) or s))) for k,s in enumerate(quick_reply_menu)]
-
-            msg = ImageSendMessage(
-                original_content_url=url,
-                preview_image_url=url,
-                quick_reply=QuickReply(items=items)
-            )
+            msg = build_image_message(url)
             memory.append(user_id, 'assistant', url)
         elif cmd == OpenAIModelCmd.SET_SUMMARIZE_URL:
             user_model = get_model(user_id)
             memory.append(user_id, 'user', text)
             url = website.get_url_from_text(text)
             if url:
-                if youtube.retrieve_video_id(text):
-                    is_successful, chunks, error_message = youtube.get_transcript_chunks(youtube.retrieve_video_id(text))
-                    if not is_successful:
-                        raise Exception(error_message)
-                    youtube_transcript_reader = YoutubeTranscriptReader(user_model, os.getenv('OPENAI_MODEL_ENGINE'))
-                    is_successful, response, error_message = youtube_transcript_reader.summarize(chunks)
-                    if not is_successful:
-                        raise Exception(error_message)
-                    role, response = get_role_and_content(response)
-                    quick_reply_menu = {
-                        "続けてURLを入力":"/url",
-                        "ヘルプ":"ヘルプ",
-                    }
-                    items = [QuickReplyButton(action=MessageAction(label=((s[:15]+"..") if len(s)>15 else s), text=(quick_reply_menu.get(s) or s))) for k,s in enumerate(quick_reply_menu)]
-                    msg = TextSendMessage(text=response, quick_reply=QuickReply(items=items))
+                model_engine = os.getenv('OPENAI_MODEL_ENGINE')
+                video_id = youtube.retrieve_video_id(text)
+                if video_id:
+                    reader = YoutubeTranscriptReader(user_model, model_engine)
+                    cache_key = summary_cache.make_key(f'youtube:{video_id}', reader.prompt_key(), model_engine)
+                    load = summarize_youtube
+                    source = video_id
                 else:
-                    chunks = website.get_content_from_url(url)
-                    if len(chunks) == 0:
-                        raise Exception('このサイトからテキストを取得できませんでした。')
-                    website_reader = WebsiteReader(user_model, os.getenv('OPENAI_MODEL_ENGINE'))
-                    is_successful, response, error_message = website_reader.summarize(chunks)
-                    if not is_successful:
-                        raise Exception(error_message)
-                    role, response = get_role_and_content(response)
-
-                    quick_reply_menu = {
-                        "続けてURLを入力":"/url",
-                        "ヘルプ":"ヘルプ",
-                    }
-                    items = [QuickReplyButton(action=MessageAction(label=((s[:15]+"..") if len(s)>15 else s), text=(quick_reply_menu.get(s) or s))) for k,s in enumerate(quick_reply_menu)]
-                    msg = TextSendMessage(text=response, quick_reply=QuickReply(items=items))
+                    reader = WebsiteReader(user_model, model_engine)
+                    cache_key = summary_cache.make_key(f'url:{website.canonicalize_url(url)}', reader.prompt_key(), model_engine)
+                    load = summarize_website
+                    source = url
+                response = summary_cache.get(cache_key)
+                if response is None:
+                    response = summary_flight.do(cache_key, load_summary, cache_key, load, reader, source)
+                else:
+                    logger.info(f'summary cache hit: {cache_key}')
+                msg = build_summary_message(response)
+                memory.append(user_id, 'assistant', response)
             else:
-                quick_reply_menu = {
-                    "続けてURLを入力":"/url",
-                    "ヘルプ":"ヘルプ",
-                }
-                items = [QuickReplyButton(action=MessageAction(label=((s[:15]+"..") if len(s)>15 else s), text=(quick_reply_menu.get(s) or s))) for k,s in enumerate(quick_reply_menu)]
-                msg = TextSendMessage(text="入力された内容はURLではありませんでした。", quick_reply=QuickReply(items=items))
-            memory.append(user_id, role, response)
-        elif text.startswith('/token'):
-            get_model(user_id).set_command(OpenAIModelCmd.SET_TOKEN)
-            # api_key = text[3:].strip()
-            # setup_token(user_id, api_key)
-
-            quick_reply_menu = {"キャンセル":"/cancel"}
-            items = [QuickReplyButton(action=MessageAction(label=v, text=quick_reply_menu[v])) for k,v in enumerate(quick_reply_menu)]
-            msg = TextSendMessage(text='トークンを入力してください。', quick_reply=QuickReply(items=items))
-        elif text.startswith('/reset_system_message'):
-            system_prompt = text
-            memory.change_system_message(user_id, system_message=os.getenv('SYSTEM_MESSAGE'))
-            msg = TextSendMessage(text=f'システムメッセージを初期状態に戻しました。')
-        elif text in ['ヘルプ', '使い方']:
-            quick_reply_menu = {"何を聞けば良い？":"何を聞けば良い？", "明日の天気は？":"明日の天気は？", "画像生成をしたい":"/image", "URLを要約": "/url", "システムメッセージ":"/system", "システムメッセージをリセット":"/reset_system_message", "履歴をクリア":"/clear", "トークンを入力":"/token"}
-
-            items = [QuickReplyButton(action=MessageAction(label=v, text=quick_reply_menu[v])) for k,v in enumerate(quick_reply_menu)]
-            
-            msg = TextSendMessage(text="チャットの他、画像の生成や、指定したURLの要約などができます✨",
-                                    quick_reply=QuickReply(items=items))
-        elif text.startswith('/help'):
-            text = '''
-            このままチャットすればChatGPTをお手軽に使えます✨
-            以下のコマンドも使えます。
-
-            /image 画像の生成をします。
-            /url 指定したURLを要約します。
-            /system システムメッセージを入力します。例：あなたは有能な弁護士です。
-            /reset_system_message システムメッセージを初期状態に戻します。
-            /clear ２つ前までのチャット履歴を覚えてますが、その履歴をクリアします。
-            /token カスタムのAPI Tokenを入力します。https://platform.openai.com/ に登録すれば取得できます。
-            '''[1:-1]
-            msg = TextSendMessage(text=textwrap.dedent(text))
-
-        elif text.startswith('/system'):
-            get_model(user_id).set_command(OpenAIModelCmd.SET_SYSTEM_PROMPT)
-            msg = TextSendMessage(text='システムメッセージを入力してください。\n\n例1 あなたは有能な弁護士です。\n例2 あなたは優秀な小学生の家庭教師です。')
-            # memory.change_system_message(user_id, text[5:].strip())
-            # msg = TextSendMessage(text='システムプロンプトを入力しました。')
-
-        elif text.startswith('/clear'):
-            memory.remove(user_id)
-            msg = TextSendMessage(text='履歴をクリアしました。')
-
-        elif text.startswith('/image'):
-            get_model(user_id).set_command(OpenAIModelCmd.SET_IMAGE_PROMPT)
-            quick_reply_menu = {
-                "お菓子の城を作った恐竜たちが楽しそうに遊んでいるシーン":"A scene of dinosaurs happily playing in a candy castle they built",
-                "逆さまに歩く象とその周りに驚く動物たちの姿":"An upside-down walking elephant with surprised animals around it",
-                "飛行船に乗ったネコ科の生き物たちが、大量の毛玉を空中にばらまいているシーン":"A scene of feline creatures on a hot air balloon, scattering a massive amount of furballs into the air",
-                "ウサギがチェロを演奏している様子を見て、羊やヒツジたちが驚きを隠せないシーン":"A scene where sheep and lambs can't hide their surprise as they watch a rabbit playing the cello",
-                "海底で巨大なイカが、砂浜に座って日光浴をしている様子":"A giant squid sunbathing on a sandy beach at the bottom of the sea"
-            }
-            items = [QuickReplyButton(action=MessageAction(label=((s[:15]+"..") if len(s)>15 else s), text=(quick_reply_menu.get(s) or s))) for k,s in enumerate(quick_reply_menu)]
-            msg = TextSendMessage(text='どんな画像を生成しますか？できるだけ英語で入力してください。', quick_reply=QuickReply(items=items))
-
-            # prompt = text[3:].strip()
-            # memory.append(user_id, 'user', prompt)
-            # is_successful, response, error_message = get_model(user_id).image_generations(prompt)
-            # if not is_successful:
-            #     raise Exception(error_message)
-            # url = response['data'][0]['url']
-            # msg = ImageSendMessage(
-            #     original_content_url=url,
-            #     preview_image_url=url
-            # )
-            # memory.append(user_id, 'assistant', url)
-        elif text.startswith('/url'):
-            get_model(user_id).set_command(OpenAIModelCmd.SET_SUMMARIZE_URL)
-            msg = TextSendMessage(text='要約したいURLを入力してね。')
+                msg = build_summary_message("入力された内容はURLではありませんでした。")
         else:
-            user_model = get_model(user_id)
+            msg = answer_chat(user_id, text)
+    except Exception as e:
+        msg = build_error_message(user_id, e)
+    reply_message(event.reply_token, msg)
 
-            def wrap_msg(msg):
-                text=("""
-                # 命令書：
-                あなたは、優秀な女子高生のアシスタントで質問者からの質問に的確に回答します。
-                以下の制約条件をもとに、アシスタントとしての回答および、それに対する質問者からのさらなる質問の例を出力してください。
-
-                # 制約条件：
-                ・回答の文字数は500字以内
-                ・さらなる質問の例は最大4つ。それぞれ20字以内
-                ・出力は女子高生が話すような日本語の砕けた言葉で。
-                ・重要なキーワードを取り残さない
-                ・情報が不足する場合は、回答せず、さらなる質問を求めてください。
-
-                # 入力文：
-                """ + msg +
-                """
-                # 出力文：
-                {"reply":"...","reply sample1":"...", ...}
-                """)[1:-1]
-                text = textwrap.dedent(text)
-                return text
 
-            memory.append(user_id, 'user', text)
-            ret = memory.get(user_id)
-            comp = copy.deepcopy(ret)
-            last = comp.pop()
-            last["content"]=wrap_msg(last["content"])
-            comp.append(last)
-            # logger.info("送信ログ:\n" + json.dumps(comp))
-            is_successful, response, error_message = user_model.chat_completions(comp, os.getenv('OPENAI_MODEL_ENGINE'))
-            if not is_successful:
-                raise Exception(error_message)
-            role, response = get_role_and_content(response)
-            logger.info(response)
-            reply, samples = get_reply_and_reply_samples(response)
-            # logger.info(f"{reply} {samples}")
-            quick_reply_menu = {
-                "ヘルプ":"ヘルプ"
-            }
-            items = [QuickReplyButton(action=MessageAction(label=((s[:15]+"..") if len(s)>15 else s), text=(quick_reply_menu.get(s) or s))) for k,s in enumerate(quick_reply_menu)]
-            items += [QuickReplyButton(action=MessageAction(label=((s[:15]+"..") if len(s)>15 else s), text=s)) for s in samples]
-            if len(items)>0:
-                msg = TextSendMessage(text=reply, quick_reply=QuickReply(items=items))
-            else:
-                msg = TextSendMessage(text=reply)
-            memory.append(user_id, role, reply)
-    except ValueError as e:
-        logger.info(f'例外が発生しました。{str(e)}')
-        msg = TextSendMessage(text=f'例外が発生しました。{str(e)}')
-    except KeyError as e:
-        logger.info(f'例外が発生しました。{str(e)}')
-        msg = TextSendMessage(text=f'例外が発生しました。{str(e)}')
+def transcribe_audio(event) -> str:
+    with metrics.timer('stage_seconds', stage='audio_download'):
+        audio = audio_transcriber.read(line_bot_api.get_message_content(event.message.id))
+    is_successful, response, error_message = get_model(event.source.user_id).audio_transcriptions(audio, 'whisper-1')
+    if not is_successful:
+        raise Exception(error_message)
+    return response['text']
+
+
+def answer_audio(event, wait=False):
+    """
+    With `wait`, the transcription runs on the audio threads while this
+    thread waits, and the answer is built here.
+    """
+    user_id = event.source.user_id
+    try:
+        text = audio_transcriber.call(transcribe_audio, event) if wait else transcribe_audio(event)
+        logger.info(f"{user_id}: (voice) {text}")
+        msg = answer_chat(user_id, text)
+    except AudioRejected as e:
+        msg = TextSendMessage(text=str(e))
     except Exception as e:
-        memory.remove(user_id)
-        if str(e).startswith('Incorrect API key provided'):
-            msg = TextSendMessage(text='OpenAI API Token が正しくありません。/token sk-xxxxx の形式で登録してください。')
-        elif str(e).startswith('That model is currently overloaded with other requests.'):
-            msg = TextSendMessage(text='同時使用人数を超えました。しばらく待ってからお試しください。')
-        else:
-            msg = TextSendMessage(text=str(e))
-    line_bot_api.reply_message(event.reply_token, msg)
+        msg = build_error_message(user_id, e)
+    reply_message(event.reply_token, msg)
 
 
 @handler.add(MessageEvent, message=AudioMessage)
 def handle_audio_message(event):
-    user_id = event.source.user_id
-    # audio_content = line_bot_api.get_message_content(event.message.id)
-    # input_audio_path = f'{str(uuid.uuid4())}.m4a'
-    # with open(input_audio_path, 'wb') as fd:
-    #     for chunk in audio_content.iter_content():
-    #         fd.write(chunk)
-
-    # try:
-    #     is_successful, response, error_message = get_model(user_id).audio_transcriptions(input_audio_path, 'whisper-1')
-    #     if not is_successful:
-    #         raise Exception(error_message)
-    #     memory.append(user_id, 'user', response['text'])
-    #     is_successful, response, error_message = get_model(user_id).chat_completions(memory.get(user_id), 'gpt-3.5-turbo')
-    #     if not is_successful:
-    #         raise Exception(error_message)
-    #     role, response = get_role_and_content(response)
-    #     memory.append(user_id, role, response)
-    #     msg = TextSendMessage(text=response)
-    # except ValueError:
-    #     msg = TextSendMessage(text='最初に /token sk-xxxxx の形式でトークンを登録してください。')
-    # except KeyError:
-    #     msg = TextSendMessage(text='最初に /token sk-xxxxx の形式でトークンを登録してください。')
-    # except Exception as e:
-    #     memory.remove(user_id)
-    #     if str(e).startswith('Incorrect API key provided'):
-    #         msg = TextSendMessage(text='OpenAI API Token が正しくありません。/token sk-xxxxx の形式で登録してください。')
-    #     else:
-    #         msg = TextSendMessage(text=str(e))
-    # os.remove(input_audio_path)
-    msg = TextSendMessage(text="音声メッセージには対応していません。")
-    line_bot_api.reply_message(event.reply_token, msg)
+    set_reply_deadline(event.timestamp)
+    metrics.inc('commands_total', command='audio')
+    try:
+        audio_transcriber.check_duration(event.message.duration)
+    except AudioRejected as e:
+        reply_message(event.reply_token, TextSendMessage(text=str(e)))
+        return
+    if job_pool:
+        # a user's jobs run in order: the answer waits on this worker
+        answer_audio(event, wait=True)
+        return
+    # transcription runs on its own threads, off the webhook threads
+    if not audio_transcriber.submit(answer_audio, event):
+        reply_message(event.reply_token, TextSendMessage(text=AUDIO_BUSY_MESSAGE))
 
 
 @app.route("/", methods=['GET'])
@@ -379,20 +616,74 @@ def home():
     return 'Hello World'
 
 
-if __name__ == "__main__":
-    if os.getenv('USE_MONGO'):
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+def register_metrics():
+    metrics.describe('stage_seconds', 'Time spent per processing stage.')
+    metrics.describe('commands_total', 'Text messages by command branch.')
+    metrics.describe('inflight_requests', 'Webhook requests being handled.')
+    metrics.describe('inflight_events', 'Webhook events being handled.')
+    metrics.describe('transcript_cache_total', 'YouTube transcript lookups by cache result.')
+    metrics.register('job_queue_depth', lambda: job_pool.depth() if job_pool else 0)
+    metrics.register('job_retries_total', lambda: job_pool.retried if job_pool else 0)
+    metrics.register('jobs_failed_total', lambda: job_pool.failed if job_pool else 0)
+    metrics.register('webhook_dedup_total', lambda: [({'result': 'duplicate'}, seen_events.hits), ({'result': 'new'}, seen_events.misses)])
+    metrics.register('summary_cache_total', lambda: [({'result': 'hit'}, summary_cache.hits), ({'result': 'miss'}, summary_cache.misses)])
+    metrics.register('summary_cache_size', lambda: summary_cache.stats()['size'])
+    metrics.register('single_flight_shared_total', lambda: summary_flight.shared + image_flight.shared)
+    metrics.register('memory_users', lambda: len(memory))
+    metrics.register('log_records_dropped_total', lambda: [({'level': level}, count) for level, count in queue_handler.dropped.items()])
+    metrics.register('log_payloads_sampled_out_total', lambda: queue_handler.sampled_out)
+    metrics.register('audio_pending', lambda: audio_transcriber.pending)
+    metrics.register('image_pool_ready', image_pool.ready)
+    metrics.register('image_pool_served_total', lambda: image_pool.served)
+    metrics.register('image_cache_total', lambda: [({'result': 'hit'}, image_pool.cache.hits), ({'result': 'miss'}, image_pool.cache.misses)])
+
+
+register_metrics()
+
+
+def setup():
+    global storage, memory, user_commands
+    if os.getenv('USE_MONGO') or 'mongo' in (os.getenv('MEMORY_BACKEND'), os.getenv('WEBHOOK_DEDUP_STORE')):
         mongodb.connect_to_database()
+    if os.getenv('USE_MONGO'):
         storage = Storage(MongoStorage(mongodb.db))
+        summary_cache.store = MongoCacheStore(mongodb.db, max_entries=int(os.getenv('SUMMARY_CACHE_MAX_ENTRIES') or 10000), ttl=summary_cache.ttl)
     else:
         storage = Storage(FileStorage('db.json'))
-    try:
-        data = storage.load()
-        for user_id in data.keys():
-            model_management[user_id] = OpenAIModel(api_key=data[user_id])
-    except FileNotFoundError:
-        pass
+        summary_cache.store = SQLiteCacheStore(os.getenv('SUMMARY_CACHE_PATH') or 'summary_cache.db', max_bytes=int(os.getenv('SUMMARY_CACHE_MAX_BYTES') or 64 * 1024 * 1024), ttl=summary_cache.ttl)
+    youtube.transcript_cache = SQLiteCacheStore(os.getenv('YOUTUBE_TRANSCRIPT_CACHE_PATH') or 'transcript_cache.db', max_bytes=int(os.getenv('YOUTUBE_TRANSCRIPT_CACHE_MAX_BYTES') or 64 * 1024 * 1024), ttl=int(os.getenv('YOUTUBE_TRANSCRIPT_CACHE_TTL') or 7 * 86400))
+    website.page_cache = SQLiteCacheStore(os.getenv('WEBSITE_CACHE_PATH') or 'page_cache.db', max_bytes=int(os.getenv('WEBSITE_CACHE_MAX_BYTES') or 128 * 1024 * 1024), ttl=int(os.getenv('WEBSITE_CACHE_TTL') or 7 * 86400))
+    if os.getenv('WEBHOOK_DEDUP_STORE') == 'mongo':
+        seen_events.store = MongoSeenStore(mongodb.db)
+    elif os.getenv('WEBHOOK_DEDUP_STORE') == 'sqlite':
+        seen_events.store = SQLiteSeenStore(os.getenv('WEBHOOK_DEDUP_PATH') or 'webhook_events.db')
+    # conversations and pending commands shared between processes / nodes
+    if os.getenv('MEMORY_BACKEND') == 'mongo':
+        backend = MongoConversationBackend(mongodb.db)
+    elif os.getenv('MEMORY_BACKEND') == 'sqlite':
+        backend = SQLiteConversationBackend(os.getenv('MEMORY_SQLITE_PATH') or 'conversations.db')
+    else:
+        backend = None
+    if backend is not None:
+        memory = PersistentMemory(backend, **memory_options)
+        user_commands = CommandStore(backend, ttl=command_ttl)
+    if default_model is not None:
+        image_pool.start(default_model)
+
+
+if __name__ == "__main__":
+    setup()
+    if os.getenv('USE_JOB_QUEUE'):
+        job_queue = SQLiteJobQueue(os.getenv('JOB_QUEUE_PATH') or 'jobs.db')
+        job_pool = JobWorkerPool(job_queue, handle_job, workers=int(os.getenv('JOB_QUEUE_WORKERS') or 4))
+        job_pool.start()
     host = '0.0.0.0'
-    port = "8080"
+    port = os.getenv('PORT') or "8080"
     # app.run(host='0.0.0.0', port=8080)
     logger.info(f"start listening: {host}:{port}")
-    serve(app, host=host, port=port)
\ No newline at end of file
+    serve(app, host=host, port=port)
@@ -0,0 +1,251 @@
+import datetime
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize=256, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.time():
+                del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        with self.lock:
+            self.data[key] = (value, time.time() + ttl if ttl else None)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.data.pop(key, None)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at is not None and expires_at < time.time():
+            return default
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses}
+
+
+class ShardedLRUCache:
+    """
+    LRUCache split into lock-striped shards by key, so threads working on
+    different users do not wait on one lock.
+    """
+    def __init__(self, maxsize=256, ttl=None, shards=16):
+        self.shards = [LRUCache(maxsize=max(1, -(-maxsize // shards)), ttl=ttl) for _ in range(shards)]
+
+    def _shard(self, key) -> LRUCache:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, key, default=None):
+        return self._shard(key).get(key, default)
+
+    def set(self, key, value, ttl=None):
+        self._shard(key).set(key, value, ttl)
+
+    def delete(self, key):
+        self._shard(key).delete(key)
+
+    def pop(self, key, default=None):
+        return self._shard(key).pop(key, default)
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def stats(self):
+        stats = [shard.stats() for shard in self.shards]
+        return {name: sum(stat[name] for stat in stats) for name in ('size', 'hits', 'misses')}
+
+
+class SQLiteCacheStore:
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, ttl=86400):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)')
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                self._delete(key)
+                return None
+            self.conn.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+            return value
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        size = len(value)
+        with self.lock:
+            self._delete(key)
+            self.conn.execute(
+                'INSERT INTO cache (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                (key, value, size, now + (ttl or self.ttl), now)
+            )
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self._evict(now)
+
+    def delete(self, key):
+        with self.lock:
+            self._delete(key)
+
+    def _delete(self, key):
+        row = self.conn.execute('SELECT size FROM cache WHERE key = ?', (key,)).fetchone()
+        if row:
+            self.conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self.total_bytes -= row[0]
+
+    def _evict(self, now):
+        self.conn.execute('DELETE FROM cache WHERE expires_at < ?', (now,))
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute('SELECT key, size FROM cache ORDER BY accessed_at').fetchall()
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            self.conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self.total_bytes -= size
+
+
+class MongoCacheStore:
+    def __init__(self, db, collection='summary_cache', max_entries=10000, ttl=86400):
+        self.collection = db[collection]
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.writes = 0
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+        self.collection.create_index('accessed_at')
+
+    def get(self, key):
+        now = datetime.datetime.utcnow()
+        doc = self.collection.find_one_and_update({
+            '_id': key, 'expires_at': {'$gt': now}
+        }, {
+            '$set': {'accessed_at': now}
+        })
+        return doc['value'] if doc else None
+
+    def set(self, key, value, ttl=None):
+        now = datetime.datetime.utcnow()
+        self.collection.replace_one({'_id': key}, {
+            '_id': key,
+            'value': value,
+            'expires_at': now + datetime.timedelta(seconds=ttl or self.ttl),
+            'accessed_at': now,
+        }, upsert=True)
+        self.writes += 1
+        if self.writes % 100 == 0:
+            self._evict()
+
+    def delete(self, key):
+        self.collection.delete_one({'_id': key})
+
+    def _evict(self):
+        overflow = self.collection.estimated_document_count() - self.max_entries
+        if overflow > 0:
+            oldest = self.collection.find({}, {'_id': 1}).sort('accessed_at', 1).limit(overflow)
+            self.collection.delete_many({'_id': {'$in': [doc['_id'] for doc in oldest]}})
+
+
+class SummaryCache:
+    """
+    Two-tier cache for /url summaries: an in-process LRU in front of an
+    optional SQLiteCacheStore or MongoCacheStore.
+    """
+    def __init__(self, store=None, maxsize=256, ttl=86400):
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.store = store
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(source: str, prompt: str, model_engine: str) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+        return f'{source}|{model_engine}|{prompt_hash}'
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.store is not None:
+            stored = self.store.get(key)
+            if stored is not None:
+                value = bytes(stored).decode('utf-8')
+                self.memory.set(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def peek(self, key):
+        """
+        Looks at the in-process tier only and leaves hits and misses alone;
+        set() fills that tier first, so a summary stored moments ago by this
+        process is always found.
+        """
+        return self.memory.get(key)
+
+    def set(self, key, value: str):
+        self.memory.set(key, value)
+        if self.store is not None:
+            self.store.set(key, value.encode('utf-8'), ttl=self.ttl)
+
+    def stats(self):
+        return {'size': len(self.memory), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,180 @@
+import datetime
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+
+class SQLiteConversationBackend:
+    """
+    Conversations and pending commands in a local SQLite file, shared by
+    the worker processes of one host. Every write bumps the row version;
+    save_many() only writes rows still at the version the caller read.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                user_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS commands (
+                user_id TEXT PRIMARY KEY,
+                command TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+
+    def load(self, user_id):
+        with self.lock:
+            row = self.conn.execute('SELECT data, version FROM conversations WHERE user_id = ?', (user_id,)).fetchone()
+        if row is None:
+            return None, 0
+        return json.loads(row[0]), row[1]
+
+    def save_many(self, items):
+        """
+        Writes (user_id, document, expected_version) items in one
+        transaction and returns the user ids whose version had moved on.
+        """
+        conflicts = []
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for user_id, document, version in items:
+                    data = json.dumps(document, ensure_ascii=False)
+                    if version == 0:
+                        cursor = self.conn.execute('INSERT OR IGNORE INTO conversations (user_id, data, version, updated_at) VALUES (?, ?, 1, ?)', (user_id, data, now))
+                    else:
+                        cursor = self.conn.execute('UPDATE conversations SET data = ?, version = version + 1, updated_at = ? WHERE user_id = ? AND version = ?', (data, now, user_id, version))
+                    if cursor.rowcount == 0:
+                        conflicts.append(user_id)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return conflicts
+
+    def reset(self, user_id, system_message=None):
+        data = json.dumps({'messages': [], 'summary': None, 'system_message': system_message}, ensure_ascii=False)
+        with self.lock:
+            self.conn.execute('''
+                INSERT INTO conversations (user_id, data, version, updated_at) VALUES (?, ?, 1, ?)
+                ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, version = version + 1, updated_at = excluded.updated_at
+            ''', (user_id, data, time.time()))
+
+    def set_command(self, user_id, command, ttl):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO commands (user_id, command, expires_at) VALUES (?, ?, ?)', (user_id, command, time.time() + ttl))
+
+    def pop_command(self, user_id):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT command, expires_at FROM commands WHERE user_id = ?', (user_id,)).fetchone()
+                if row is not None:
+                    self.conn.execute('DELETE FROM commands WHERE user_id = ?', (user_id,))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class MongoConversationBackend:
+    """
+    Conversations and pending commands in MongoDB, shared by every node.
+    Each batch is tagged with a unique writer id so the documents a
+    conditional bulk write did not update can be told apart afterwards.
+    """
+    def __init__(self, db):
+        self.conversations = db['conversations']
+        self.commands = db['commands']
+        self.commands.create_index('expires_at', expireAfterSeconds=0)
+        self.node_id = uuid.uuid4().hex
+
+    def load(self, user_id):
+        doc = self.conversations.find_one({'_id': user_id}, {'data': 1, 'version': 1})
+        if doc is None:
+            return None, 0
+        return doc['data'], doc['version']
+
+    def save_many(self, items):
+        writer = f'{self.node_id}:{uuid.uuid4().hex}'
+        now = datetime.datetime.utcnow()
+        operations = [UpdateOne({
+            '_id': user_id,
+            'version': version,
+        }, {
+            '$set': {'data': document, 'writer': writer, 'updated_at': now},
+            '$inc': {'version': 1},
+        }, upsert=version == 0) for user_id, document, version in items]
+        try:
+            result = self.conversations.bulk_write(operations, ordered=False)
+            if result.matched_count + len(result.upserted_ids) == len(items):
+                return []
+        except BulkWriteError as e:
+            # duplicate keys are first writes that lost against another node
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+        user_ids = [user_id for user_id, _, _ in items]
+        written = {doc['_id'] for doc in self.conversations.find({'_id': {'$in': user_ids}, 'writer': writer}, {'_id': 1})}
+        return [user_id for user_id in user_ids if user_id not in written]
+
+    def reset(self, user_id, system_message=None):
+        self.conversations.update_one({'_id': user_id}, {
+            '$set': {
+                'data': {'messages': [], 'summary': None, 'system_message': system_message},
+                'writer': self.node_id,
+                'updated_at': datetime.datetime.utcnow(),
+            },
+            '$inc': {'version': 1},
+        }, upsert=True)
+
+    def set_command(self, user_id, command, ttl):
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+        try:
+            self.commands.replace_one({'_id': user_id}, {'_id': user_id, 'command': command, 'expires_at': expires_at}, upsert=True)
+        except DuplicateKeyError:
+            self.commands.replace_one({'_id': user_id}, {'_id': user_id, 'command': command, 'expires_at': expires_at})
+
+    def pop_command(self, user_id):
+        doc = self.commands.find_one_and_delete({'_id': user_id})
+        if doc is None or doc['expires_at'] < datetime.datetime.utcnow():
+            return None
+        return doc['command']
+
+
+class CommandStore:
+    """
+    Pending commands kept in a conversation backend, with the set/pop
+    interface of the in-process ShardedLRUCache.
+    """
+    def __init__(self, backend, ttl=600):
+        self.backend = backend
+        self.ttl = ttl
+
+    def set(self, user_id, command):
+        self.backend.set_command(user_id, command, self.ttl)
+
+    def pop(self, user_id, default=None):
+        command = self.backend.pop_command(user_id)
+        return default if command is None else command
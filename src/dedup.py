@@ -0,0 +1,128 @@
+import datetime
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class SQLiteSeenStore:
+    """
+    Persistent tier of SeenSet, so redeliveries are recognised across
+    restarts and between the worker processes of one host.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS seen_expires_at ON seen (expires_at)')
+        self.adds = 0
+
+    def add(self, key, ttl) -> bool:
+        now = time.time()
+        with self.lock:
+            self.adds += 1
+            if self.adds % 1000 == 0:
+                self.conn.execute('DELETE FROM seen WHERE expires_at < ?', (now,))
+            cursor = self.conn.execute('''
+                INSERT INTO seen (key, expires_at) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at WHERE seen.expires_at < ?
+            ''', (key, now + ttl, now))
+            return cursor.rowcount > 0
+
+    def discard(self, key):
+        with self.lock:
+            self.conn.execute('DELETE FROM seen WHERE key = ?', (key,))
+
+
+class MongoSeenStore:
+    def __init__(self, db, collection='webhook_events'):
+        self.collection = db[collection]
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+
+    def add(self, key, ttl) -> bool:
+        from pymongo.errors import DuplicateKeyError
+        now = datetime.datetime.utcnow()
+        try:
+            self.collection.insert_one({'_id': key, 'expires_at': now + datetime.timedelta(seconds=ttl)})
+            return True
+        except DuplicateKeyError:
+            # the TTL monitor only runs once a minute
+            return self.collection.update_one({'_id': key, 'expires_at': {'$lt': now}}, {'$set': {'expires_at': now + datetime.timedelta(seconds=ttl)}}).modified_count > 0
+
+    def discard(self, key):
+        self.collection.delete_one({'_id': key})
+
+
+class SeenSet:
+    """
+    Environment Variables:
+        WEBHOOK_DEDUP_SIZE
+        WEBHOOK_DEDUP_WINDOW
+
+    Remembers keys for WEBHOOK_DEDUP_WINDOW seconds, at most
+    WEBHOOK_DEDUP_SIZE of them. add() is O(1) and returns False for a key
+    already seen. With a `store`, keys missing from memory are checked
+    against it too.
+    """
+    def __init__(self, maxsize=None, window=None, store=None):
+        self.maxsize = int(maxsize or os.getenv('WEBHOOK_DEDUP_SIZE') or 100000)
+        self.window = float(window or os.getenv('WEBHOOK_DEDUP_WINDOW') or 3600)
+        self.store = store
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, key) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            # entries share one window, so the oldest insert expires first
+            while self.seen and (len(self.seen) >= self.maxsize or next(iter(self.seen.values())) < now):
+                self.seen.popitem(last=False)
+            expires_at = self.seen.get(key)
+            if expires_at is not None and expires_at >= now:
+                self.hits += 1
+                return False
+            self.seen[key] = now + self.window
+            self.seen.move_to_end(key)
+        if self.store is not None and not self.store.add(key, self.window):
+            with self.lock:
+                self.hits += 1
+            return False
+        with self.lock:
+            self.misses += 1
+        return True
+
+    def discard(self, key):
+        """
+        Forgets a key whose processing failed, so a redelivery is handled.
+        """
+        with self.lock:
+            self.seen.pop(key, None)
+        if self.store is not None:
+            self.store.discard(key)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'size': len(self.seen), 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+
+def event_key(event):
+    """
+    Dedup key of a webhook event, given as a dict or a linebot Event.
+    """
+    if isinstance(event, dict):
+        event_id = event.get('webhookEventId')
+        message_id = (event.get('message') or {}).get('id')
+    else:
+        event_id = getattr(event, 'webhook_event_id', None)
+        message_id = getattr(getattr(event, 'message', None), 'id', None)
+    if event_id:
+        return f'event:{event_id}'
+    if message_id:
+        return f'message:{message_id}'
+    return None
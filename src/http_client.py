@@ -0,0 +1,195 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HTTPClient:
+    """
+    Environment Variables:
+        HTTP_CONNECT_TIMEOUT
+        HTTP_READ_TIMEOUT
+        HTTP_POOL_CONNECTIONS
+        HTTP_POOL_MAXSIZE
+        HTTP_USE_HTTP2
+    """
+    def __init__(self, connect_timeout=None, read_timeout=None, pool_connections=None, pool_maxsize=None, http2=None):
+        self.connect_timeout = float(connect_timeout or os.getenv('HTTP_CONNECT_TIMEOUT') or 5)
+        self.read_timeout = float(read_timeout or os.getenv('HTTP_READ_TIMEOUT') or 60)
+        self.pool_connections = int(pool_connections or os.getenv('HTTP_POOL_CONNECTIONS') or 10)
+        self.pool_maxsize = int(pool_maxsize or os.getenv('HTTP_POOL_MAXSIZE') or 50)
+        self.http2 = http2 if http2 is not None else (os.getenv('HTTP_USE_HTTP2') or '').lower() in ('1', 'true', 'yes')
+        self.lock = threading.Lock()
+        self.session = None
+        self.stream_session = None
+
+    def _create_session(self):
+        if self.http2:
+            try:
+                import httpx
+                limits = httpx.Limits(max_connections=self.pool_maxsize, max_keepalive_connections=self.pool_maxsize)
+                return httpx.Client(http2=True, limits=limits)
+            except ImportError:
+                pass
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize, pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_session(self):
+        if self.session is None:
+            with self.lock:
+                if self.session is None:
+                    self.session = self._create_session()
+        return self.session
+
+    def request(self, method, url, timeout=None, **kwargs):
+        session = self.get_session()
+        if isinstance(session, requests.Session):
+            timeout = timeout or (self.connect_timeout, self.read_timeout)
+        else:
+            import httpx
+            timeout = httpx.Timeout(timeout or self.read_timeout, connect=self.connect_timeout)
+        return session.request(method, url, timeout=timeout, **kwargs)
+
+    def get_stream_session(self):
+        """
+        fetch_limited needs the socket of the response to enforce its
+        deadline, so it always streams through requests.
+        """
+        session = self.get_session()
+        if isinstance(session, requests.Session):
+            return session
+        if self.stream_session is None:
+            with self.lock:
+                if self.stream_session is None:
+                    stream_session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize, pool_block=True)
+                    stream_session.mount('https://', adapter)
+                    stream_session.mount('http://', adapter)
+                    self.stream_session = stream_session
+        return self.stream_session
+
+    @staticmethod
+    def _abort(response, expired):
+        expired.set()
+        # closing the response would not wake a thread blocked in recv()
+        sock = getattr(getattr(response.raw, '_connection', None), 'sock', None)
+        if sock is None:
+            # urllib3 lets go of connections that close after the response
+            reader = getattr(getattr(response.raw, '_fp', None), 'fp', None)
+            sock = getattr(getattr(reader, 'raw', None), '_sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def fetch_limited(self, url, max_bytes, headers=None, timeout=None, deadline=None):
+        """
+        Streams a GET response and stops reading after `max_bytes` or once
+        `deadline` seconds have passed since the request was sent, however
+        slowly the server trickles the body. Returns (status_code, headers,
+        body, truncated).
+        """
+        started = time.monotonic()
+        response = self.get_stream_session().get(url, headers=headers, stream=True, timeout=timeout or (self.connect_timeout, self.read_timeout))
+        chunks = []
+        size = 0
+        truncated = False
+        expired = threading.Event()
+        timer = None
+        if deadline:
+            timer = threading.Timer(max(0, started + deadline - time.monotonic()), self._abort, (response, expired))
+            timer.daemon = True
+            timer.start()
+        try:
+            for chunk in response.iter_content(16384):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= max_bytes:
+                    truncated = True
+                    break
+        except Exception:
+            if not expired.is_set():
+                raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            response.close()
+        return response.status_code, response.headers, b''.join(chunks)[:max_bytes], truncated or expired.is_set()
+
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+            if self.stream_session is not None:
+                self.stream_session.close()
+                self.stream_session = None
+
+
+class AsyncHTTPClient:
+    """
+    aiohttp counterpart of HTTPClient for the asyncio serving mode. The
+    session is created on first use inside the running event loop.
+    """
+    def __init__(self, connect_timeout=None, read_timeout=None, pool_maxsize=None):
+        self.connect_timeout = float(connect_timeout or os.getenv('HTTP_CONNECT_TIMEOUT') or 5)
+        self.read_timeout = float(read_timeout or os.getenv('HTTP_READ_TIMEOUT') or 60)
+        self.pool_maxsize = int(pool_maxsize or os.getenv('HTTP_POOL_MAXSIZE') or 50)
+        self.session = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_maxsize)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.session
+
+    def request(self, method, url, **kwargs):
+        return self.get_session().request(method, url, **kwargs)
+
+    async def fetch_limited(self, url, max_bytes, headers=None, timeout=None, deadline=None):
+        """
+        Counterpart of HTTPClient.fetch_limited; returns (status_code,
+        headers, body, truncated).
+        """
+        import aiohttp
+        started = time.monotonic()
+        chunks = []
+        client_timeout = aiohttp.ClientTimeout(sock_connect=timeout or self.connect_timeout, sock_read=timeout or self.read_timeout)
+
+        async def read(response):
+            size = 0
+            async for chunk in response.content.iter_chunked(16384):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= max_bytes:
+                    return True
+            return False
+
+        async with self.get_session().get(url, headers=headers, timeout=client_timeout) as response:
+            try:
+                if deadline:
+                    truncated = await asyncio.wait_for(read(response), max(0, started + deadline - time.monotonic()))
+                else:
+                    truncated = await read(response)
+            except asyncio.TimeoutError:
+                truncated = True
+            return response.status, response.headers, b''.join(chunks)[:max_bytes], truncated
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+http_client = HTTPClient()
+async_http_client = AsyncHTTPClient()
@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+from collections import deque
+
+from src.cache import LRUCache
+from src.logger import logger
+from src.rate_limiter import Priority
+
+
+def normalize_prompt(prompt: str) -> str:
+    return ' '.join(prompt.split()).lower()
+
+
+class ImagePool:
+    """
+    Environment Variables:
+        IMAGE_POOL_SIZE
+        IMAGE_POOL_TTL
+        IMAGE_POOL_REFILL_INTERVAL
+        IMAGE_POOL_IDLE
+        IMAGE_CACHE_SIZE
+        IMAGE_CACHE_TTL
+
+    Ready images for the canned /image prompts and a cache of recent
+    results for any other prompt, both keyed by normalized prompt and size.
+    Each pooled image is handed out once, so users tapping the same sample
+    still get different pictures. A warmer thread keeps IMAGE_POOL_SIZE
+    images for each canned prompt asked for within the last IMAGE_POOL_IDLE
+    seconds, so an idle bot generates nothing, and drops them at
+    IMAGE_POOL_TTL seconds; OpenAI image URLs expire after an hour.
+    """
+    def __init__(self, prompts=(), size='512x512', pool_size=None, ttl=None, refill_interval=None, idle=None, cache_size=None, cache_ttl=None):
+        self.size = size
+        self.pool_size = int(os.getenv('IMAGE_POOL_SIZE') or 2) if pool_size is None else pool_size
+        self.ttl = float(ttl or os.getenv('IMAGE_POOL_TTL') or 2700)
+        self.refill_interval = float(refill_interval or os.getenv('IMAGE_POOL_REFILL_INTERVAL') or 60)
+        self.idle = float(idle or os.getenv('IMAGE_POOL_IDLE') or 3600)
+        self.cache = LRUCache(maxsize=int(cache_size or os.getenv('IMAGE_CACHE_SIZE') or 1000), ttl=float(cache_ttl or os.getenv('IMAGE_CACHE_TTL') or 2700))
+        self.prompts = {self.key(prompt): prompt for prompt in prompts}
+        # (url, created_at), oldest first
+        self.pools = {key: deque() for key in self.prompts}
+        # when each canned prompt was last asked for
+        self.demanded_at = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.model = None
+        self.thread = None
+        self.served = 0
+        self.generated = 0
+
+    def key(self, prompt: str, size=None):
+        return normalize_prompt(prompt), size or self.size
+
+    def take(self, prompt: str, size=None):
+        """
+        Returns an image_generations response for the prompt without
+        calling OpenAI, or None.
+        """
+        key = self.key(prompt, size)
+        pool = self.pools.get(key)
+        if pool is None:
+            return self.cache.get(key)
+        now = time.time()
+        with self.lock:
+            self.demanded_at[key] = now
+            while pool:
+                url, created_at = pool.popleft()
+                if created_at + self.ttl > now:
+                    self.served += 1
+                    self.wakeup.set()
+                    return {'data': [{'url': url}]}
+        self.wakeup.set()
+        return None
+
+    def remember(self, prompt: str, response, size=None):
+        key = self.key(prompt, size)
+        # a canned prompt's users get fresh images instead of a shared one
+        if key not in self.pools:
+            self.cache.set(key, response)
+
+    def ready(self) -> int:
+        with self.lock:
+            return sum(len(pool) for pool in self.pools.values())
+
+    def start(self, model):
+        if self.pool_size <= 0 or not self.pools or self.thread is not None:
+            return
+        self.model = model
+        self.thread = threading.Thread(target=self._run, name='image-pool', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                refilled = self.refill()
+            except Exception as e:
+                logger.error(f'failed to refill image pool: {str(e)}')
+                refilled = False
+            if not refilled:
+                # do not let takes hammer a failing API
+                time.sleep(self.refill_interval)
+            self.wakeup.wait(self.refill_interval)
+
+    def refill(self) -> bool:
+        for key, prompt in self.prompts.items():
+            pool = self.pools[key]
+            while True:
+                now = time.time()
+                with self.lock:
+                    while pool and pool[0][1] + self.ttl <= now:
+                        pool.popleft()
+                    if len(pool) >= self.pool_size or self.demanded_at.get(key, 0) + self.idle <= now:
+                        break
+                is_successful, response, error_message = self.model.image_generations(prompt, key[1], Priority.BULK)
+                if not is_successful:
+                    logger.error(f'failed to refill image pool: {error_message}')
+                    return False
+                with self.lock:
+                    pool.append((response['data'][0]['url'], now))
+                    self.generated += 1
+        return True
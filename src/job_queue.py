@@ -0,0 +1,178 @@
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import zlib
+
+from src.logger import logger
+
+
+class JobAborted(Exception):
+    """
+    Raised by a job function that failed after it changed something, so
+    running it again would repeat those changes. The job is marked failed
+    instead of retried.
+    """
+
+
+class SQLiteJobQueue:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(jobs)')}
+        # queues created before jobs were retried
+        if 'attempts' not in columns:
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN failed_at REAL')
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN last_error TEXT')
+
+    def put_many(self, jobs):
+        now = time.time()
+        ids = []
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                for key, payload in jobs:
+                    cursor = self.conn.execute(
+                        'INSERT INTO jobs (key, payload, created_at) VALUES (?, ?, ?)',
+                        (key, payload, now)
+                    )
+                    ids.append(cursor.lastrowid)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return ids
+
+    def done(self, job_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def retry(self, job_id, attempts, error):
+        with self.lock:
+            self.conn.execute('UPDATE jobs SET attempts = ?, last_error = ? WHERE id = ?', (attempts, error, job_id))
+
+    def fail(self, job_id, attempts, error):
+        """
+        Keeps a job that ran out of attempts for inspection; it is not
+        replayed.
+        """
+        with self.lock:
+            self.conn.execute('UPDATE jobs SET attempts = ?, last_error = ?, failed_at = ? WHERE id = ?', (attempts, error, time.time(), job_id))
+
+    def pending(self):
+        with self.lock:
+            return self.conn.execute('SELECT id, key, payload, attempts FROM jobs WHERE failed_at IS NULL ORDER BY id').fetchall()
+
+    def failed(self):
+        with self.lock:
+            return self.conn.execute('SELECT id, key, payload, attempts, last_error, failed_at FROM jobs WHERE failed_at IS NOT NULL ORDER BY id').fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class JobWorkerPool:
+    """
+    Environment Variables:
+        JOB_MAX_ATTEMPTS
+        JOB_RETRY_BASE
+
+    Drains a SQLiteJobQueue with a fixed number of worker threads.
+    Jobs with the same key always land on the same worker, so they run in
+    the order they were queued while different keys run in parallel.
+    A job that raises is run again after a jittered, doubling delay
+    starting at JOB_RETRY_BASE seconds. It stays at the head of its worker
+    meanwhile, so later jobs of its key never overtake it. After
+    JOB_MAX_ATTEMPTS attempts, or at once when it raises JobAborted, it is
+    marked failed and kept in the queue file.
+    """
+    def __init__(self, job_queue, func, workers=4, max_attempts=None, retry_base=None):
+        self.job_queue = job_queue
+        self.func = func
+        self.workers = max(1, workers)
+        self.max_attempts = int(max_attempts or os.getenv('JOB_MAX_ATTEMPTS') or 3)
+        self.retry_base = float(retry_base or os.getenv('JOB_RETRY_BASE') or 1)
+        self.queues = [queue.Queue() for _ in range(self.workers)]
+        self.threads = []
+        self.retried = 0
+        self.failed = 0
+
+    def _shard(self, key):
+        return zlib.crc32(key.encode('utf-8')) % self.workers
+
+    def _dispatch(self, job_id, key, payload, attempts=0):
+        self.queues[self._shard(key)].put((job_id, key, payload, attempts))
+
+    def _run(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            self._process(*job)
+
+    def _process(self, job_id, key, payload, attempts):
+        while True:
+            try:
+                self.func(payload)
+            except JobAborted as e:
+                self._give_up(job_id, key, attempts + 1, str(e))
+                return
+            except Exception as e:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    self._give_up(job_id, key, attempts, str(e))
+                    return
+                self.retried += 1
+                delay = self.retry_base * 2 ** (attempts - 1) * random.uniform(0.5, 1)
+                logger.error(f'job {job_id} ({key}) failed, attempt {attempts} of {self.max_attempts}, retry in {delay:.1f}s: {str(e)}')
+                self.job_queue.retry(job_id, attempts, str(e))
+                # holds the worker: later jobs of the key must not run first
+                time.sleep(delay)
+                continue
+            self.job_queue.done(job_id)
+            return
+
+    def _give_up(self, job_id, key, attempts, error):
+        self.failed += 1
+        logger.error(f'job {job_id} ({key}) failed after {attempts} attempts, giving up: {error}')
+        self.job_queue.fail(job_id, attempts, error)
+
+    def start(self):
+        for i, jobs in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(jobs,), name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        replayed = self.job_queue.pending()
+        for job_id, key, payload, attempts in replayed:
+            self._dispatch(job_id, key, payload, attempts)
+        if replayed:
+            logger.info(f'replaying {len(replayed)} unfinished jobs')
+
+    def submit(self, jobs):
+        ids = self.job_queue.put_many(jobs)
+        for job_id, (key, payload) in zip(ids, jobs):
+            self._dispatch(job_id, key, payload)
+
+    def depth(self):
+        return sum(jobs.qsize() for jobs in self.queues)
+
+    def stop(self, timeout=None):
+        for jobs in self.queues:
+            jobs.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
@@ -0,0 +1,276 @@
+import asyncio
+import contextvars
+import os
+import re
+import threading
+import time
+
+from src.logger import logger
+from src.models import ModelInterface, OpenAIModel, AsyncOpenAIModel
+from src.rate_limiter import Priority, backoff_delay, get_reply_deadline, is_retryable
+
+
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+# (status_code, error, retry-after) of the last response seen by this call
+last_response = contextvars.ContextVar('last_response', default=None)
+
+
+def parse_reset(value) -> float:
+    """
+    Parses x-ratelimit-reset-* values such as '20ms', '1s' or '6m0s'.
+    """
+    if not value:
+        return 0
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in DURATION_PART.findall(str(value)))
+
+
+def _header_int(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class KeyState:
+    __slots__ = ('limit_requests', 'remaining_requests', 'reset_requests_at',
+                 'limit_tokens', 'remaining_tokens', 'reset_tokens_at',
+                 'inflight', 'failures', 'quarantined_until')
+
+    def __init__(self):
+        self.limit_requests = None
+        self.remaining_requests = None
+        self.reset_requests_at = 0
+        self.limit_tokens = None
+        self.remaining_tokens = None
+        self.reset_tokens_at = 0
+        self.inflight = 0
+        self.failures = 0
+        self.quarantined_until = 0
+
+    def headroom(self, now) -> float:
+        headroom = 1.0
+        if self.limit_requests and now < self.reset_requests_at:
+            headroom = min(headroom, (self.remaining_requests - self.inflight) / self.limit_requests)
+        else:
+            headroom -= self.inflight / (self.limit_requests or 1000)
+        if self.limit_tokens and now < self.reset_tokens_at:
+            headroom = min(headroom, self.remaining_tokens / self.limit_tokens)
+        return headroom
+
+
+class KeyPool:
+    """
+    Environment Variables:
+        KEY_POOL_QUARANTINE
+        KEY_POOL_MAX_QUARANTINE
+        KEY_POOL_INVALID_QUARANTINE
+        OPENAI_MAX_RETRIES
+
+    The default OpenAI keys. pick() returns the key with the most headroom
+    according to the x-ratelimit-* headers of its last responses and the
+    requests in flight. Keys answering 429 are set aside until their limit
+    resets, keys failing repeatedly for an exponentially growing time, and
+    invalid or out-of-quota keys for KEY_POOL_INVALID_QUARANTINE seconds.
+    The models behind the keys do not retry themselves; PooledOpenAIModel
+    retries up to OPENAI_MAX_RETRIES times, moving on to another key.
+    """
+    def __init__(self, api_keys, quarantine=None, max_quarantine=None, invalid_quarantine=None, max_retries=None):
+        self.api_keys = list(dict.fromkeys(api_keys))
+        self.quarantine = float(quarantine or os.getenv('KEY_POOL_QUARANTINE') or 30)
+        self.max_quarantine = float(max_quarantine or os.getenv('KEY_POOL_MAX_QUARANTINE') or 600)
+        self.invalid_quarantine = float(invalid_quarantine or os.getenv('KEY_POOL_INVALID_QUARANTINE') or 3600)
+        self.max_retries = int(os.getenv('OPENAI_MAX_RETRIES') or 4) if max_retries is None else max_retries
+        self.states = {api_key: KeyState() for api_key in self.api_keys}
+        self.models = {api_key: OpenAIModel(api_key, observer=self.observe, max_retries=0) for api_key in self.api_keys}
+        self.async_models = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, api_key):
+        return api_key in self.states
+
+    def __len__(self):
+        return len(self.api_keys)
+
+    def pick(self, exclude=()) -> str:
+        now = time.monotonic()
+        with self.lock:
+            candidates = [api_key for api_key in self.api_keys if api_key not in exclude] or self.api_keys
+            healthy = [api_key for api_key in candidates if self.states[api_key].quarantined_until <= now]
+            if healthy:
+                api_key = max(healthy, key=lambda k: self.states[k].headroom(now))
+            else:
+                # every key is set aside: use the one released first
+                api_key = min(candidates, key=lambda k: self.states[k].quarantined_until)
+            self.states[api_key].inflight += 1
+            return api_key
+
+    def release(self, api_key):
+        with self.lock:
+            self.states[api_key].inflight -= 1
+
+    def is_quarantined(self, api_key) -> bool:
+        return self.states[api_key].quarantined_until > time.monotonic()
+
+    def retry_delay(self, api_key, result, attempt, tried, deadline):
+        """
+        Returns how long to wait before the next attempt of a pooled call,
+        or None when `result` is final.
+        """
+        if result[0] or attempt >= self.max_retries:
+            return None
+        status_code, error, retry_after = last_response.get() or (None, None, None)
+        quarantined = self.is_quarantined(api_key)
+        if not quarantined and status_code is not None and not is_retryable(status_code, error):
+            return None
+        if quarantined and len(tried) < len(self):
+            # another key takes over right away
+            delay = 0
+        else:
+            delay = backoff_delay(attempt, None if quarantined else retry_after)
+        if time.monotonic() + delay > deadline:
+            return None
+        return delay
+
+    def _quarantine(self, api_key, state, seconds, reason):
+        state.quarantined_until = max(state.quarantined_until, time.monotonic() + seconds)
+        logger.info(f'quarantine default key {api_key[:7]}... for {seconds:.0f}s: {reason}')
+
+    def observe(self, api_key, status_code, headers, error):
+        last_response.set((status_code, error, headers.get('retry-after')))
+        now = time.monotonic()
+        with self.lock:
+            state = self.states.get(api_key)
+            if state is None:
+                return
+            limit = _header_int(headers, 'x-ratelimit-limit-requests')
+            remaining = _header_int(headers, 'x-ratelimit-remaining-requests')
+            if limit and remaining is not None:
+                state.limit_requests, state.remaining_requests = limit, remaining
+                state.reset_requests_at = now + parse_reset(headers.get('x-ratelimit-reset-requests'))
+            limit = _header_int(headers, 'x-ratelimit-limit-tokens')
+            remaining = _header_int(headers, 'x-ratelimit-remaining-tokens')
+            if limit and remaining is not None:
+                state.limit_tokens, state.remaining_tokens = limit, remaining
+                state.reset_tokens_at = now + parse_reset(headers.get('x-ratelimit-reset-tokens'))
+            error_type = error.get('type') if isinstance(error, dict) else None
+            if status_code == 401 or error_type == 'insufficient_quota':
+                self._quarantine(api_key, state, self.invalid_quarantine, error_type or 'invalid key')
+            elif status_code == 429:
+                reset = max(parse_reset(headers.get('x-ratelimit-reset-requests')), parse_reset(headers.get('x-ratelimit-reset-tokens')))
+                self._quarantine(api_key, state, min(reset or self.quarantine, self.max_quarantine), 'rate limited')
+            elif status_code is None or status_code >= 500:
+                state.failures += 1
+                if state.failures >= 3:
+                    self._quarantine(api_key, state, min(self.quarantine * 2 ** (state.failures - 3), self.max_quarantine), 'failing')
+            else:
+                state.failures = 0
+
+    def get_async_model(self, api_key) -> AsyncOpenAIModel:
+        model = self.async_models.get(api_key)
+        if model is None:
+            model = self.async_models[api_key] = AsyncOpenAIModel(api_key, observer=self.observe, max_retries=0)
+        return model
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                f'{api_key[:7]}...': {
+                    'headroom': round(state.headroom(now), 3),
+                    'inflight': state.inflight,
+                    'quarantined': state.quarantined_until > now,
+                } for api_key, state in self.states.items()
+            }
+
+
+class PooledOpenAIModel(ModelInterface):
+    """
+    Model used by everyone without their own token. Each attempt is served
+    by the key KeyPool.pick() chooses among those not tried yet; failed
+    attempts are retried with backoff, and at once when their key got
+    quarantined and another one is left.
+    """
+    def __init__(self, pool: KeyPool):
+        self.pool = pool
+        self.api_key = 'default-key-pool'
+
+    @property
+    def key_count(self):
+        return len(self.pool)
+
+    def _call(self, method, *args):
+        deadline = get_reply_deadline()
+        tried = []
+        attempt = 0
+        while True:
+            api_key = self.pool.pick(exclude=tried)
+            last_response.set(None)
+            try:
+                result = getattr(self.pool.models[api_key], method)(*args)
+            finally:
+                self.pool.release(api_key)
+            if api_key not in tried:
+                tried.append(api_key)
+            delay = self.pool.retry_delay(api_key, result, attempt, tried, deadline)
+            if delay is None:
+                return result
+            logger.info(f'retry {method} on the key pool in {delay:.1f}s: {result[2]}')
+            time.sleep(delay)
+            attempt += 1
+
+    def check_token_valid(self):
+        return self._call('check_token_valid')
+
+    def chat_completions(self, messages, model_engine, priority=Priority.INTERACTIVE):
+        return self._call('chat_completions', messages, model_engine, priority)
+
+    def audio_transcriptions(self, file, model_engine):
+        return self._call('audio_transcriptions', file, model_engine)
+
+    def image_generations(self, prompt: str, size: str = '512x512', priority=Priority.INTERACTIVE):
+        return self._call('image_generations', prompt, size, priority)
+
+
+class AsyncPooledOpenAIModel(ModelInterface):
+
+    def __init__(self, pool: KeyPool):
+        self.pool = pool
+        self.api_key = 'default-key-pool'
+
+    @property
+    def key_count(self):
+        return len(self.pool)
+
+    async def _call(self, method, *args):
+        deadline = get_reply_deadline()
+        tried = []
+        attempt = 0
+        while True:
+            api_key = self.pool.pick(exclude=tried)
+            last_response.set(None)
+            try:
+                result = await getattr(self.pool.get_async_model(api_key), method)(*args)
+            finally:
+                self.pool.release(api_key)
+            if api_key not in tried:
+                tried.append(api_key)
+            delay = self.pool.retry_delay(api_key, result, attempt, tried, deadline)
+            if delay is None:
+                return result
+            logger.info(f'retry {method} on the key pool in {delay:.1f}s: {result[2]}')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def check_token_valid(self):
+        return await self._call('check_token_valid')
+
+    async def chat_completions(self, messages, model_engine, priority=Priority.INTERACTIVE):
+        return await self._call('chat_completions', messages, model_engine, priority)
+
+    async def audio_transcriptions(self, file, model_engine):
+        return await self._call('audio_transcriptions', file, model_engine)
+
+    async def image_generations(self, prompt: str, size: str = '512x512', priority=Priority.INTERACTIVE):
+        return await self._call('image_generations', prompt, size, priority)
@@ -1,18 +1,98 @@
+import atexit
+import copy
+import json
 import os
+import queue
+import random
 import logging
 import logging.handlers
+from collections import Counter
 
 class LoggerFactory:
     @staticmethod
-    def create_logger(formatter, handlers):
+    def create_logger(formatter, handlers, queue_handler=None):
         logger = logging.getLogger('chatgpt_logger')
         logger.setLevel(logging.INFO)
         for handler in handlers:
             handler.setLevel(logging.DEBUG)
             handler.setFormatter(formatter)
-            logger.addHandler(handler)
+            if queue_handler is None:
+                logger.addHandler(handler)
+        if queue_handler is not None:
+            logger.addHandler(queue_handler)
         return logger
 
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'payload', None):
+            entry['payload'] = record.payload
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Environment Variables:
+        LOG_QUEUE_SIZE
+        LOG_MAX_PAYLOAD
+        LOG_PAYLOAD_SAMPLE_RATE
+
+    Hands records to the writer thread of a QueueListener, so a slow disk
+    or console never holds up the thread that logs. While the queue is full
+    new records are dropped and counted per level. Messages are cut to
+    LOG_MAX_PAYLOAD characters, and only a LOG_PAYLOAD_SAMPLE_RATE share of
+    payload records (see log_payload) is kept.
+    """
+    def __init__(self, maxsize=None, max_payload=None, sample_rate=None):
+        super().__init__(queue.Queue(int(maxsize or os.getenv('LOG_QUEUE_SIZE') or 10000)))
+        self.max_payload = int(max_payload or os.getenv('LOG_MAX_PAYLOAD') or 1000)
+        sample_rate = os.getenv('LOG_PAYLOAD_SAMPLE_RATE') if sample_rate is None else sample_rate
+        self.sample_rate = float(1 if sample_rate in (None, '') else sample_rate)
+        self.dropped = Counter()
+        self.sampled_out = 0
+
+    def prepare(self, record):
+        message = record.getMessage()
+        if len(message) > self.max_payload:
+            message = f'{message[:self.max_payload]}... ({len(message) - self.max_payload} more characters)'
+        record = copy.copy(record)
+        record.message = message
+        record.msg = message
+        record.args = None
+        # tracebacks are rendered here; the frames must not outlive the call
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        if getattr(record, 'payload', None) and self.sample_rate < 1 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.dropped[record.levelname] += 1
+        except Exception:
+            self.handleError(record)
+
+
+class LogWriter(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        # wait for room rather than losing the records still queued at exit
+        self.queue.put(self._sentinel)
+
+
 rotate_handler = logging.handlers.RotatingFileHandler("output.log", maxBytes=1000000, backupCount=5)
 
 class ConsoleHandler(logging.StreamHandler):
@@ -22,4 +102,19 @@ class ConsoleHandler(logging.StreamHandler):
 formatter = "%(asctime)s [%(levelname)s] %(message)s"
 # file_handler = FileHandler('./logs')
 console_handler = ConsoleHandler()
-logger = LoggerFactory.create_logger(logging.Formatter(formatter), [rotate_handler, console_handler])
+queue_handler = BoundedQueueHandler()
+logger = LoggerFactory.create_logger(
+    logging.Formatter(formatter) if os.getenv('LOG_FORMAT') == 'text' else JSONFormatter(),
+    [rotate_handler, console_handler],
+    queue_handler,
+)
+log_writer = LogWriter(queue_handler.queue, rotate_handler, console_handler, respect_handler_level=True)
+log_writer.start()
+atexit.register(log_writer.stop)
+
+
+def log_payload(name: str, payload: str):
+    """
+    Logs a request body, model response or other large text under `name`.
+    """
+    logger.info('%s: %s', name, payload, extra={'payload': name})
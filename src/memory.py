@@ -1,5 +1,15 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict
-from collections import defaultdict
+
+from src.logger import logger
+from src.tokenizer import count_tokens, get_token_budget, MESSAGE_TOKEN_OVERHEAD
+
+
+SUMMARY_MESSAGE_FORMAT = "これまでの会話の要約：\n{}"
 
 
 class MemoryInterface:
@@ -13,38 +23,346 @@ class MemoryInterface:
         pass
 
 
+class Message:
+    __slots__ = ('role', 'content', 'size', 'tokens')
+
+    def __init__(self, role: str, content: str):
+        self.role = sys.intern(role)
+        self.content = content
+        self.size = len(content.encode('utf-8'))
+        self.tokens = count_tokens(content) + MESSAGE_TOKEN_OVERHEAD
+
+    def to_dict(self) -> Dict:
+        return {'role': self.role, 'content': self.content}
+
+
+class Conversation:
+    __slots__ = ('messages', 'size', 'last_access', 'summary', 'dropped', 'folding')
+
+    def __init__(self):
+        self.messages = []
+        self.size = 0
+        self.last_access = time.monotonic()
+        self.summary = None
+        self.dropped = None
+        self.folding = False
+
+
+class MemoryShard:
+    __slots__ = ('storage', 'system_messages', 'total_bytes', 'lock')
+
+    def __init__(self):
+        # plain dict kept in LRU order: the oldest entry is first
+        self.storage = {}
+        self.system_messages = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+
 class Memory(MemoryInterface):
-    def __init__(self, system_message, memory_message_count):
-        self.storage = defaultdict(list)
-        self.system_messages = defaultdict(str)
+    """
+    Environment Variables:
+        MEMORY_MAX_USERS
+        MEMORY_MAX_BYTES
+        MEMORY_IDLE_TTL
+        MEMORY_TOKEN_BUDGET
+        MEMORY_SHARDS
+
+    Users are striped over MEMORY_SHARDS shards, each with its own lock,
+    LRU order and share of the user and byte limits. Every read-modify-write
+    of one user's history happens under its shard's lock.
+
+    `summarizer(user_id, summary, messages)` is called in the background to
+    fold turns that no longer fit the token budget into a rolling summary,
+    once at least `fold_batch` messages have overflowed.
+    It returns the new summary text, or None to keep the old one.
+    """
+    def __init__(self, system_message, memory_message_count, max_users=None, max_bytes=None, idle_ttl=None, model_engine=None, summarizer=None, shards=None):
+        self.shards = [MemoryShard() for _ in range(int(shards or os.getenv('MEMORY_SHARDS') or 16))]
         self.default_system_message = system_message
         self.memory_message_count = memory_message_count
+        self.max_users = int(max_users or os.getenv('MEMORY_MAX_USERS') or 100000)
+        self.max_bytes = int(max_bytes or os.getenv('MEMORY_MAX_BYTES') or 256 * 1024 * 1024)
+        self.idle_ttl = float(idle_ttl or os.getenv('MEMORY_IDLE_TTL') or 86400)
+        self.shard_max_users = max(1, -(-self.max_users // len(self.shards)))
+        self.shard_max_bytes = max(1, self.max_bytes // len(self.shards))
+        self.model_engine = model_engine
+        self.summarizer = summarizer
+        self.fold_batch = max(2, memory_message_count)
+        self.summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='memory-summary')
+
+    conversation_class = Conversation
+
+    def _touched(self, user_id: str, conversation: Conversation, message: Message = None):
+        """
+        Called under the shard lock after a message was appended (`message`)
+        or the summary changed. Subclasses persist the change from here.
+        """
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(shard.total_bytes for shard in self.shards)
 
-    def _initialize(self, user_id: str):
-        self.storage[user_id] = [{
-            'role': 'system', 'content': self.system_messages.get(user_id) or self.default_system_message
-        }]
+    def __len__(self):
+        return sum(len(shard.storage) for shard in self.shards)
 
-    def _drop_message(self, user_id: str):
-        if len(self.storage.get(user_id)) >= (self.memory_message_count + 1) * 2 + 1:
-            return [self.storage[user_id][0]] + self.storage[user_id][-(self.memory_message_count * 2):]
-        return self.storage.get(user_id)
+    def _shard(self, user_id: str) -> MemoryShard:
+        return self.shards[hash(user_id) % len(self.shards)]
+
+    def _system_message(self, shard: MemoryShard, user_id: str) -> Message:
+        return Message('system', shard.system_messages.get(user_id) or self.default_system_message or '')
+
+    def _evict(self, shard: MemoryShard):
+        deadline = time.monotonic() - self.idle_ttl
+        while shard.storage:
+            user_id = next(iter(shard.storage))
+            conversation = shard.storage[user_id]
+            if len(shard.storage) <= self.shard_max_users and shard.total_bytes <= self.shard_max_bytes and conversation.last_access >= deadline:
+                break
+            self._pop(shard, user_id)
+
+    def _pop(self, shard: MemoryShard, user_id: str):
+        conversation = shard.storage.pop(user_id, None)
+        if conversation is not None:
+            shard.total_bytes -= conversation.size
+
+    def _fold(self, user_id: str, conversation: Conversation, messages):
+        summary = conversation.summary.content if conversation.summary else None
+        try:
+            new_summary = self.summarizer(user_id, summary, [message.to_dict() for message in messages])
+        except Exception as e:
+            logger.error(f'failed to summarize history of {user_id}: {str(e)}')
+            new_summary = None
+        shard = self._shard(user_id)
+        with shard.lock:
+            conversation.folding = False
+            if not new_summary or shard.storage.get(user_id) is not conversation:
+                return
+            message = Message('system', new_summary)
+            if conversation.summary:
+                conversation.size -= conversation.summary.size
+                shard.total_bytes -= conversation.summary.size
+            conversation.summary = message
+            conversation.size += message.size
+            shard.total_bytes += message.size
+            for folded in messages:
+                if conversation.dropped and conversation.dropped[0] is folded:
+                    conversation.dropped.pop(0)
+                elif conversation.messages and conversation.messages[0] is folded:
+                    conversation.messages.pop(0)
+                    conversation.size -= folded.size
+                    shard.total_bytes -= folded.size
+            self._touched(user_id, conversation)
 
     def change_system_message(self, user_id, system_message):
-        self.system_messages[user_id] = system_message
-        self.remove(user_id)
+        shard = self._shard(user_id)
+        with shard.lock:
+            shard.system_messages[user_id] = system_message
+            self._pop(shard, user_id)
 
     def append(self, user_id: str, role: str, content: str) -> None:
-        if self.storage[user_id] == []:
-            self._initialize(user_id)
-        self.storage[user_id].append({
-            'role': role,
-            'content': content
-        })
-        self._drop_message(user_id)
+        message = Message(role, content)
+        shard = self._shard(user_id)
+        with shard.lock:
+            conversation = shard.storage.pop(user_id, None) or self.conversation_class()
+            shard.storage[user_id] = conversation
+            conversation.messages.append(message)
+            conversation.size += message.size
+            shard.total_bytes += message.size
+            while len(conversation.messages) > self.memory_message_count * 2:
+                dropped = conversation.messages.pop(0)
+                conversation.size -= dropped.size
+                shard.total_bytes -= dropped.size
+                if self.summarizer:
+                    conversation.dropped = ((conversation.dropped or []) + [dropped])[-self.memory_message_count * 2:]
+            conversation.last_access = time.monotonic()
+            self._touched(user_id, conversation, message)
+            self._evict(shard)
 
-    def get(self, user_id: str) -> str:
-        return self.storage[user_id]
+    def get(self, user_id: str, model_engine: str = None) -> str:
+        budget = get_token_budget(model_engine or self.model_engine)
+        shard = self._shard(user_id)
+        with shard.lock:
+            conversation = shard.storage.pop(user_id, None)
+            if conversation is None:
+                return []
+            shard.storage[user_id] = conversation
+            conversation.last_access = time.monotonic()
+            head = [self._system_message(shard, user_id)]
+            if conversation.summary:
+                head.append(Message('system', SUMMARY_MESSAGE_FORMAT.format(conversation.summary.content)))
+            used = sum(message.tokens for message in head)
+            kept = []
+            for message in reversed(conversation.messages):
+                if kept and used + message.tokens > budget:
+                    break
+                used += message.tokens
+                kept.append(message)
+            kept.reverse()
+            overflow = (conversation.dropped or []) + conversation.messages[:len(conversation.messages) - len(kept)]
+            if len(overflow) >= self.fold_batch and self.summarizer and not conversation.folding:
+                conversation.folding = True
+                self.summary_executor.submit(self._fold, user_id, conversation, overflow)
+        return [message.to_dict() for message in head + kept]
 
     def remove(self, user_id: str) -> None:
-        self.storage[user_id] = []
+        shard = self._shard(user_id)
+        with shard.lock:
+            self._pop(shard, user_id)
+
+
+class SyncedConversation(Conversation):
+    __slots__ = ('version', 'synced_at', 'pending')
+
+    def __init__(self):
+        super().__init__()
+        self.version = 0
+        self.synced_at = 0
+        self.pending = None
+
+
+class PersistentMemory(Memory):
+    """
+    Environment Variables:
+        MEMORY_FLUSH_INTERVAL
+        MEMORY_CACHE_TTL
+
+    Memory backed by a shared conversation backend so several processes or
+    nodes can serve the same users. The in-process shards are a hot cache
+    trusted for MEMORY_CACHE_TTL seconds after the last sync. Appends are
+    written behind in batches every MEMORY_FLUSH_INTERVAL seconds with a
+    version check; when another node wrote the user first, its copy is
+    loaded and the local appends are replayed on top of it. Clearing the
+    history or changing the system message is written through.
+    """
+    conversation_class = SyncedConversation
+
+    def __init__(self, backend, system_message, memory_message_count, flush_interval=None, cache_ttl=None, **kwargs):
+        super().__init__(system_message, memory_message_count, **kwargs)
+        self.backend = backend
+        self.flush_interval = float(flush_interval or os.getenv('MEMORY_FLUSH_INTERVAL') or 1)
+        self.cache_ttl = float(cache_ttl or os.getenv('MEMORY_CACHE_TTL') or 30)
+        # user_id -> conversation to write, kept even if it gets evicted
+        self.dirty = {}
+        self.dirty_lock = threading.Lock()
+        self.conflicts = 0
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def _touched(self, user_id, conversation, message=None):
+        if message is not None:
+            conversation.pending = (conversation.pending or []) + [message]
+        with self.dirty_lock:
+            self.dirty[user_id] = conversation
+
+    def _document(self, shard, user_id, conversation):
+        return {
+            'messages': [[message.role, message.content] for message in conversation.messages],
+            'summary': conversation.summary.content if conversation.summary else None,
+            'system_message': shard.system_messages.get(user_id),
+        }
+
+    def _restore(self, shard, user_id, conversation, document, version):
+        """
+        Replaces the conversation with the stored document plus the local
+        appends that are not stored yet. Called under the shard lock.
+        """
+        document = document or {}
+        messages = [Message(role, content) for role, content in document.get('messages', [])]
+        messages = (messages + (conversation.pending or []))[-self.memory_message_count * 2:]
+        summary = Message('system', document['summary']) if document.get('summary') else None
+        size = sum(message.size for message in messages) + (summary.size if summary else 0)
+        if shard.storage.get(user_id) is conversation:
+            shard.total_bytes += size - conversation.size
+        conversation.messages = messages
+        conversation.summary = summary
+        conversation.size = size
+        conversation.version = version
+        conversation.synced_at = time.monotonic()
+        if document.get('system_message'):
+            shard.system_messages[user_id] = document['system_message']
+
+    def _hydrate(self, user_id: str):
+        shard = self._shard(user_id)
+        with shard.lock:
+            conversation = shard.storage.get(user_id)
+            if conversation is not None and conversation.synced_at + self.cache_ttl > time.monotonic():
+                return
+        started = time.monotonic()
+        document, version = self.backend.load(user_id)
+        with shard.lock:
+            conversation = shard.storage.get(user_id)
+            if conversation is None:
+                conversation = self.conversation_class()
+                shard.storage[user_id] = conversation
+            elif conversation.synced_at >= started or conversation.version > version:
+                return
+            self._restore(shard, user_id, conversation, document, version)
+            self._evict(shard)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f'failed to flush conversations: {str(e)}')
+
+    def flush(self):
+        with self.dirty_lock:
+            dirty, self.dirty = self.dirty, {}
+        if not dirty:
+            return
+        items = []
+        for user_id, conversation in dirty.items():
+            shard = self._shard(user_id)
+            with shard.lock:
+                items.append((user_id, conversation, self._document(shard, user_id, conversation), conversation.version, len(conversation.pending or [])))
+        try:
+            conflicts = set(self.backend.save_many([(user_id, document, version) for user_id, _, document, version, _ in items]))
+        except Exception:
+            with self.dirty_lock:
+                for user_id, conversation in dirty.items():
+                    self.dirty.setdefault(user_id, conversation)
+            raise
+        for user_id, conversation, _, version, written in items:
+            shard = self._shard(user_id)
+            if user_id in conflicts:
+                self.conflicts += 1
+                document, version = self.backend.load(user_id)
+                with shard.lock:
+                    self._restore(shard, user_id, conversation, document, version)
+                    self._touched(user_id, conversation)
+                continue
+            with shard.lock:
+                conversation.version = version + 1
+                conversation.synced_at = time.monotonic()
+                conversation.pending = conversation.pending[written:] or None if conversation.pending else None
+
+    def _reset(self, user_id: str, system_message: str = None):
+        with self.dirty_lock:
+            self.dirty.pop(user_id, None)
+        self.backend.reset(user_id, system_message)
+
+    def append(self, user_id: str, role: str, content: str) -> None:
+        self._hydrate(user_id)
+        super().append(user_id, role, content)
+
+    def get(self, user_id: str, model_engine: str = None) -> str:
+        self._hydrate(user_id)
+        return super().get(user_id, model_engine)
+
+    def change_system_message(self, user_id, system_message):
+        super().change_system_message(user_id, system_message)
+        self._reset(user_id, system_message)
+
+    def remove(self, user_id: str) -> None:
+        super().remove(user_id)
+        shard = self._shard(user_id)
+        with shard.lock:
+            system_message = shard.system_messages.get(user_id)
+        self._reset(user_id, system_message)
+
+    def stats(self):
+        with self.dirty_lock:
+            dirty = len(self.dirty)
+        return {'users': len(self), 'dirty': dirty, 'conflicts': self.conflicts}
@@ -0,0 +1,145 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels(labels) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms in the Prometheus text format.
+
+    Every thread writes only to its own dicts, so recording takes no lock;
+    render() sums the per-thread values. Gauges that are cheaper to read
+    than to track (queue depth, cache stats) are registered as callbacks.
+    """
+    def __init__(self, prefix='line_bot', buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.local = threading.local()
+        # (thread, (counters, histograms)); shards of finished threads are
+        # folded into `retired` so short-lived pool threads do not pile up
+        self.shards = []
+        self.retired = ({}, {})
+        self.callbacks = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = ({}, {})
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    @staticmethod
+    def _merge(target, shard):
+        counters, histograms = target
+        for key, value in list(shard[0].items()):
+            counters[key] = counters.get(key, 0) + value
+        for key, (buckets, total) in list(shard[1].items()):
+            merged = histograms.setdefault(key, [[0] * len(buckets), 0.0])
+            merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+            merged[1] += total
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        counters = self._shard()[0]
+        key = (name, _labels(labels))
+        counters[key] = counters.get(key, 0) + value
+
+    def dec(self, name, value=1, **labels):
+        self.inc(name, -value, **labels)
+
+    def observe(self, name, value, **labels):
+        histograms = self._shard()[1]
+        key = (name, _labels(labels))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        histogram[0][bisect_left(self.buckets, value)] += 1
+        histogram[1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def register(self, name, callback):
+        """
+        `callback()` returns a number, or a list of (labels dict, number)
+        pairs.
+        """
+        self.callbacks[name] = callback
+
+    def _collect(self):
+        with self.lock:
+            alive = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._merge(self.retired, shard)
+            self.shards = alive
+            total = ({}, {})
+            self._merge(total, self.retired)
+        for _, shard in alive:
+            self._merge(total, shard)
+        return total
+
+    def render(self) -> str:
+        counters, histograms = self._collect()
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            if name in self.help:
+                lines.append(f'# HELP {self.prefix}_{name} {self.help[name]}')
+            lines.append(f'# TYPE {self.prefix}_{name} {kind}')
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter' if name.endswith('_total') else 'gauge')
+            lines.append(f'{self.prefix}_{name}{_format_labels(labels)} {value}')
+        for (name, labels), (buckets, total) in sorted(histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), buckets):
+                cumulative += count
+                lines.append(f'{self.prefix}_{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.prefix}_{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{self.prefix}_{name}_count{_format_labels(labels)} {cumulative}')
+        for name, callback in sorted(self.callbacks.items()):
+            try:
+                value = callback()
+            except Exception:
+                continue
+            header(name, 'counter' if name.endswith('_total') else 'gauge')
+            samples = value if isinstance(value, list) else [({}, value)]
+            for labels, sample in samples:
+                lines.append(f'{self.prefix}_{name}{_format_labels(_labels(labels))} {sample}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -1,9 +1,26 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
 from enum import Enum
 from typing import List, Dict
-import requests
+
+from src.cache import LRUCache
+from src.http_client import http_client, async_http_client
+from src.logger import logger
+from src.metrics import metrics
+from src.rate_limiter import rate_limiter, Priority, RATE_LIMITED_ERROR_MESSAGE, get_reply_deadline, is_retryable, backoff_delay
+from src.tokenizer import count_tokens, MESSAGE_TOKEN_OVERHEAD
+
+
+UNSTABLE_ERROR_MESSAGE = 'OpenAI API システムが不安定なため、後で再試行してください。'
 
 
 class ModelInterface:
+    # number of API keys behind the model; in-flight limits are per key
+    key_count = 1
+
     def check_token_valid(self) -> bool:
         pass
 
@@ -13,7 +30,7 @@ class ModelInterface:
     def audio_transcriptions(self, file, model_engine: str) -> str:
         pass
 
-    def image_generations(self, prompt: str) -> str:
+    def image_generations(self, prompt: str, size: str = '512x512', priority=Priority.INTERACTIVE) -> str:
         pass
 
 
@@ -24,60 +41,264 @@ class OpenAIModelCmd(Enum):
     SET_IMAGE_PROMPT = 4
     SET_SUMMARIZE_URL = 5
 class OpenAIModel(ModelInterface):
+    """
+    Environment Variables:
+        OPENAI_API_BASE
+        OPENAI_MAX_RETRIES
+        OPENAI_COMPLETION_TOKEN_ESTIMATE
 
-    def __init__(self, api_key: str):
+    Calls go through the shared rate limiter, and 429, 5xx and overloaded
+    errors are retried with backoff until the reply deadline.
+    `observer(api_key, status_code, headers, error)` is called after every
+    attempt; status_code is None when the request itself failed.
+    """
+    def __init__(self, api_key: str, observer=None, max_retries=None):
         self.api_key = api_key
-        self.base_url = 'https://api.openai.com/v1'
-        self.cmd = OpenAIModelCmd.NONE
+        self.base_url = (os.getenv('OPENAI_API_BASE') or 'https://api.openai.com/v1').rstrip('/')
+        self.max_retries = int(os.getenv('OPENAI_MAX_RETRIES') or 4) if max_retries is None else max_retries
+        self.observer = observer
+
+    def _observe(self, status_code, headers, error):
+        if self.observer is not None:
+            self.observer(self.api_key, status_code, headers, error)
+
+    def _request(self, method, endpoint, body=None, files=None, kind=None, tokens=0, priority=Priority.INTERACTIVE):
+        with metrics.timer('stage_seconds', stage='openai', endpoint=endpoint):
+            return self._send(method, endpoint, body, files, kind, tokens, priority)
 
-    def _request(self, method, endpoint, body=None, files=None):
-        self.headers = {
+    def _send(self, method, endpoint, body, files, kind, tokens, priority):
+        headers = {
             'Authorization': f'Bearer {self.api_key}'
         }
-        try:
-            if method == 'GET':
-                r = requests.get(f'{self.base_url}{endpoint}', headers=self.headers)
-            elif method == 'POST':
-                if body:
-                    self.headers['Content-Type'] = 'application/json'
-                r = requests.post(f'{self.base_url}{endpoint}', headers=self.headers, json=body, files=files)
-            r = r.json()
-            if r.get('error'):
-                return False, None, r.get('error', {}).get('message')
-        except Exception:
-            return False, None, 'OpenAI API システムが不安定なため、後で再試行してください。'
-        return True, r, None
+        deadline = get_reply_deadline()
+        attempt = 0
+        while True:
+            if kind and not rate_limiter.acquire(self.api_key, kind, tokens, priority, deadline):
+                return False, None, RATE_LIMITED_ERROR_MESSAGE
+            status_code = None
+            retry_after = None
+            try:
+                if method == 'GET':
+                    r = http_client.request('GET', f'{self.base_url}{endpoint}', headers=headers)
+                elif method == 'POST':
+                    if body:
+                        headers['Content-Type'] = 'application/json'
+                    # an earlier attempt or key may have read the file already
+                    for value in (files or {}).values():
+                        if hasattr(value[1], 'seek'):
+                            value[1].seek(0)
+                    r = http_client.request('POST', f'{self.base_url}{endpoint}', headers=headers, json=body, files=files)
+                status_code = r.status_code
+                response_headers = r.headers
+                retry_after = response_headers.get('retry-after')
+                r = r.json()
+                error = r.get('error')
+                self._observe(status_code, response_headers, error)
+                if not error:
+                    return True, r, None
+                error_message = error.get('message')
+                if not is_retryable(status_code, error):
+                    return False, None, error_message
+            except Exception:
+                if status_code is None:
+                    self._observe(None, {}, None)
+                error_message = UNSTABLE_ERROR_MESSAGE
+            if kind and status_code == 429:
+                rate_limiter.penalize(self.api_key, kind)
+            delay = backoff_delay(attempt, retry_after)
+            if not kind or attempt >= self.max_retries or time.monotonic() + delay > deadline:
+                return False, None, error_message
+            logger.info(f'retry {endpoint} in {delay:.1f}s: {error_message}')
+            time.sleep(delay)
+            attempt += 1
 
     def check_token_valid(self):
         return self._request('GET', '/models')
 
-    def chat_completions(self, messages, model_engine) -> str:
+    def check_token_status(self):
+        """
+        Returns the HTTP status code of GET /models and its error object;
+        the status code is None when the request itself failed.
+        """
+        try:
+            with metrics.timer('stage_seconds', stage='openai', endpoint='/models'):
+                r = http_client.request('GET', f'{self.base_url}/models', headers={'Authorization': f'Bearer {self.api_key}'})
+        except Exception:
+            self._observe(None, {}, None)
+            return None, None
+        try:
+            error = r.json().get('error')
+        except ValueError:
+            error = None
+        self._observe(r.status_code, r.headers, error)
+        return r.status_code, error
+
+    def chat_completions(self, messages, model_engine, priority=Priority.INTERACTIVE) -> str:
         json_body = {
             'model': model_engine,
             'messages': messages,
             'temperature': 0.5,
         }
-        return self._request('POST', '/chat/completions', body=json_body)
+        return self._request('POST', '/chat/completions', body=json_body, kind='chat', tokens=estimate_tokens(messages, model_engine), priority=priority)
 
-    def audio_transcriptions(self, file_path, model_engine) -> str:
+    def audio_transcriptions(self, file, model_engine) -> str:
         files = {
-            'file': open(file_path, 'rb'),
+            'file': ('audio.m4a', file),
             'model': (None, model_engine),
         }
-        return self._request('POST', '/audio/transcriptions', files=files)
+        return self._request('POST', '/audio/transcriptions', files=files, kind='audio')
+
+    def image_generations(self, prompt: str, size: str = '512x512', priority=Priority.INTERACTIVE) -> str:
+        json_body = {
+            "prompt": prompt,
+            "n": 1,
+            "size": size
+        }
+        return self._request('POST', '/images/generations', body=json_body, kind='images', priority=priority)
+
+
+class AsyncOpenAIModel(ModelInterface):
+
+    def __init__(self, api_key: str, observer=None, max_retries=None):
+        self.api_key = api_key
+        self.base_url = (os.getenv('OPENAI_API_BASE') or 'https://api.openai.com/v1').rstrip('/')
+        self.max_retries = int(os.getenv('OPENAI_MAX_RETRIES') or 4) if max_retries is None else max_retries
+        self.observer = observer
+
+    def _observe(self, status_code, headers, error):
+        if self.observer is not None:
+            self.observer(self.api_key, status_code, headers, error)
+
+    async def _request(self, method, endpoint, body=None, data=None, kind=None, tokens=0, priority=Priority.INTERACTIVE):
+        with metrics.timer('stage_seconds', stage='openai', endpoint=endpoint):
+            return await self._send(method, endpoint, body, data, kind, tokens, priority)
+
+    async def _send(self, method, endpoint, body, data, kind, tokens, priority):
+        headers = {
+            'Authorization': f'Bearer {self.api_key}'
+        }
+        deadline = get_reply_deadline()
+        attempt = 0
+        while True:
+            if kind and not await rate_limiter.acquire_async(self.api_key, kind, tokens, priority, deadline):
+                return False, None, RATE_LIMITED_ERROR_MESSAGE
+            status_code = None
+            retry_after = None
+            try:
+                # form data cannot be sent twice, so it is passed as a factory
+                async with async_http_client.request(method, f'{self.base_url}{endpoint}', headers=headers, json=body, data=data() if callable(data) else data) as r:
+                    status_code = r.status
+                    response_headers = r.headers
+                    retry_after = response_headers.get('retry-after')
+                    r = await r.json(content_type=None)
+                error = r.get('error')
+                self._observe(status_code, response_headers, error)
+                if not error:
+                    return True, r, None
+                error_message = error.get('message')
+                if not is_retryable(status_code, error):
+                    return False, None, error_message
+            except Exception:
+                if status_code is None:
+                    self._observe(None, {}, None)
+                error_message = UNSTABLE_ERROR_MESSAGE
+            if kind and status_code == 429:
+                rate_limiter.penalize(self.api_key, kind)
+            delay = backoff_delay(attempt, retry_after)
+            if not kind or attempt >= self.max_retries or time.monotonic() + delay > deadline:
+                return False, None, error_message
+            logger.info(f'retry {endpoint} in {delay:.1f}s: {error_message}')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def check_token_valid(self):
+        return await self._request('GET', '/models')
+
+    async def chat_completions(self, messages, model_engine, priority=Priority.INTERACTIVE) -> str:
+        json_body = {
+            'model': model_engine,
+            'messages': messages,
+            'temperature': 0.5,
+        }
+        return await self._request('POST', '/chat/completions', body=json_body, kind='chat', tokens=estimate_tokens(messages, model_engine), priority=priority)
 
-    def image_generations(self, prompt: str) -> str:
+    async def audio_transcriptions(self, file, model_engine) -> str:
+        import aiohttp
+
+        def build_form():
+            data = aiohttp.FormData()
+            data.add_field('file', file, filename='audio.m4a')
+            data.add_field('model', model_engine)
+            return data
+        return await self._request('POST', '/audio/transcriptions', data=build_form, kind='audio')
+
+    async def image_generations(self, prompt: str, size: str = '512x512', priority=Priority.INTERACTIVE) -> str:
         json_body = {
             "prompt": prompt,
             "n": 1,
-            "size": "512x512"
+            "size": size
         }
-        return self._request('POST', '/images/generations', body=json_body)
-
-    def set_command(self, cmd: OpenAIModelCmd):
-        self.cmd = cmd
-    
-    def pop_command(self) -> OpenAIModelCmd:
-        cmd = self.cmd
-        self.cmd = OpenAIModelCmd.NONE
-        return cmd
\ No newline at end of file
+        return await self._request('POST', '/images/generations', body=json_body, kind='images', priority=priority)
+
+
+def estimate_tokens(messages, model_engine=None) -> int:
+    prompt_tokens = sum(count_tokens(message['content'], model_engine) + MESSAGE_TOKEN_OVERHEAD for message in messages)
+    return prompt_tokens + int(os.getenv('OPENAI_COMPLETION_TOKEN_ESTIMATE') or 256)
+
+
+class TokenValidationCache:
+    """
+    Remembers check_token_valid() results by a hash of the API key. Valid
+    keys are trusted for TOKEN_VALIDATION_TTL seconds and then revalidated
+    in the background; keys rejected with 401 / invalid_api_key are
+    remembered for TOKEN_VALIDATION_NEGATIVE_TTL seconds. Rate limits,
+    server and transport errors are not cached.
+    """
+    def __init__(self, ttl=None, negative_ttl=None, maxsize=10000):
+        self.ttl = float(ttl or os.getenv('TOKEN_VALIDATION_TTL') or 3600)
+        self.negative_ttl = float(negative_ttl or os.getenv('TOKEN_VALIDATION_NEGATIVE_TTL') or 300)
+        self.entries = LRUCache(maxsize=maxsize)
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+    def _check(self, key, model: OpenAIModel):
+        status_code, error = model.check_token_status()
+        code = error.get('code') if isinstance(error, dict) else None
+        if status_code == 200 and not error:
+            self.entries.set(key, (True, time.time()))
+            return True
+        if status_code == 401 or code == 'invalid_api_key':
+            self.entries.set(key, (False, time.time()))
+            return False
+        # rate limited: the key authenticated; other failures say nothing
+        return status_code == 429 and code != 'insufficient_quota'
+
+    def _revalidate(self, key, model: OpenAIModel):
+        try:
+            self._check(key, model)
+        except Exception as e:
+            logger.error(f'failed to revalidate token: {str(e)}')
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def is_valid(self, model: OpenAIModel) -> bool:
+        key = self._key(model.api_key)
+        entry = self.entries.get(key)
+        if entry is None:
+            return self._check(key, model)
+        is_valid, checked_at = entry
+        age = time.time() - checked_at
+        if not is_valid:
+            return False if age < self.negative_ttl else self._check(key, model)
+        if age >= self.ttl:
+            with self.lock:
+                stale = key not in self.refreshing
+                self.refreshing.add(key)
+            if stale:
+                threading.Thread(target=self._revalidate, args=(key, model), daemon=True).start()
+        return True
\ No newline at end of file
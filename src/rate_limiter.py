@@ -0,0 +1,185 @@
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from enum import Enum
+
+from src.cache import LRUCache
+
+
+RATE_LIMITED_ERROR_MESSAGE = '同時使用人数を超えました。しばらく待ってからお試しください。'
+
+# monotonic time by which the current LINE reply has to be sent
+reply_deadline = contextvars.ContextVar('reply_deadline', default=None)
+
+
+class Priority(Enum):
+    INTERACTIVE = 1
+    BULK = 2
+
+
+def set_reply_deadline(timestamp_ms=None):
+    """
+    Starts the retry budget of the current event from its webhook
+    timestamp (milliseconds), or from now when it is unknown.
+    """
+    seconds = float(os.getenv('LINE_REPLY_DEADLINE') or 50)
+    if timestamp_ms:
+        seconds -= time.time() - timestamp_ms / 1000
+    reply_deadline.set(time.monotonic() + seconds)
+
+
+def get_reply_deadline() -> float:
+    deadline = reply_deadline.get()
+    if deadline is None:
+        deadline = time.monotonic() + float(os.getenv('LINE_REPLY_DEADLINE') or 50)
+    return deadline
+
+
+def is_retryable(status_code, error) -> bool:
+    if isinstance(error, dict) and error.get('type') == 'insufficient_quota':
+        return False
+    message = str(error.get('message') if isinstance(error, dict) else error or '')
+    return status_code == 429 or (status_code or 0) >= 500 or 'overloaded' in message
+
+
+def backoff_delay(attempt: int, retry_after=None) -> float:
+    """
+    Full-jitter exponential backoff, but never earlier than Retry-After.
+    """
+    base = float(os.getenv('OPENAI_RETRY_BASE') or 0.5)
+    cap = float(os.getenv('OPENAI_RETRY_MAX_DELAY') or 8)
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    try:
+        return max(delay, float(retry_after))
+    except (TypeError, ValueError):
+        return delay
+
+
+class TokenBucket:
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now) -> float:
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def drain(self):
+        self.tokens = min(self.tokens, 0)
+
+
+class RateLimiter:
+    """
+    Environment Variables:
+        OPENAI_RPM
+        OPENAI_TPM
+        OPENAI_IMAGE_RPM
+        OPENAI_AUDIO_RPM
+
+    Token buckets per API key and kind of call ('chat', 'images', 'audio').
+    Chat calls are also limited by tokens per minute. While an interactive
+    call waits for a key, bulk calls for the same key hold back.
+    """
+    def __init__(self, rpm=None, tpm=None, image_rpm=None, audio_rpm=None, maxsize=10000):
+        self.rpm = {
+            'chat': float(rpm or os.getenv('OPENAI_RPM') or 3500),
+            'images': float(image_rpm or os.getenv('OPENAI_IMAGE_RPM') or 50),
+            'audio': float(audio_rpm or os.getenv('OPENAI_AUDIO_RPM') or 50),
+        }
+        self.tpm = float(tpm or os.getenv('OPENAI_TPM') or 90000)
+        self.buckets = LRUCache(maxsize=maxsize)
+        self.interactive_waiting = {}
+        self.lock = threading.Lock()
+
+    def _buckets(self, api_key, kind):
+        buckets = self.buckets.get((api_key, kind))
+        if buckets is None:
+            buckets = (TokenBucket(self.rpm[kind]), TokenBucket(self.tpm) if kind == 'chat' else None)
+            self.buckets.set((api_key, kind), buckets)
+        return buckets
+
+    def try_acquire(self, api_key, kind, tokens=0, priority=Priority.INTERACTIVE) -> float:
+        """
+        Takes capacity and returns 0, or returns how long to wait first.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if priority == Priority.BULK and self.interactive_waiting.get(api_key):
+                return 0.05
+            requests, token_bucket = self._buckets(api_key, kind)
+            wait = requests.wait_time(1, now)
+            if token_bucket is not None:
+                wait = max(wait, token_bucket.wait_time(tokens, now))
+            if wait == 0:
+                requests.take(1)
+                if token_bucket is not None:
+                    token_bucket.take(tokens)
+            return wait
+
+    def _waiting(self, api_key, priority, delta):
+        if priority != Priority.INTERACTIVE:
+            return
+        with self.lock:
+            count = self.interactive_waiting.get(api_key, 0) + delta
+            if count > 0:
+                self.interactive_waiting[api_key] = count
+            else:
+                self.interactive_waiting.pop(api_key, None)
+
+    def acquire(self, api_key, kind, tokens=0, priority=Priority.INTERACTIVE, deadline=None) -> bool:
+        wait = self.try_acquire(api_key, kind, tokens, priority)
+        if wait == 0:
+            return True
+        self._waiting(api_key, priority, 1)
+        try:
+            while wait > 0:
+                if deadline is not None and time.monotonic() + wait > deadline:
+                    return False
+                time.sleep(min(wait, 1))
+                wait = self.try_acquire(api_key, kind, tokens, priority)
+            return True
+        finally:
+            self._waiting(api_key, priority, -1)
+
+    async def acquire_async(self, api_key, kind, tokens=0, priority=Priority.INTERACTIVE, deadline=None) -> bool:
+        wait = self.try_acquire(api_key, kind, tokens, priority)
+        if wait == 0:
+            return True
+        self._waiting(api_key, priority, 1)
+        try:
+            while wait > 0:
+                if deadline is not None and time.monotonic() + wait > deadline:
+                    return False
+                await asyncio.sleep(min(wait, 1))
+                wait = self.try_acquire(api_key, kind, tokens, priority)
+            return True
+        finally:
+            self._waiting(api_key, priority, -1)
+
+    def penalize(self, api_key, kind):
+        """
+        Empties the request bucket after the API answered 429, so other
+        callers of the key back off too.
+        """
+        with self.lock:
+            self._buckets(api_key, kind)[0].drain()
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,122 @@
+import contextvars
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src.logger import logger
+
+
+AUDIO_TOO_LONG_MESSAGE = '音声メッセージが長すぎます。{}秒以内でお願いします。'
+AUDIO_TOO_LARGE_MESSAGE = '音声メッセージのサイズが大きすぎます。'
+AUDIO_BUSY_MESSAGE = '音声メッセージが混み合っています。しばらく待ってからお試しください。'
+
+
+class AudioRejected(Exception):
+    """
+    The voice message is not transcribed; str(e) is the reply to the user.
+    """
+
+
+class AudioTranscriber:
+    """
+    Environment Variables:
+        AUDIO_MAX_DURATION
+        AUDIO_MAX_BYTES
+        AUDIO_WORKERS
+        AUDIO_MAX_PENDING
+
+    Voice messages are read chunk by chunk into a buffer in memory that
+    stops at AUDIO_MAX_BYTES, so nothing touches the disk and a long
+    upload cannot exhaust memory. Messages longer than AUDIO_MAX_DURATION
+    seconds are rejected before they are downloaded. Downloading,
+    transcription and the answer run on AUDIO_WORKERS threads of their own,
+    with at most AUDIO_MAX_PENDING messages waiting, so voice messages do
+    not hold up the threads answering text. call() waits for the result
+    instead, for callers that must answer in order.
+    """
+    def __init__(self, max_duration=None, max_bytes=None, workers=None, max_pending=None, chunk_size=64 * 1024):
+        self.max_duration = float(max_duration or os.getenv('AUDIO_MAX_DURATION') or 120)
+        self.max_bytes = int(max_bytes or os.getenv('AUDIO_MAX_BYTES') or 10 * 1024 * 1024)
+        self.workers = int(workers or os.getenv('AUDIO_WORKERS') or 2)
+        self.max_pending = int(max_pending or os.getenv('AUDIO_MAX_PENDING') or 20)
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='audio')
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def check_duration(self, duration_ms):
+        if duration_ms and duration_ms / 1000 > self.max_duration:
+            raise AudioRejected(AUDIO_TOO_LONG_MESSAGE.format(int(self.max_duration)))
+
+    def check_size(self, size):
+        if size is not None and int(size) > self.max_bytes:
+            raise AudioRejected(AUDIO_TOO_LARGE_MESSAGE)
+
+    def read(self, content) -> io.BytesIO:
+        """
+        Buffers a linebot Content response.
+        """
+        self.check_size(content.response.headers.get('content-length'))
+        buffer = io.BytesIO()
+        for chunk in content.iter_content(self.chunk_size):
+            if buffer.tell() + len(chunk) > self.max_bytes:
+                raise AudioRejected(AUDIO_TOO_LARGE_MESSAGE)
+            buffer.write(chunk)
+        buffer.seek(0)
+        return buffer
+
+    async def read_async(self, content) -> bytes:
+        self.check_size(content.response.headers.get('content-length'))
+        buffer = io.BytesIO()
+        async for chunk in content.iter_content(self.chunk_size):
+            if buffer.tell() + len(chunk) > self.max_bytes:
+                raise AudioRejected(AUDIO_TOO_LARGE_MESSAGE)
+            buffer.write(chunk)
+        return buffer.getvalue()
+
+    def reserve(self) -> bool:
+        """
+        Counts a voice message in; False when too many are waiting already.
+        """
+        with self.lock:
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+
+    def submit(self, func, *args) -> bool:
+        """
+        Runs func(*args) on the audio threads; False when too many voice
+        messages are waiting already.
+        """
+        if not self.reserve():
+            return False
+        context = contextvars.copy_context()
+        self.executor.submit(self._run, context, func, args)
+        return True
+
+    def call(self, func, *args):
+        """
+        Runs func(*args) on the audio threads and waits for its result, for
+        callers that have to keep their place in line. Raises AudioRejected
+        when too many voice messages are waiting already.
+        """
+        if not self.reserve():
+            raise AudioRejected(AUDIO_BUSY_MESSAGE)
+        try:
+            return self.executor.submit(contextvars.copy_context().run, func, *args).result()
+        finally:
+            self.release()
+
+    def _run(self, context, func, args):
+        try:
+            context.run(func, *args)
+        except Exception as e:
+            logger.error(f'failed to handle voice message: {str(e)}')
+        finally:
+            self.release()
@@ -0,0 +1,168 @@
+import re
+from urllib.parse import urlsplit
+
+from bs4 import BeautifulSoup, CData, NavigableString
+from bs4.element import Tag
+
+try:
+    import lxml  # noqa: F401
+    DEFAULT_PARSER = 'lxml'
+except ImportError:
+    DEFAULT_PARSER = 'html.parser'
+
+
+STRIP_TAGS = {'script', 'style', 'noscript', 'template', 'iframe', 'svg', 'canvas', 'nav', 'header', 'footer', 'aside', 'button', 'select'}
+BLOCK_TAGS = {'p', 'pre', 'td', 'blockquote', 'li', 'h2', 'h3'}
+POSITIVE_HINTS = re.compile(r'article|body|content|entry|main|news|post|story|text|paragraph|detail|本文', re.I)
+# 'ad' and 'tag' only as whole words, not inside 'downloads' or 'tagline'
+NEGATIVE_HINTS = re.compile(r'comment|footer|footnote|header|menu|nav|related|share|sidebar|social|sponsor|banner|promo|recommend|ranking|breadcrumb|copyright|advert|(?<![a-z0-9])(?:ads?|tags?)(?![a-z0-9])', re.I)
+PUNCTUATION = re.compile(r'[,，、。．.!?！？]')
+# scripts, styles and comments are dropped before parsing; they are most
+# of the markup of a news page and never part of the text
+RAW_NOISE = re.compile(r'<(script|style)\b[^>]*>.*?</\1\s*>|<!--.*?-->', re.I | re.S)
+TEXT_TYPES = (NavigableString, CData)
+
+# CSS selectors for the article body of the news sites we summarize,
+# tried in order before falling back to scoring
+DOMAIN_RULES = {
+    'udn.com': ['section.article-content__editor', 'div#story_body_content', 'article'],
+    'setn.com': ['div#ckuse', 'article'],
+    'tw.news.yahoo.com': ['div.caas-body', 'article'],
+    'news.yahoo.co.jp': ['div.article_body', 'article'],
+    'cna.com.tw': ['div.paragraph', 'article'],
+    'storm.mg': ['div#CMS_wrapper', 'article'],
+    'tvbs.com.tw': ['div.article_content', 'div#news_detail_div'],
+    'ltn.com.tw': ['div[itemprop=articleBody]', 'div.text'],
+    'ettoday.net': ['div.story', 'article'],
+    'chinatimes.com': ['div.article-body', 'article'],
+    'today.line.me': ['article', 'div.articleContent'],
+    'news.ttv.com.tw': ['div#newscontent', 'div.article'],
+    'nhk.or.jp': ['section.content--detail-body', 'div.content--body', 'article'],
+    'asahi.com': ['div.nfyQp', 'div[class*=ArticleText]', 'article'],
+    'mainichi.jp': ['section#articledetail-body', 'article'],
+    'nikkei.com': ['section[class*=container_]', 'article'],
+}
+
+
+class ArticleExtractor:
+    """
+    Extracts the main text of a news page. Noise elements are removed
+    first, then the per-domain selectors are tried, then the legacy
+    <article> / div.content lookup, and finally readability-style scoring
+    of block elements, with the text and link lengths of all candidates
+    measured in one pass over the tree.
+    """
+    def __init__(self, parser=None, rules=None, min_length=140):
+        self.parser = parser or DEFAULT_PARSER
+        self.rules = DOMAIN_RULES if rules is None else rules
+        self.min_length = min_length
+
+    def _domain_selectors(self, url):
+        host = (urlsplit(url).hostname or '') if url else ''
+        for domain, selectors in self.rules.items():
+            if host == domain or host.endswith('.' + domain):
+                return selectors
+        return []
+
+    @staticmethod
+    def _text(element):
+        return re.sub(r'\n\s*\n+', '\n', element.get_text('\n', strip=True))
+
+    def _select(self, soup, selector):
+        chunks = [self._text(element) for element in soup.select(selector)]
+        return [chunk for chunk in chunks if chunk]
+
+    def _class_weight(self, element):
+        weight = 0
+        for value in (' '.join(element.get('class') or []), element.get('id') or ''):
+            if value and POSITIVE_HINTS.search(value):
+                weight += 25
+            if value and NEGATIVE_HINTS.search(value):
+                weight -= 25
+        return weight
+
+    @staticmethod
+    def _strip(soup):
+        noise = [element for element in soup.descendants if element.name in STRIP_TAGS]
+        for element in noise:
+            # children of an element removed before are gone already
+            if not element.decomposed:
+                element.decompose()
+
+    @staticmethod
+    def _measure(nodes):
+        """
+        Text length, link text length and punctuation count of every tag,
+        summed bottom-up in one pass over `nodes` in document order.
+        Lengths count stripped strings like get_text(strip=True).
+        """
+        stats = {}
+        for node in reversed(nodes):
+            if type(node) in TEXT_TYPES:
+                text = node.strip()
+                if not text:
+                    continue
+                length, link_length, marks = len(text), 0, len(PUNCTUATION.findall(text))
+            elif isinstance(node, Tag):
+                entry = stats.get(id(node))
+                if entry is None:
+                    continue
+                if node.name == 'a':
+                    entry[1] = entry[0]
+                length, link_length, marks = entry
+            else:
+                continue
+            parent = stats.get(id(node.parent))
+            if parent is None:
+                parent = stats[id(node.parent)] = [0, 0, 0]
+            parent[0] += length
+            parent[1] += link_length
+            parent[2] += marks
+        return stats
+
+    def _score(self, soup):
+        nodes = list(soup.descendants)
+        stats = self._measure(nodes)
+        scores = {}
+        for block in nodes:
+            if block.name not in BLOCK_TAGS:
+                continue
+            entry = stats.get(id(block))
+            if entry is None or entry[0] < 20:
+                continue
+            text_length, _, marks = entry
+            score = 1 + marks + min(text_length // 100, 3)
+            parent = block.parent
+            grandparent = parent.parent if parent is not None else None
+            for candidate, share in ((parent, 1), (grandparent, 0.5)):
+                if candidate is None or candidate.name in (None, '[document]', 'html'):
+                    continue
+                if id(candidate) not in scores:
+                    scores[id(candidate)] = [candidate, self._class_weight(candidate)]
+                scores[id(candidate)][1] += score * share
+        best = None
+        best_score = 0
+        for candidate, score in scores.values():
+            text_length, link_length, _ = stats[id(candidate)]
+            score *= 1 - link_length / max(text_length, 1)
+            if score > best_score:
+                best, best_score = candidate, score
+        return best
+
+    def extract(self, html, url=None):
+        soup = BeautifulSoup(RAW_NOISE.sub('', html), self.parser)
+        self._strip(soup)
+        for selector in self._domain_selectors(url):
+            chunks = self._select(soup, selector)
+            if sum(len(chunk) for chunk in chunks) >= self.min_length:
+                return chunks
+        for selector in ('article', 'div.content'):
+            chunks = self._select(soup, selector)
+            if sum(len(chunk) for chunk in chunks) >= self.min_length:
+                return chunks
+        best = self._score(soup)
+        if best is not None:
+            return [self._text(best)]
+        body = soup.body or soup
+        text = self._text(body)
+        return [text] if text else []
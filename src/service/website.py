@@ -1,7 +1,21 @@
+import asyncio
+import contextvars
+import json
 import os
 import re
-import requests
-from bs4 import BeautifulSoup
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from src.http_client import http_client, async_http_client
+from src.logger import logger
+from src.metrics import metrics
+from src.models import UNSTABLE_ERROR_MESSAGE
+from src.rate_limiter import Priority, backoff_delay, get_reply_deadline
+from src.service.extractor import ArticleExtractor
+from src.tokenizer import split_by_tokens
+from src.utils import get_role_and_content, get_key_semaphore, get_async_key_semaphore
 
 
 WEBSITE_SYSTEM_MESSAGE = "あなたは今、データの整理、要約、まとめ、集約が得意で、細部に着目してポイントを押さえることができます。"
@@ -21,9 +35,35 @@ WEBSITE_MESSAGE_FORMAT = """
     - 要約： '...'
     - 重要な視点： '...'
 """
+WEBSITE_PART_MESSAGE_FORMAT = """
+    以下はリンク先の内容の一部です（{} / {}）:
+    \"\"\"
+    {}
+    \"\"\"
+
+    この部分の要点と重要な細部を 200 字程度でまとめてください。
+"""
 
 
 class Website:
+    """
+    Environment Variables:
+        WEBSITE_MAX_BYTES
+        WEBSITE_TIMEOUT
+        WEBSITE_CACHE_FRESH_SECONDS
+
+    `page_cache` is an optional SQLiteCacheStore for raw pages. Cached pages
+    are revalidated with If-None-Match / If-Modified-Since once they are
+    older than WEBSITE_CACHE_FRESH_SECONDS. `extractor` turns HTML into
+    text chunks and defaults to ArticleExtractor.
+    """
+    def __init__(self, page_cache=None, max_bytes=None, timeout=None, fresh_seconds=None, extractor=None):
+        self.page_cache = page_cache
+        self.extractor = extractor or ArticleExtractor()
+        self.max_bytes = int(max_bytes or os.getenv('WEBSITE_MAX_BYTES') or 2 * 1024 * 1024)
+        self.timeout = float(timeout or os.getenv('WEBSITE_TIMEOUT') or 10)
+        self.fresh_seconds = float(fresh_seconds or os.getenv('WEBSITE_CACHE_FRESH_SECONDS') or 300)
+
     def get_url_from_text(self, text: str):
         url_regex = re.compile(r'^https?://\S+')
         match = re.search(url_regex, text)
@@ -32,31 +72,245 @@ class Website:
         else:
             return None
 
+    def canonicalize_url(self, url: str) -> str:
+        parts = urlsplit(url.strip())
+        host = parts.hostname or ''
+        if host.startswith('www.'):
+            host = host[4:]
+        if parts.port and parts.port not in (80, 443):
+            host = f'{host}:{parts.port}'
+        query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.startswith('utm_') and k not in ('fbclid', 'gclid'))
+        path = parts.path.rstrip('/') or '/'
+        return urlunsplit(('https' if parts.scheme in ('http', 'https') else parts.scheme, host, path, urlencode(query), ''))
+
+    def parse_content(self, html: str, url: str = None):
+        return self.extractor.extract(html, url)
+
+    def _load_page(self, url: str):
+        if self.page_cache is None:
+            return None
+        value = self.page_cache.get(url)
+        if value is None:
+            return None
+        header, body = bytes(value).split(b'\n', 1)
+        page = json.loads(header)
+        page['body'] = zlib.decompress(body)
+        return page
+
+    def _store_page(self, url: str, headers, body: bytes):
+        if self.page_cache is None:
+            return
+        header = json.dumps({
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'content_type': headers.get('Content-Type'),
+            'fetched_at': time.time(),
+        }).encode('utf-8')
+        self.page_cache.set(url, header + b'\n' + zlib.compress(body))
+
+    def _conditional_headers(self, page):
+        headers = {}
+        if page and page.get('etag'):
+            headers['If-None-Match'] = page['etag']
+        if page and page.get('last_modified'):
+            headers['If-Modified-Since'] = page['last_modified']
+        return headers
+
+    def decode_html(self, body: bytes, content_type: str = None) -> str:
+        match = re.search(r'charset=["\']?([\w-]+)', content_type or '', re.I)
+        if not match:
+            match = re.search(rb'<meta[^>]+charset=["\']?([\w-]+)', body[:4096], re.I)
+        encoding = match.group(1) if match else 'utf-8'
+        if isinstance(encoding, bytes):
+            encoding = encoding.decode('ascii')
+        try:
+            return body.decode(encoding, errors='replace')
+        except LookupError:
+            return body.decode('utf-8', errors='replace')
+
+    def _fresh_html(self, page):
+        if page and time.time() - page['fetched_at'] < self.fresh_seconds:
+            return self.decode_html(page['body'], page['content_type'])
+        return None
+
+    def _handle_response(self, url: str, page, status, headers, body: bytes, truncated: bool) -> str:
+        if status == 304 and page:
+            self._store_page(url, {'ETag': page['etag'], 'Last-Modified': page['last_modified'], 'Content-Type': page['content_type']}, page['body'])
+            return self.decode_html(page['body'], page['content_type'])
+        if truncated:
+            logger.info(f'page truncated at {len(body)} bytes: {url}')
+        if status == 200:
+            self._store_page(url, headers, body)
+        return self.decode_html(body, headers.get('Content-Type'))
+
+    def fetch(self, url: str) -> str:
+        page = self._load_page(url)
+        html = self._fresh_html(page)
+        if html is not None:
+            return html
+        status, headers, body, truncated = http_client.fetch_limited(url, self.max_bytes, headers=self._conditional_headers(page), timeout=self.timeout, deadline=self.timeout)
+        return self._handle_response(url, page, status, headers, body, truncated)
+
+    async def fetch_async(self, url: str) -> str:
+        page = await asyncio.to_thread(self._load_page, url)
+        html = self._fresh_html(page)
+        if html is not None:
+            return html
+        status, headers, body, truncated = await async_http_client.fetch_limited(url, self.max_bytes, headers=self._conditional_headers(page), timeout=self.timeout, deadline=self.timeout)
+        return await asyncio.to_thread(self._handle_response, url, page, status, headers, body, truncated)
+
     def get_content_from_url(self, url: str):
-        hotpage = requests.get(url)
-        main = BeautifulSoup(hotpage.text, 'html.parser')
-        chunks = [article.text.strip() for article in main.find_all('article')]
-        if chunks == []:
-            chunks = [article.text.strip() for article in main.find_all('div', class_='content')]
-        return chunks
+        with metrics.timer('stage_seconds', stage='page_fetch'):
+            html = self.fetch(url)
+        with metrics.timer('stage_seconds', stage='page_extract'):
+            return self.parse_content(html, url)
+
+    async def get_content_from_url_async(self, url: str):
+        with metrics.timer('stage_seconds', stage='page_fetch'):
+            html = await self.fetch_async(url)
+        with metrics.timer('stage_seconds', stage='page_extract'):
+            return await asyncio.to_thread(self.parse_content, html, url)
 
 
 class WebsiteReader:
+    """
+    Environment Variables:
+        WEBSITE_CHUNK_TOKENS
+        WEBSITE_MAX_CHUNKS
+        SUMMARY_MAX_WORKERS
+        SUMMARY_MAX_INFLIGHT_PER_KEY
+        SUMMARY_PART_RETRIES
+
+    Pages that fit in one chunk are summarized with a single request.
+    Longer pages are split into token-sized chunks that are summarized
+    concurrently, and the partial summaries are reduced until they fit
+    into the final request.
+    """
     def __init__(self, model=None, model_engine=None):
         self.system_message = os.getenv('WEBSITE_SYSTEM_MESSAGE') or WEBSITE_SYSTEM_MESSAGE
         self.message_format = os.getenv('WEBSITE_MESSAGE_FORMAT') or WEBSITE_MESSAGE_FORMAT
+        self.part_message_format = os.getenv('WEBSITE_PART_MESSAGE_FORMAT') or WEBSITE_PART_MESSAGE_FORMAT
         self.model = model
-        self.text_length_limit = 1800
         self.model_engine = model_engine
+        self.chunk_tokens = int(os.getenv('WEBSITE_CHUNK_TOKENS') or 1500)
+        self.max_chunks = int(os.getenv('WEBSITE_MAX_CHUNKS') or 12)
+        self.max_workers = int(os.getenv('SUMMARY_MAX_WORKERS') or 4)
+        self.max_inflight_per_key = int(os.getenv('SUMMARY_MAX_INFLIGHT_PER_KEY') or 4)
+        self.part_retries = int(os.getenv('SUMMARY_PART_RETRIES') or 1)
+        self.requests = 0
+        self.lock = threading.Lock()
 
-    def send_msg(self, msg):
-        return self.model.chat_completions(msg, self.model_engine)
+    def send_msg(self, msg, priority=Priority.INTERACTIVE):
+        with self.lock:
+            self.requests += 1
+        return self.model.chat_completions(msg, self.model_engine, priority)
 
-    def summarize(self, chunks):
-        text = '\n'.join(chunks)[:self.text_length_limit]
-        msgs = [{
+    def prompt_key(self):
+        return '\n'.join([self.system_message, self.message_format, self.part_message_format, str(self.chunk_tokens), str(self.max_chunks)])
+
+    def _split(self, chunks):
+        parts = split_by_tokens('\n'.join(chunks), self.chunk_tokens, self.model_engine)
+        if len(parts) > self.max_chunks:
+            logger.info(f'website summary: keep {self.max_chunks} of {len(parts)} chunks')
+            parts = parts[:self.max_chunks]
+        return parts
+
+    def _build_messages(self, text):
+        return [{
             "role": "system", "content": self.system_message
         }, {
             "role": "user", "content": self.message_format.format(text)
         }]
-        return self.send_msg(msgs)
+
+    def _part_messages(self, i, total, text):
+        return [{
+            "role": "system", "content": self.system_message
+        }, {
+            "role": "user", "content": self.part_message_format.format(i + 1, total, text)
+        }]
+
+    def summarize_part(self, i, total, text):
+        msgs = self._part_messages(i, total, text)
+        semaphore = get_key_semaphore(self.model.api_key, self.max_inflight_per_key * self.model.key_count)
+        error_message = None
+        for attempt in range(self.part_retries + 1):
+            if attempt:
+                # the model call retried already; back off before asking again
+                delay = backoff_delay(attempt)
+                if time.monotonic() + delay > get_reply_deadline():
+                    break
+                time.sleep(delay)
+            with semaphore:
+                is_successful, response, error_message = self.send_msg(msgs, Priority.BULK)
+            if is_successful:
+                _, content = get_role_and_content(response)
+                return content
+        logger.info(f'skip website summary part {i}: {error_message}')
+        return None
+
+    async def summarize_part_async(self, i, total, text, semaphore):
+        msgs = self._part_messages(i, total, text)
+        error_message = None
+        for attempt in range(self.part_retries + 1):
+            if attempt:
+                # the model call retried already; back off before asking again
+                delay = backoff_delay(attempt)
+                if time.monotonic() + delay > get_reply_deadline():
+                    break
+                await asyncio.sleep(delay)
+            async with semaphore:
+                is_successful, response, error_message = await self.model.chat_completions(msgs, self.model_engine, Priority.BULK)
+            self.requests += 1
+            if is_successful:
+                _, content = get_role_and_content(response)
+                return content
+        logger.info(f'skip website summary part {i}: {error_message}')
+        return None
+
+    def _reduce(self, texts, summaries):
+        reduced = split_by_tokens('\n'.join(summaries), self.chunk_tokens, self.model_engine)
+        # every round must shrink, even if the model ignores the length hint
+        return reduced[:len(texts) - 1] or reduced[:1]
+
+    def _log(self, parts, started):
+        logger.info(f'website summary: {len(parts)} chunks, {self.requests} requests, {time.monotonic() - started:.2f}s')
+
+    def summarize(self, chunks):
+        started = time.monotonic()
+        self.requests = 0
+        parts = self._split(chunks)
+        if not parts:
+            return False, None, 'このサイトからテキストを取得できませんでした。'
+        texts = parts
+        while len(texts) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(texts))) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, self.summarize_part, i, len(texts), text) for i, text in enumerate(texts)]
+                summaries = [future.result() for future in futures]
+            summaries = [content for content in summaries if content is not None]
+            if not summaries:
+                self._log(parts, started)
+                return False, None, UNSTABLE_ERROR_MESSAGE
+            texts = self._reduce(texts, summaries)
+        result = self.send_msg(self._build_messages(texts[0]))
+        self._log(parts, started)
+        return result
+
+    async def summarize_async(self, chunks):
+        started = time.monotonic()
+        self.requests = 0
+        parts = await asyncio.to_thread(self._split, chunks)
+        if not parts:
+            return False, None, 'このサイトからテキストを取得できませんでした。'
+        texts = parts
+        semaphore = get_async_key_semaphore(self.model.api_key, self.max_inflight_per_key * self.model.key_count)
+        while len(texts) > 1:
+            summaries = await asyncio.gather(*[self.summarize_part_async(i, len(texts), text, semaphore) for i, text in enumerate(texts)])
+            summaries = [content for content in summaries if content is not None]
+            if not summaries:
+                self._log(parts, started)
+                return False, None, UNSTABLE_ERROR_MESSAGE
+            texts = await asyncio.to_thread(self._reduce, texts, summaries)
+        result = await self.model.chat_completions(self._build_messages(texts[0]), self.model_engine)
+        self.requests += 1
+        self._log(parts, started)
+        return result
@@ -1,7 +1,16 @@
-import math
+import asyncio
+import contextvars
+import json
 import os
 import re
-from src.utils import get_role_and_content
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from src.logger import logger
+from src.metrics import metrics
+from src.rate_limiter import Priority, backoff_delay, get_reply_deadline
+from src.tokenizer import split_by_tokens
+from src.utils import get_role_and_content, get_key_semaphore, get_async_key_semaphore
 
 from youtube_transcript_api import YouTubeTranscriptApi, NoTranscriptFound, TranscriptsDisabled
 
@@ -13,26 +22,67 @@ PART {} END
 """
 WHOLE_MESSAGE_FORMAT = "下面是每一個部分的小結論：\"\"\"{}\"\"\" \n\n 請給我全部小結論的總結，字數約 100 字左右"
 SINGLE_MESSAGE_FORMAT = "下面是一個 Youtube 影片的字幕： \"\"\"{}\"\"\" \n\n請總結出這部影片的重點與一些細節，字數約 100 字左右"
+TRANSCRIPT_LANGUAGES = ['zh-TW', 'zh', 'ja', 'zh-Hant', 'zh-Hans', 'en', 'ko']
 
 
 class Youtube:
-    def __init__(self, step):
-        self.step = step
-        self.chunk_size = 150
+    """
+    Environment Variables:
+        YOUTUBE_CHUNK_TOKENS
+        YOUTUBE_MAX_CHUNKS
 
-    def get_transcript_chunks(self, video_id):
+    The whole transcript is packed into chunks of up to
+    YOUTUBE_CHUNK_TOKENS tokens, at most YOUTUBE_MAX_CHUNKS of them.
+    Fetched transcripts are kept zlib-compressed in `transcript_cache`
+    (a SQLiteCacheStore) under the video id and the language preference,
+    so asking for the same video again skips the fetch.
+    """
+    def __init__(self, transcript_cache=None, chunk_tokens=None, max_chunks=None):
+        self.transcript_cache = transcript_cache
+        self.chunk_tokens = int(chunk_tokens or os.getenv('YOUTUBE_CHUNK_TOKENS') or 1500)
+        self.max_chunks = int(max_chunks or os.getenv('YOUTUBE_MAX_CHUNKS') or 20)
+
+    def get_transcript(self, video_id):
+        """
+        Returns (language code, caption lines).
+        """
+        key = f'youtube_transcript:{video_id}:{",".join(TRANSCRIPT_LANGUAGES)}'
+        if self.transcript_cache is not None:
+            value = self.transcript_cache.get(key)
+            if value is not None:
+                metrics.inc('transcript_cache_total', result='hit')
+                transcript = json.loads(zlib.decompress(value))
+                return transcript['language'], transcript['lines']
+            metrics.inc('transcript_cache_total', result='miss')
+        with metrics.timer('stage_seconds', stage='youtube_transcript'):
+            transcript = YouTubeTranscriptApi.list_transcripts(video_id).find_transcript(TRANSCRIPT_LANGUAGES)
+            lines = [t.get('text') for t in transcript.fetch()]
+        if self.transcript_cache is not None:
+            value = json.dumps({'language': transcript.language_code, 'lines': lines}, ensure_ascii=False)
+            self.transcript_cache.set(key, zlib.compress(value.encode('utf-8')))
+        return transcript.language_code, lines
+
+    def get_transcript_chunks(self, video_id, model_engine=None):
         try:
-            transcript = YouTubeTranscriptApi.get_transcript(video_id, languages=['zh-TW', 'zh', 'ja', 'zh-Hant', 'zh-Hans', 'en', 'ko'])
-            text = [t.get('text') for i, t in enumerate(transcript) if i % self.step == 0]
-            chunks = ['\n'.join(text[i*self.chunk_size: (i+1)*self.chunk_size]) for i in range(math.ceil(len(text) / self.chunk_size))]
+            _, lines = self.get_transcript(video_id)
         except NoTranscriptFound:
             return False, [], '目前只支援：中文、英文、日文、韓文'
         except TranscriptsDisabled:
             return False, [], '本影片無開啟字幕功能'
         except Exception as e:
             return False, [], str(e)
+        chunks = split_by_tokens('\n'.join(lines), self.chunk_tokens, model_engine)
+        if not chunks:
+            return False, [], '本影片沒有字幕內容'
+        if len(chunks) > self.max_chunks:
+            logger.info(f'youtube summary: keep {self.max_chunks} of {len(chunks)} chunks')
+            chunks = chunks[:self.max_chunks]
         return True, chunks, None
 
+    async def get_transcript_chunks_async(self, video_id, model_engine=None):
+        # youtube_transcript_api has no async client
+        return await asyncio.to_thread(self.get_transcript_chunks, video_id, model_engine)
+
     def retrieve_video_id(self, url):
         regex = r'(?:youtube\.com\/(?:[^\/]+\/.+\/|(?:v|e(?:mbed)?)\/|.*[?&]v=)|youtu\.be\/)([a-zA-Z0-9_-]{11})'
         match = re.search(regex, url)
@@ -50,33 +100,93 @@ class YoutubeTranscriptReader:
         self.single_message_format = os.getenv('SINGLE_MESSAGE_FORMAT') or SINGLE_MESSAGE_FORMAT
         self.model = model
         self.model_engine = model_engine
+        self.max_workers = int(os.getenv('SUMMARY_MAX_WORKERS') or 4)
+        self.max_inflight_per_key = int(os.getenv('SUMMARY_MAX_INFLIGHT_PER_KEY') or 4)
+        self.part_retries = int(os.getenv('SUMMARY_PART_RETRIES') or 1)
 
-    def send_msg(self, msg):
-        return self.model.chat_completions(msg, self.model_engine)
+    def send_msg(self, msg, priority=Priority.INTERACTIVE):
+        return self.model.chat_completions(msg, self.model_engine, priority)
 
-    def summarize(self, chunks):
-        summary_msg = []
+    def prompt_key(self):
+        return '\n'.join([self.summary_system_prompt, self.part_message_format, self.whole_message_format, self.single_message_format])
+
+    def _part_messages(self, i, chunk):
+        return [{
+            "role": "system", "content": self.summary_system_prompt
+        }, {
+            "role": "user", "content": self.part_message_format.format(i, chunk, i)
+        }]
+
+    def _final_messages(self, chunks, summary_msg):
         if len(chunks) > 1:
-            for i, chunk in enumerate(chunks):
-                msgs = [{
-                    "role": "system", "content": self.summary_system_prompt
-                }, {
-                    "role": "user", "content": self.part_message_format.format(i, chunk, i)
-                }]
-                _, response, _ = self.send_msg(msgs)
-                _, content = get_role_and_content(response)
-                summary_msg.append(content)
             text = '\n'.join(summary_msg)
-            msgs = [{
+            return [{
                 'role': 'system', 'content': self.summary_system_prompt
             }, {
                 'role': 'user', 'content': self.whole_message_format.format(text)
             }]
-        else:
-            text = chunks[0]
-            msgs = [{
-                'role': 'system', 'content': self.summary_system_prompt
-            }, {
-                'role': 'user', 'content': self.single_message_format.format(text)
-            }]
-        return self.send_msg(msgs)
+        text = chunks[0]
+        return [{
+            'role': 'system', 'content': self.summary_system_prompt
+        }, {
+            'role': 'user', 'content': self.single_message_format.format(text)
+        }]
+
+    def summarize_part(self, i, chunk):
+        msgs = self._part_messages(i, chunk)
+        semaphore = get_key_semaphore(self.model.api_key, self.max_inflight_per_key * self.model.key_count)
+        error_message = None
+        for attempt in range(self.part_retries + 1):
+            if attempt:
+                # the model call retried already; back off before asking again
+                delay = backoff_delay(attempt)
+                if time.monotonic() + delay > get_reply_deadline():
+                    break
+                time.sleep(delay)
+            with semaphore:
+                is_successful, response, error_message = self.send_msg(msgs, Priority.BULK)
+            if is_successful:
+                _, content = get_role_and_content(response)
+                return content
+        logger.info(f'skip youtube summary part {i}: {error_message}')
+        return None
+
+    async def summarize_part_async(self, i, chunk, semaphore):
+        msgs = self._part_messages(i, chunk)
+        error_message = None
+        for attempt in range(self.part_retries + 1):
+            if attempt:
+                # the model call retried already; back off before asking again
+                delay = backoff_delay(attempt)
+                if time.monotonic() + delay > get_reply_deadline():
+                    break
+                await asyncio.sleep(delay)
+            async with semaphore:
+                is_successful, response, error_message = await self.model.chat_completions(msgs, self.model_engine, Priority.BULK)
+            if is_successful:
+                _, content = get_role_and_content(response)
+                return content
+        logger.info(f'skip youtube summary part {i}: {error_message}')
+        return None
+
+    def summarize(self, chunks):
+        summary_msg = []
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as executor:
+                # each part carries the reply deadline of the calling event
+                futures = [executor.submit(contextvars.copy_context().run, self.summarize_part, i, chunk) for i, chunk in enumerate(chunks)]
+                summary_msg = [future.result() for future in futures]
+            summary_msg = [content for content in summary_msg if content is not None]
+            if not summary_msg:
+                return False, None, 'OpenAI API システムが不安定なため、後で再試行してください。'
+        return self.send_msg(self._final_messages(chunks, summary_msg))
+
+    async def summarize_async(self, chunks):
+        summary_msg = []
+        if len(chunks) > 1:
+            semaphore = get_async_key_semaphore(self.model.api_key, self.max_inflight_per_key * self.model.key_count)
+            summary_msg = await asyncio.gather(*[self.summarize_part_async(i, chunk, semaphore) for i, chunk in enumerate(chunks)])
+            summary_msg = [content for content in summary_msg if content is not None]
+            if not summary_msg:
+                return False, None, 'OpenAI API システムが不安定なため、後で再試行してください。'
+        return await self.model.chat_completions(self._final_messages(chunks, summary_msg), self.model_engine)
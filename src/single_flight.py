@@ -0,0 +1,124 @@
+import asyncio
+import os
+import threading
+import time
+
+from src.logger import logger
+
+
+SINGLE_FLIGHT_TIMEOUT_MESSAGE = '同じリクエストの処理に時間がかかっています。しばらく待ってからお試しください。'
+
+
+# result of a flight whose leader failed
+_FAILED = object()
+
+
+class _Call:
+    __slots__ = ('event', 'result')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = _FAILED
+
+
+class SingleFlight:
+    """
+    Environment Variables:
+        SINGLE_FLIGHT_TIMEOUT
+
+    Coalesces concurrent calls with the same key: the first caller runs
+    `func` and the others wait for it. Only successful results are shared;
+    `shareable(result)` decides for results that report failure as a value.
+    When the leader raises or fails, its error may be tied to its own API
+    key, so the waiters run the flight again with their own arguments.
+    Waiters give up after SINGLE_FLIGHT_TIMEOUT seconds with a TimeoutError.
+    """
+    def __init__(self, timeout=None, shareable=None):
+        self.timeout = float(timeout or os.getenv('SINGLE_FLIGHT_TIMEOUT') or 120)
+        self.shareable = shareable
+        self.calls = {}
+        self.executed = 0
+        self.shared = 0
+        self.timeouts = 0
+        self.lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = _Call()
+                    self.calls[key] = call
+                    self.executed += 1
+            if leader:
+                break
+            logger.info(f'single flight: wait for {key}')
+            if not call.event.wait(max(0, deadline - time.monotonic())):
+                with self.lock:
+                    self.timeouts += 1
+                raise TimeoutError(SINGLE_FLIGHT_TIMEOUT_MESSAGE)
+            if call.result is not _FAILED:
+                with self.lock:
+                    self.shared += 1
+                return call.result
+            logger.info(f'single flight: leader of {key} failed, run it again')
+        try:
+            result = func(*args, **kwargs)
+            if self.shareable is None or self.shareable(result):
+                call.result = result
+            return result
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call.event.set()
+
+    def stats(self):
+        with self.lock:
+            return {'executed': self.executed, 'shared': self.shared, 'timeouts': self.timeouts, 'inflight': len(self.calls)}
+
+
+class AsyncSingleFlight:
+    """
+    asyncio counterpart of SingleFlight. Must be used from one event loop.
+    """
+    def __init__(self, timeout=None, shareable=None):
+        self.timeout = float(timeout or os.getenv('SINGLE_FLIGHT_TIMEOUT') or 120)
+        self.shareable = shareable
+        self.calls = {}
+        self.executed = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    async def do(self, key, func, *args, **kwargs):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            future = self.calls.get(key)
+            if future is None:
+                break
+            logger.info(f'single flight: wait for {key}')
+            try:
+                # shield so a waiter timing out does not cancel the leader
+                result = await asyncio.wait_for(asyncio.shield(future), max(0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise TimeoutError(SINGLE_FLIGHT_TIMEOUT_MESSAGE)
+            if result is not _FAILED:
+                self.shared += 1
+                return result
+            logger.info(f'single flight: leader of {key} failed, run it again')
+        future = asyncio.get_running_loop().create_future()
+        self.calls[key] = future
+        self.executed += 1
+        result = _FAILED
+        try:
+            result = await func(*args, **kwargs)
+            return result
+        finally:
+            self.calls.pop(key, None)
+            # also reached when the leader raised or was cancelled
+            future.set_result(result if self.shareable is None or result is _FAILED or self.shareable(result) else _FAILED)
+
+    def stats(self):
+        return {'executed': self.executed, 'shared': self.shared, 'timeouts': self.timeouts, 'inflight': len(self.calls)}
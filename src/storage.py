@@ -1,39 +1,217 @@
 import json
 import datetime
+import os
+import threading
+import time
+
+from pymongo import UpdateOne
+
+from src.cache import LRUCache
+from src.logger import logger
 
 
 class FileStorage:
-    def __init__(self, file_name):
+    """
+    Keeps a JSON snapshot in `file_name` and appends every change to
+    `file_name.journal`. The journal is fsynced in batches and folded back
+    into the snapshot in the background once it grows past a threshold.
+
+    Environment Variables:
+        FILE_STORAGE_FSYNC_INTERVAL
+        FILE_STORAGE_COMPACT_BYTES
+    """
+    def __init__(self, file_name, fsync_interval=None, compact_bytes=None):
         self.fine_name = file_name
+        self.journal_name = f'{file_name}.journal'
+        self.compacting_name = f'{file_name}.journal.compacting'
+        self.fsync_interval = float(fsync_interval or os.getenv('FILE_STORAGE_FSYNC_INTERVAL') or 1)
+        self.compact_bytes = int(compact_bytes or os.getenv('FILE_STORAGE_COMPACT_BYTES') or 16 * 1024 * 1024)
         self.history = {}
+        self.lock = threading.Lock()
+        self.journal = None
+        self.dirty = False
+        self.compacting = False
+        self.flusher = None
+        self.loaded = False
+        self.load_lock = threading.Lock()
+
+    def _open_journal(self):
+        if self.journal is None:
+            self.journal = open(self.journal_name, 'a', encoding='utf-8', newline='')
+            # never append a record onto a torn one
+            if self.journal.tell() > 0:
+                with open(self.journal_name, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        self.journal.write('\n')
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self.flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.fsync_interval)
+            with self.lock:
+                self._flush()
+
+    def _flush(self):
+        if self.dirty and self.journal is not None:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.dirty = False
+
+    def _replay(self, file_name, data):
+        """
+        Applies the complete records of a journal and returns the offset
+        after the last complete line.
+        """
+        end = 0
+        try:
+            with open(file_name, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # torn write at the end of the journal
+                        break
+                    end += len(line)
+                    try:
+                        data.update(json.loads(line))
+                    except ValueError:
+                        logger.error(f'skip corrupt record in {file_name} at byte {end - len(line)}')
+        except FileNotFoundError:
+            pass
+        return end
+
+    def _compact(self):
+        with self.lock:
+            self._flush()
+            self.journal.close()
+            self.journal = None
+            os.replace(self.journal_name, self.compacting_name)
+            self._open_journal()
+            snapshot = dict(self.history)
+        self._write_snapshot(snapshot)
+        os.remove(self.compacting_name)
+        self.compacting = False
+
+    def _write_snapshot(self, snapshot):
+        tmp_name = f'{self.fine_name}.tmp'
+        with open(tmp_name, 'w', encoding='utf-8', newline='') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, self.fine_name)
 
     def save(self, data):
-        self.history.update(data)
-        with open(self.fine_name, 'w', newline='') as f:
-            json.dump(self.history, f)
+        # a save before the first load would be overwritten by it
+        self.load()
+        with self.lock:
+            self.history.update(data)
+            self._open_journal()
+            self.journal.write(json.dumps(data) + '\n')
+            self.dirty = True
+            if not self.compacting and self.journal.tell() > self.compact_bytes:
+                self.compacting = True
+                threading.Thread(target=self._compact, daemon=True).start()
 
     def load(self):
-        with open(self.fine_name, newline='') as jsonfile:
-            data = json.load(jsonfile)
-        self.history = data
+        """
+        Reads the snapshot and journal once, on the first lookup or save;
+        concurrent first callers wait for that single read.
+        """
+        if not self.loaded:
+            with self.load_lock:
+                if not self.loaded:
+                    self._load()
         return self.history
 
+    def _load(self):
+        data = {}
+        try:
+            with open(self.fine_name, newline='') as jsonfile:
+                data = json.load(jsonfile)
+        except FileNotFoundError:
+            pass
+        self._replay(self.compacting_name, data)
+        end = self._replay(self.journal_name, data)
+        with self.lock:
+            if self.journal is None and os.path.exists(self.journal_name) and os.path.getsize(self.journal_name) > end:
+                os.truncate(self.journal_name, end)
+        if os.path.exists(self.compacting_name):
+            # a compaction was interrupted: finish it before appending again
+            self._write_snapshot(data)
+            os.remove(self.compacting_name)
+        with self.lock:
+            self.history = data
+            self.loaded = True
+
+    def get(self, user_id):
+        self.load()
+        return self.history.get(user_id)
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
 
 class MongoStorage:
-    def __init__(self, db):
+    """
+    Environment Variables:
+        MONGO_STORAGE_BATCH_SIZE
+        MONGO_STORAGE_FLUSH_INTERVAL
+    """
+    def __init__(self, db, batch_size=None, flush_interval=None):
         self.db = db
+        self.batch_size = int(batch_size or os.getenv('MONGO_STORAGE_BATCH_SIZE') or 100)
+        self.flush_interval = float(flush_interval or os.getenv('MONGO_STORAGE_FLUSH_INTERVAL') or 1)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.db['api_key'].create_index('user_id')
+        threading.Thread(target=self._flush_loop, daemon=True).start()
 
-    def save(self, data):
-        user_id, api_key = list(data.items())[0]
-        self.db['api_key'].update_one({
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        now = datetime.datetime.utcnow()
+        operations = [UpdateOne({
             'user_id': user_id
         }, {
             '$set': {
                 'user_id': user_id,
                 'api_key': api_key,
-                'created_at': datetime.datetime.utcnow()
+                'created_at': now
             }
-        }, upsert=True)
+        }, upsert=True) for user_id, api_key in pending.items()]
+        try:
+            self.db['api_key'].bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.error(f'failed to save {len(operations)} api keys: {str(e)}')
+            with self.lock:
+                for user_id, api_key in pending.items():
+                    self.pending.setdefault(user_id, api_key)
+
+    def save(self, data):
+        with self.lock:
+            self.pending.update(data)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def get(self, user_id):
+        with self.lock:
+            if user_id in self.pending:
+                return self.pending[user_id]
+        doc = self.db['api_key'].find_one({'user_id': user_id}, {'api_key': 1})
+        return doc['api_key'] if doc else None
 
     def load(self):
         data = list(self.db['api_key'].find())
@@ -44,11 +222,26 @@ class MongoStorage:
 
 
 class Storage:
-    def __init__(self, storage):
+    """
+    Environment Variables:
+        STORAGE_CACHE_SIZE
+    """
+    def __init__(self, storage, cache_size=None):
         self.storage = storage
+        self.cache = LRUCache(maxsize=int(cache_size or os.getenv('STORAGE_CACHE_SIZE') or 10000))
 
     def save(self, data):
         self.storage.save(data)
+        for user_id, api_key in data.items():
+            self.cache.set(user_id, api_key)
+
+    def get(self, user_id):
+        api_key = self.cache.get(user_id)
+        if api_key is None:
+            api_key = self.storage.get(user_id)
+            if api_key is not None:
+                self.cache.set(user_id, api_key)
+        return api_key
 
     def load(self):
         return self.storage.load()
@@ -0,0 +1,77 @@
+import functools
+import math
+import os
+from typing import List
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+MESSAGE_TOKEN_OVERHEAD = 4
+DEFAULT_TOKEN_BUDGET = 2000
+MODEL_TOKEN_BUDGETS = {
+    'gpt-3.5-turbo': 2000,
+    'gpt-3.5-turbo-16k': 8000,
+    'gpt-4': 4000,
+    'gpt-4-32k': 16000,
+}
+
+
+@functools.lru_cache(maxsize=8)
+def _get_encoding(model_engine):
+    try:
+        return tiktoken.encoding_for_model(model_engine)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def count_tokens(text: str, model_engine: str = None) -> int:
+    if tiktoken is not None:
+        return len(_get_encoding(model_engine or 'gpt-3.5-turbo').encode(text))
+    # rough estimate without tiktoken: CJK characters are about one token
+    # each, everything else about four characters per token
+    wide = sum(1 for c in text if ord(c) >= 0x2E80)
+    return wide + math.ceil((len(text) - wide) / 4)
+
+
+def get_token_budget(model_engine: str = None) -> int:
+    if os.getenv('MEMORY_TOKEN_BUDGET'):
+        return int(os.getenv('MEMORY_TOKEN_BUDGET'))
+    for name, budget in sorted(MODEL_TOKEN_BUDGETS.items(), key=lambda item: -len(item[0])):
+        if model_engine and model_engine.startswith(name):
+            return budget
+    return DEFAULT_TOKEN_BUDGET
+
+
+def split_by_tokens(text: str, max_tokens: int, model_engine: str = None) -> List[str]:
+    """
+    Packs the lines of `text` into chunks of at most `max_tokens` tokens.
+    Lines longer than that are cut by characters.
+    """
+    chunks = []
+    current = []
+    used = 0
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        tokens = count_tokens(line, model_engine)
+        if tokens > max_tokens:
+            step = max(1, len(line) * max_tokens // tokens)
+            pieces = [line[i:i + step] for i in range(0, len(line), step)]
+        else:
+            pieces = [line]
+        for piece in pieces:
+            if len(pieces) > 1:
+                tokens = count_tokens(piece, model_engine)
+            if current and used + tokens > max_tokens:
+                chunks.append('\n'.join(current))
+                current = []
+                used = 0
+            current.append(piece)
+            used += tokens
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
@@ -1,11 +1,31 @@
+import asyncio
+import threading
+
 # import opencc
 
 # s2t_converter = opencc.OpenCC('s2t')
 # t2s_converter = opencc.OpenCC('t2s')
 
+_key_semaphores = {}
+_key_semaphores_lock = threading.Lock()
+_async_key_semaphores = {}
+
 
 def get_role_and_content(response: str):
     role = response['choices'][0]['message']['role']
     content = response['choices'][0]['message']['content'].strip()
     # content = s2t_converter.convert(content)
     return role, content
+
+
+def get_key_semaphore(key: str, limit: int) -> threading.BoundedSemaphore:
+    with _key_semaphores_lock:
+        if key not in _key_semaphores:
+            _key_semaphores[key] = threading.BoundedSemaphore(limit)
+        return _key_semaphores[key]
+
+
+def get_async_key_semaphore(key: str, limit: int) -> asyncio.Semaphore:
+    if key not in _async_key_semaphores:
+        _async_key_semaphores[key] = asyncio.Semaphore(limit)
+    return _async_key_semaphores[key]